@@ -135,3 +135,29 @@ class DataBase:
             raise
         finally:
             conn.close()
+
+    def save_queries(self, user_id, query_type, mushroom_images):
+        """Сохраняем несколько фото одного запроса (альбом) за одно подключение"""
+        conn = self.get_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT telegram_user_id FROM users WHERE telegram_user_id = %s", (user_id,))
+                if not cursor.fetchone():
+                    logging.error(f"Пользователь с Telegram ID {user_id} не найден в таблице users.")
+                    raise ValueError(f"Пользователь с Telegram ID {user_id} не найден в базе.")
+
+                cursor.executemany(
+                    """
+                    INSERT INTO interactions (user_id, query_type, query_text, mushroom_image)
+                    VALUES (%s, %s, %s, %s);
+                    """,
+                    [(user_id, query_type, None, image) for image in mushroom_images]
+                )
+                conn.commit()
+                logging.info(f"Сохранено {len(mushroom_images)} фото альбома пользователя {user_id}")
+                return len(mushroom_images)
+        except Exception as e:
+            logging.error(f"Ошибка сохранения альбома: {e}")
+            raise
+        finally:
+            conn.close()
@@ -0,0 +1,181 @@
+import hashlib
+import io
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+from PIL import Image, ImageOps
+
+from app.catalog import MANIFEST_NAME, MushroomCatalog
+from app.config import settings
+
+logger = logging.getLogger("app.assets")
+
+MANIFEST_VERSION = 1
+
+
+def _sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def _normalize_image(data: bytes, max_side: int, quality: int):
+    """Приводит фото к размеру и качеству, удобным для Telegram"""
+    with Image.open(io.BytesIO(data)) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=quality, optimize=True, progressive=True)
+        return buffer.getvalue(), image.size
+
+
+def build_reference_assets(source_dir=None, assets_dir=None, max_side=None, quality=None):
+    """Сборка нормализованных эталонных фото и манифеста (name, latin, sha256, размер)"""
+    source_dir = source_dir or settings.reference_photo_dir
+    assets_dir = assets_dir or settings.reference_assets_dir
+    max_side = max_side or settings.reference_image_max_side
+    quality = quality or settings.reference_image_quality
+
+    os.makedirs(assets_dir, exist_ok=True)
+    manifest_path = os.path.join(assets_dir, MANIFEST_NAME)
+
+    # Предыдущий манифест позволяет не пережимать неизменившиеся фото
+    previous = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, encoding="utf-8") as f:
+            old_manifest = json.load(f)
+        if old_manifest.get("max_side") == max_side and old_manifest.get("quality") == quality:
+            previous = {entry["name"]: entry for entry in old_manifest.get("images", [])}
+
+    species = MushroomCatalog()  # Только описания: латинское название по русскому имени фото
+    entries = []
+
+    for filename in sorted(os.listdir(source_dir)):
+        if not filename.lower().endswith(".jpg"):
+            continue
+
+        name = filename[:-4]
+        with open(os.path.join(source_dir, filename), "rb") as f:
+            source_bytes = f.read()
+        source_hash = _sha256(source_bytes)
+
+        old_entry = previous.get(name)
+        if (old_entry and old_entry["source_sha256"] == source_hash
+                and os.path.exists(os.path.join(assets_dir, old_entry["file"]))):
+            entries.append(old_entry)
+            continue
+
+        data, (width, height) = _normalize_image(source_bytes, max_side, quality)
+        digest = _sha256(data)
+        output_name = f"{digest[:16]}.jpg"
+        with open(os.path.join(assets_dir, output_name), "wb") as f:
+            f.write(data)
+
+        entry = species.find(name)
+        latin_name = entry.latin if entry else None
+        if latin_name is None:
+            logger.warning(f"Для фото '{name}' не найдено латинское название")
+
+        entries.append({
+            "name": name,
+            "latin": latin_name,
+            "file": output_name,
+            "sha256": digest,
+            "source_sha256": source_hash,
+            "bytes": len(data),
+            "width": width,
+            "height": height,
+        })
+        logger.debug(f"Фото '{name}': {len(source_bytes)} -> {len(data)} байт, {width}x{height}")
+
+    # Удаляем устаревшие файлы, на которые больше не ссылается манифест
+    used_files = {entry["file"] for entry in entries}
+    for filename in os.listdir(assets_dir):
+        if filename.endswith(".jpg") and filename not in used_files:
+            os.remove(os.path.join(assets_dir, filename))
+
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "max_side": max_side,
+        "quality": quality,
+        "images": entries,
+    }
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+    total = sum(entry["bytes"] for entry in entries)
+    logger.info(f"Собрано {len(entries)} эталонных фото ({total / 1024 / 1024:.1f} МБ) в {assets_dir}")
+    return manifest
+
+
+class ReferencePhotoCatalog:
+    """Каталог эталонных фото: манифест + ограниченный LRU-кэш байтов в памяти"""
+
+    def __init__(self, assets_dir=None, max_items=None, max_bytes=None):
+        self.assets_dir = assets_dir or settings.reference_assets_dir
+        self.max_items = max_items if max_items is not None else settings.reference_cache_max_items
+        self.max_bytes = max_bytes if max_bytes is not None else settings.reference_cache_max_bytes
+
+        manifest_path = os.path.join(self.assets_dir, MANIFEST_NAME)
+        if not os.path.exists(manifest_path):
+            logger.warning(f"Манифест {manifest_path} не найден, выполняем сборку эталонных фото")
+            build_reference_assets(assets_dir=self.assets_dir)
+
+        # Загрузка каталога - одно чтение манифеста
+        with open(manifest_path, encoding="utf-8") as f:
+            manifest = json.load(f)
+
+        self.entries = {entry["name"]: entry for entry in manifest["images"]}
+        self.paths = {
+            name: os.path.join(self.assets_dir, entry["file"])
+            for name, entry in self.entries.items()
+        }
+
+        self._cache = OrderedDict()
+        self._cache_bytes = 0
+        self._lock = threading.Lock()
+        logger.info(f"Каталог эталонных фото загружен: {len(self.entries)} записей")
+
+    def warm(self):
+        """Предзагрузка фото в память в пределах ограничений кэша"""
+        for name, entry in self.entries.items():
+            if len(self._cache) >= self.max_items or self._cache_bytes + entry["bytes"] > self.max_bytes:
+                break
+            self.get_bytes(name)
+        logger.info(f"Прогрето {len(self._cache)} фото ({self._cache_bytes / 1024:.0f} КБ)")
+
+    def latin(self, name):
+        """Латинское название по русскому имени фото"""
+        entry = self.entries.get(name)
+        return entry["latin"] if entry else None
+
+    def get_bytes(self, name):
+        """Возвращает байты фото, поддерживая LRU-вытеснение по количеству и объёму"""
+        with self._lock:
+            data = self._cache.get(name)
+            if data is not None:
+                self._cache.move_to_end(name)
+                return data
+
+        with open(self.paths[name], "rb") as f:
+            data = f.read()
+
+        with self._lock:
+            if name not in self._cache and len(data) <= self.max_bytes:
+                self._cache[name] = data
+                self._cache_bytes += len(data)
+                while len(self._cache) > self.max_items or self._cache_bytes > self.max_bytes:
+                    _, evicted = self._cache.popitem(last=False)
+                    self._cache_bytes -= len(evicted)
+        return data
+
+
+if __name__ == "__main__":
+    # Сборка: python -m app.assets
+    build_reference_assets()
@@ -0,0 +1,392 @@
+# Пакетная классификация больших архивов фото (директория, .tar/.tar.gz, .zip)
+#
+# Файлы читаются потоком, декодируются пулом потоков с ограниченным числом фото "в полёте",
+# классифицируются батчами и сразу дописываются в CSV или Parquet. Прогресс сохраняется
+# после каждой записи, поэтому после сбоя задание продолжается с места остановки,
+# а расход памяти не зависит от размера архива.
+#
+# запустить: python -m app.bulk run /data/archive.zip --job-dir ./bulk_jobs/field-2024 [--format parquet]
+# продолжить после сбоя: та же команда с тем же --job-dir
+# статус:    python -m app.bulk status --job-dir ./bulk_jobs/field-2024
+
+import argparse
+import csv
+import io
+import json
+import logging
+import os
+import fcntl
+import tarfile
+import time
+import uuid
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from PIL import Image
+
+from app.config import settings
+from app.image_filter import check_pixels
+
+logger = logging.getLogger("app.bulk")
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+PROGRESS_NAME = "progress.json"
+LOCK_NAME = ".progress.lock"
+OUTPUT_FORMATS = ("csv", "parquet")
+RESULT_COLUMNS = ("file", "class_name", "confidence", "top_k", "error")
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet необязателен, CSV работает без него
+    pa = pq = None
+
+
+def _is_image(name):
+    return name.lower().endswith(IMAGE_EXTENSIONS) and not os.path.basename(name).startswith(".")
+
+
+def iter_source(source, skip=0):
+    """Поток (имя, байты) фото источника в детерминированном порядке; первые skip фото пропускаются"""
+    if os.path.isdir(source):
+        index = 0
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for filename in sorted(files):
+                if not _is_image(filename):
+                    continue
+                index += 1
+                if index <= skip:
+                    continue
+                path = os.path.join(root, filename)
+                with open(path, "rb") as f:
+                    yield os.path.relpath(path, source), f.read()
+    elif zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as archive:
+            names = [info.filename for info in archive.infolist() if not info.is_dir() and _is_image(info.filename)]
+            for name in names[skip:]:
+                yield name, archive.read(name)
+    elif tarfile.is_tarfile(source):
+        # Потоковый режим: архив читается последовательно, без индекса всех членов в памяти
+        with tarfile.open(source, "r|*") as archive:
+            index = 0
+            for member in archive:
+                if not member.isfile() or not _is_image(member.name):
+                    continue
+                index += 1
+                if index <= skip:
+                    continue
+                yield member.name, archive.extractfile(member).read()
+    else:
+        raise ValueError(f"Неподдерживаемый источник: {source} (ожидается директория, tar или zip)")
+
+
+def _decode(name, data, size):
+    """Декодирование в пуле потоков (Pillow отпускает GIL); фото сразу уменьшается до входа модели"""
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            check_pixels(image)
+            image.draft("RGB", (size, size))
+            return name, image.convert("RGB").resize((size, size), Image.BILINEAR), None
+    except Exception as e:
+        return name, None, str(e)
+
+
+class CsvResultWriter:
+    """Построчная запись в CSV; после сбоя файл обрезается до последней сохранённой позиции"""
+
+    def __init__(self, job_dir, state):
+        self.path = os.path.join(job_dir, "results.csv")
+        exists = os.path.exists(self.path)
+        self._file = open(self.path, "a+", newline="", encoding="utf-8")
+        if exists:
+            self._file.truncate(state.get("csv_bytes", 0))
+            self._file.seek(0, os.SEEK_END)
+        self._writer = csv.writer(self._file)
+        if not self._file.tell():
+            self._writer.writerow(RESULT_COLUMNS)
+        self._bytes = self._file.tell()
+
+    def write(self, rows):
+        """Возвращает True, когда всё записанное до сих пор надёжно сохранено"""
+        self._writer.writerows([[row[column] for column in RESULT_COLUMNS] for row in rows])
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._bytes = self._file.tell()
+        return True
+
+    def state(self):
+        return {"csv_bytes": self._bytes}
+
+    def close(self):
+        self._file.close()
+        return True
+
+
+class ParquetResultWriter:
+    """Запись в Parquet частями part-NNNNN.parquet по part_rows строк; незавершённые части отбрасываются"""
+
+    def __init__(self, job_dir, state, part_rows=None):
+        if pq is None:
+            raise RuntimeError("Для вывода в Parquet требуется пакет pyarrow")
+        self.job_dir = job_dir
+        self.part_rows = part_rows or settings.bulk_parquet_part_rows
+        self.parts = state.get("parts", 0)
+        for filename in os.listdir(job_dir):
+            if filename.startswith("part-") and int(filename[5:10]) >= self.parts:
+                os.remove(os.path.join(job_dir, filename))
+        self._rows = []
+
+    def _flush(self):
+        table = pa.Table.from_pylist(self._rows, schema=pa.schema([
+            ("file", pa.string()), ("class_name", pa.string()), ("confidence", pa.float32()),
+            ("top_k", pa.string()), ("error", pa.string()),
+        ]))
+        path = os.path.join(self.job_dir, f"part-{self.parts:05d}.parquet")
+        pq.write_table(table, path + ".tmp")
+        os.replace(path + ".tmp", path)
+        self.parts += 1
+        self._rows = []
+
+    def write(self, rows):
+        self._rows.extend(rows)
+        if len(self._rows) >= self.part_rows:
+            self._flush()
+            return True
+        return False
+
+    def state(self):
+        return {"parts": self.parts}
+
+    def close(self):
+        if self._rows:
+            self._flush()
+        return True
+
+
+class JobLeased(RuntimeError):
+    """Задание уже выполняется или ждёт в очереди: аренду держит другой запуск"""
+
+
+@contextmanager
+def _job_lock(job_dir):
+    """Межпроцессная блокировка progress.json на время проверки и взятия аренды"""
+    with open(os.path.join(job_dir, LOCK_NAME), "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class JobProgress:
+    """Прогресс задания в progress.json: сколько фото источника обработано и записано.
+
+    Запуск держит аренду (lease_owner, lease_until) и продлевает её по ходу работы: пока аренда
+    жива, второй запуск того же задания не начнётся и не испортит файлы результатов.
+    """
+
+    def __init__(self, job_dir, data):
+        self.job_dir = job_dir
+        self.data = data
+
+    @classmethod
+    def load(cls, job_dir):
+        with open(os.path.join(job_dir, PROGRESS_NAME), encoding="utf-8") as f:
+            return cls(job_dir, json.load(f))
+
+    @classmethod
+    def load_or_create(cls, job_dir, source, output_format):
+        os.makedirs(job_dir, exist_ok=True)
+        if os.path.exists(os.path.join(job_dir, PROGRESS_NAME)):
+            progress = cls.load(job_dir)
+            if progress.data["source"] != os.path.abspath(source):
+                raise ValueError(f"Задание в {job_dir} создано для другого источника: {progress.data['source']}")
+            return progress
+        return cls(job_dir, {
+            "source": os.path.abspath(source),
+            "format": output_format,
+            "status": "pending",
+            "processed": 0,
+            "errors": 0,
+            "writer": {},
+            "elapsed_seconds": 0.0,
+            "model_version": None,
+            "lease_owner": None,
+            "lease_until": 0.0,
+        })
+
+    def save(self, **fields):
+        self.data.update(fields)
+        path = os.path.join(self.job_dir, PROGRESS_NAME)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
+
+    def lease_live(self):
+        return self.data.get("lease_until", 0) > time.time()
+
+    def claim(self, owner, seconds):
+        """Атомарно берёт (или продлевает свою) аренду на seconds; False - живая аренда у другого запуска"""
+        with _job_lock(self.job_dir):
+            if os.path.exists(os.path.join(self.job_dir, PROGRESS_NAME)):
+                self.data = JobProgress.load(self.job_dir).data
+            if self.data.get("lease_owner") not in (None, owner) and self.lease_live():
+                return False
+            self.save(lease_owner=owner, lease_until=time.time() + seconds)
+        return True
+
+
+def _result_rows(classifier, names, images, top_k):
+    """Строки результата для батча: постобработка выполняется сразу для всего батча"""
+    results = classifier.postprocess(classifier.predict_probs(images), k=top_k)
+    return [
+        {
+            "file": name,
+            "class_name": result["latin"][0],
+            "confidence": result["confidences"][0],
+            "top_k": ";".join(f"{latin}:{confidence:.2f}" for latin, confidence in
+                              zip(result["latin"], result["confidences"])),
+            "error": None,
+        }
+        for name, result in zip(names, results)
+    ]
+
+
+def run_bulk_job(source, job_dir, classifier, output_format="csv", batch_size=None, workers=None,
+                 top_k=3, max_inflight=None, owner=None, hold_on_failure=0):
+    """Выполняет (или продолжает) пакетное задание и возвращает его прогресс.
+
+    owner - id запуска для аренды (у задачи Celery - её id, он сохраняется при повторах);
+    hold_on_failure - сколько секунд аренда держится после сбоя (пока ждёт повтор задачи).
+    JobLeased, если задание выполняет другой запуск.
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Неизвестный формат вывода: {output_format}")
+    batch_size = batch_size or settings.bulk_batch_size
+    workers = workers or settings.bulk_decode_workers
+    max_inflight = max_inflight or 2 * batch_size  # Ограничение памяти: столько фото декодируется одновременно
+
+    progress = JobProgress.load_or_create(job_dir, source, output_format)
+    if progress.data["status"] == "done":
+        logger.info(f"Задание {job_dir} уже завершено")
+        return progress
+    owner = owner or uuid.uuid4().hex
+    if not progress.claim(owner, settings.bulk_lease_seconds):
+        raise JobLeased(f"Задание {job_dir} уже выполняется запуском {progress.data['lease_owner']}")
+    output_format = progress.data["format"]
+    writer_cls = CsvResultWriter if output_format == "csv" else ParquetResultWriter
+    writer = writer_cls(job_dir, progress.data["writer"])
+
+    processed, errors = progress.data["processed"], progress.data["errors"]
+    if processed:
+        logger.info(f"Продолжаем задание {job_dir} с фото №{processed + 1}")
+    progress.save(status="running", model_version=classifier.version)
+
+    size = classifier.processor.size["height"]
+    pending = 0  # Обработано, но ещё не зафиксировано писателем
+    pending_errors = 0
+    names, images, error_rows = [], [], []
+    started = time.perf_counter()
+    elapsed_before = progress.data["elapsed_seconds"]
+    heartbeat = time.monotonic()
+
+    def flush():
+        nonlocal processed, errors, pending, pending_errors, names, images, error_rows, heartbeat
+        rows = error_rows + (_result_rows(classifier, names, images, top_k) if images else [])
+        pending += len(rows)
+        pending_errors += len(error_rows)
+        names, images, error_rows = [], [], []
+        if writer.write(rows):
+            processed += pending
+            errors += pending_errors
+            pending = pending_errors = 0
+            progress.save(
+                processed=processed, errors=errors, writer=writer.state(),
+                elapsed_seconds=round(elapsed_before + time.perf_counter() - started, 2),
+                lease_until=time.time() + settings.bulk_lease_seconds
+            )
+            heartbeat = time.monotonic()
+            logger.info(f"Обработано {processed} фото, ошибок {errors}")
+        elif time.monotonic() - heartbeat > settings.bulk_lease_seconds / 3:
+            # Писатель Parquet фиксирует прогресс редко - аренду продлеваем отдельно
+            progress.save(lease_until=time.time() + settings.bulk_lease_seconds)
+            heartbeat = time.monotonic()
+
+    def handle(result):
+        name, image, error = result
+        if image is None:
+            error_rows.append({"file": name, "class_name": None, "confidence": None, "top_k": None, "error": error})
+        else:
+            names.append(name)
+            images.append(image)
+        if len(images) + len(error_rows) >= batch_size:
+            flush()
+
+    try:
+        with ThreadPoolExecutor(workers) as pool:
+            inflight = deque()
+            for name, data in iter_source(source, skip=processed):
+                inflight.append(pool.submit(_decode, name, data, size))
+                if len(inflight) >= max_inflight:
+                    handle(inflight.popleft().result())
+            while inflight:
+                handle(inflight.popleft().result())
+        if images or error_rows:
+            flush()
+        writer.close()
+    except BaseException:
+        progress.save(status="failed", lease_until=time.time() + hold_on_failure)
+        raise
+
+    processed += pending
+    errors += pending_errors
+    elapsed = elapsed_before + time.perf_counter() - started
+    progress.save(
+        status="done", processed=processed, errors=errors, writer=writer.state(),
+        elapsed_seconds=round(elapsed, 2),
+        throughput_images_per_s=round(processed / elapsed, 2) if elapsed else 0.0,
+        lease_owner=None, lease_until=0.0
+    )
+    logger.info(f"Задание {job_dir} завершено: {processed} фото за {elapsed:.1f} с")
+    return progress
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Пакетная классификация архивов фото грибов")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run = subparsers.add_parser("run", help="запустить или продолжить задание")
+    run.add_argument("source", help="директория, .tar(.gz) или .zip")
+    run.add_argument("--job-dir", required=True, help="директория результатов и прогресса")
+    run.add_argument("--format", choices=OUTPUT_FORMATS, default="csv")
+    run.add_argument("--batch-size", type=int, default=None)
+    run.add_argument("--workers", type=int, default=None, help="потоки декодирования")
+    run.add_argument("--top-k", type=int, default=3)
+    run.add_argument("--model-version", default=None, help="версия из реестра моделей")
+
+    status = subparsers.add_parser("status", help="прогресс задания")
+    status.add_argument("--job-dir", required=True)
+    args = parser.parse_args()
+
+    if args.command == "status":
+        print(json.dumps(JobProgress.load(args.job_dir).data, ensure_ascii=False, indent=2))
+        return
+
+    from app.model_registry import ModelRegistry, DEFAULT_VERSION
+    from app.services import MushroomClassifier
+
+    version = args.model_version or DEFAULT_VERSION
+    model_dir, student_dir = ModelRegistry().model_dirs(version)
+    classifier = MushroomClassifier(model_dir=model_dir, student_dir=student_dir, version=version)
+    progress = run_bulk_job(
+        args.source, args.job_dir, classifier, args.format, args.batch_size, args.workers, args.top_k
+    )
+    print(json.dumps(progress.data, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+# Единый каталог видов грибов: латинское название (метки модели), русское название
+# (эталонные фото, поиск), съедобность, эталонное фото и его file_id в Telegram
+#
+# Строится один раз на процесс из описаний Settings и манифеста эталонных фото и после этого
+# не меняется (кроме кэша file_id). Обработчики бота и классификатор ищут в нём по id класса,
+# латинскому или нормализованному русскому названию за O(1), без разбора строк на месте.
+
+import json
+import logging
+import os
+from types import MappingProxyType
+
+from app.config import settings
+
+logger = logging.getLogger("app.catalog")
+
+EDIBILITY_UNKNOWN = "информация о съедобности отсутствует"
+EDIBILITY_MARKERS = {"Съедобен": "🟢", "Условно-съедобен": "🟡", "Несъедобен": "🔴"}
+MANIFEST_NAME = "manifest.json"
+
+
+def parse_description(description: str):
+    """'🟢 Лисичка обыкновенная (Съедобен)' -> ('Лисичка обыкновенная', 'Съедобен')"""
+    russian, edibility = description.split(" ", 1)[-1].rsplit(" (", 1)
+    return russian.strip(), edibility.rstrip(")")
+
+
+def normalize_name(name: str) -> str:
+    """Ключ поиска: нижний регистр, ё -> е, одиночные пробелы"""
+    return " ".join(name.lower().replace("ё", "е").split())
+
+
+class CatalogEntry:
+    """Вид гриба; все поля, кроме file_id, задаются при построении каталога и не меняются"""
+
+    __slots__ = ("id", "latin", "russian", "key", "edibility", "photo_name", "photo_path", "file_id")
+
+    def __init__(self, id, latin, russian, edibility, photo_name=None, photo_path=None):
+        for name, value in (("id", id), ("latin", latin), ("russian", russian), ("key", normalize_name(russian)),
+                            ("edibility", edibility), ("photo_name", photo_name), ("photo_path", photo_path)):
+            object.__setattr__(self, name, value)
+        self.file_id = None  # file_id эталонного фото после первой отправки: дальше без загрузки байтов
+
+    def __setattr__(self, name, value):
+        if name != "file_id":
+            raise AttributeError(f"Поле {name} записи каталога неизменяемо")
+        object.__setattr__(self, name, value)
+
+    @property
+    def marker(self):
+        return EDIBILITY_MARKERS.get(self.edibility, "⚪")
+
+    def __repr__(self):
+        return f"CatalogEntry({self.id}, {self.latin!r}, {self.russian!r})"
+
+
+class MushroomCatalog:
+    """Неизменяемый каталог видов: id каталога - номер в порядке латинских названий"""
+
+    def __init__(self, descriptions: dict = None, photos: dict = None):
+        descriptions = descriptions if descriptions is not None else settings.mushroom_descriptions
+        photos_by_key = {normalize_name(name): (name, path) for name, path in (photos or {}).items()}
+
+        entries = []
+        for i, latin in enumerate(sorted(descriptions)):
+            russian, edibility = parse_description(descriptions[latin])
+            photo_name, photo_path = photos_by_key.pop(normalize_name(russian), (None, None))
+            entries.append(CatalogEntry(i, latin, russian, edibility, photo_name, photo_path))
+        for name, _ in photos_by_key.values():
+            logger.warning(f"Для фото '{name}' нет описания вида")
+
+        self.entries = tuple(entries)
+        self.by_latin = MappingProxyType({entry.latin: entry for entry in entries})
+        self.by_key = MappingProxyType({entry.key: entry for entry in entries})
+        # Виды с эталонным фото в порядке русских названий - по ним идёт поиск в боте
+        self.searchable = tuple(sorted((e for e in entries if e.photo_name), key=lambda e: e.key))
+        self._class_entries = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, catalog_id):
+        """Запись по id каталога (None для неизвестного id)"""
+        return self.entries[catalog_id] if 0 <= catalog_id < len(self.entries) else None
+
+    def find(self, name: str):
+        """Запись по русскому (в любом регистре, с ё или е) или латинскому названию"""
+        return self.by_key.get(normalize_name(name)) or self.by_latin.get(name)
+
+    def search(self, query: str, limit: int = 5):
+        """Виды с эталонным фото, в русском названии которых встречается запрос"""
+        query = normalize_name(query)
+        matches = []
+        for entry in self.searchable:
+            if query in entry.key:
+                matches.append(entry)
+                if len(matches) >= limit:
+                    break
+        return matches
+
+    def for_labels(self, id2label: dict):
+        """Записи в порядке id классов модели (None для меток вне каталога); кэшируется на набор меток"""
+        labels = tuple(id2label[i] for i in range(len(id2label)))
+        entries = self._class_entries.get(labels)
+        if entries is None:
+            entries = self._class_entries[labels] = tuple(self.by_latin.get(label) for label in labels)
+            missing = [label for label, entry in zip(labels, entries) if entry is None]
+            if missing:
+                logger.warning(f"Метки модели без описания в каталоге: {missing}")
+        return entries
+
+
+def manifest_photos(assets_dir=None) -> dict:
+    """Имя эталонного фото -> путь к нормализованному файлу (пусто, если сборки ещё нет)"""
+    assets_dir = assets_dir or settings.reference_assets_dir
+    manifest_path = os.path.join(assets_dir, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, encoding="utf-8") as f:
+        manifest = json.load(f)
+    return {entry["name"]: os.path.join(assets_dir, entry["file"]) for entry in manifest["images"]}
+
+
+_catalog = None
+
+
+def get_catalog() -> MushroomCatalog:
+    """Каталог процесса: строится при первом обращении и дальше общий для всех"""
+    global _catalog
+    if _catalog is None:
+        _catalog = MushroomCatalog(photos=manifest_photos())
+        logger.info(f"Каталог видов: {len(_catalog)} записей, с эталонным фото {len(_catalog.searchable)}")
+    return _catalog
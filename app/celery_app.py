@@ -1,15 +1,35 @@
 from celery import Celery
+from app.config import settings
+from app.redis_client import redis_url
 
-# Настройка брокера (Redis)
+# Настройка брокера (Redis) - адрес и ограничения пула берутся из Settings
 celery_app = Celery(
     'mushroom_classification',
-    broker='redis://redis:6379/0',  # измените localhost на имя сервиса Redis
-    backend='redis://redis:6379/0'
+    broker=redis_url(),
+    backend=redis_url()
 )
 
 # Настройки Celery
 celery_app.conf.update(
-    result_expires=3600,  # Время жизни результатов задачи
+    result_expires=600,  # Страховка для непрочитанных результатов: прочитанные бот удаляет сразу
     task_serializer='json',  # Формат сериализации задач
     accept_content=['json'],  # Разрешенные форматы задач
-)
\ No newline at end of file
+    # Процесс воркера перезапускается после N задач или при превышении памяти (КБ, проверяется после задачи);
+    # новый процесс заново загружает модель при старте (worker_process_init)
+    worker_max_tasks_per_child=settings.celery_max_tasks_per_child,
+    worker_max_memory_per_child=settings.celery_max_memory_per_child_kb,
+    # Пакетные задания - в своей очереди и на своих воркерах: архив на часы не занимает
+    # интерактивный воркер и не раздувает время ответа боту (ступени деградации)
+    # Очередь интерактивных задач явно совпадает с той, длину которой читает LoadMonitor
+    task_default_queue=settings.celery_queue_name,
+    task_routes={'app.tasks.run_bulk_classification': {'queue': settings.bulk_queue_name}},
+    broker_pool_limit=settings.redis_max_connections,  # Пул соединений с брокером
+    redis_max_connections=settings.redis_max_connections,  # Пул соединений result backend
+    redis_socket_timeout=settings.redis_socket_timeout,
+    redis_socket_connect_timeout=settings.redis_socket_connect_timeout,
+    broker_transport_options={
+        'socket_timeout': settings.redis_socket_timeout,
+        'socket_connect_timeout': settings.redis_socket_connect_timeout,
+        'health_check_interval': settings.redis_health_check_interval,
+    },
+)
@@ -13,11 +13,138 @@ class Settings(BaseSettings):
         "config.json": os.getenv("GDRIVE_CONFIG_FILE_ID"),
         "model.safetensors": os.getenv("GDRIVE_MODEL_FILE_ID"),
         "preprocessor_config.json": os.getenv("GDRIVE_PREPROCESSOR_FILE_ID"),
-        "metadata.json": os.getenv("GDRIVE_METADATA_FILE_ID")
+        "metadata.json": os.getenv("GDRIVE_METADATA_FILE_ID"),
+        # Головы раннего выхода (training/early_exit.py), необязательны
+        "early_exit.json": os.getenv("GDRIVE_EARLY_EXIT_CONFIG_FILE_ID"),
+        "early_exit.safetensors": os.getenv("GDRIVE_EARLY_EXIT_HEADS_FILE_ID"),
     }
 
+    # Компактная модель-студент (training/distill.py)
+    gdrive_student_file_ids: dict = {
+        "config.json": os.getenv("GDRIVE_STUDENT_CONFIG_FILE_ID"),
+        "model.safetensors": os.getenv("GDRIVE_STUDENT_MODEL_FILE_ID"),
+        "preprocessor_config.json": os.getenv("GDRIVE_STUDENT_PREPROCESSOR_FILE_ID"),
+    }
+    # Backend классификатора: "base" (ViT-base), "student" или "cascade" (студент -> ViT-base при сомнениях)
+    model_backend: str = os.getenv("MODEL_BACKEND", "base")
+    cascade_threshold: float = 80  # Уверенность студента (%), ниже которой подключается базовая модель
+    # Локальные директории моделей (вместо загрузки с Google Диска), например для оценки
+    model_dir: str = os.getenv("MODEL_DIR", "")
+    student_model_dir: str = os.getenv("STUDENT_MODEL_DIR", "")
+    # Квантизация: "none" или "dynamic_int8" (int8-веса Linear-слоёв, только CPU)
+    model_quantization: str = os.getenv("MODEL_QUANTIZATION", "none")
+    # Ранний выход: уверенные фото покидают ViT после промежуточных слоёв (нужны головы early_exit.*)
+    early_exit_enabled: bool = os.getenv("EARLY_EXIT", "false").lower() == "true"
+    # Реестр версий модели (python -m app.model_registry): горячая замена и канареечный трафик
+    model_registry_dir: str = os.getenv("MODEL_REGISTRY_DIR", "model_registry")
+    model_canary_percent: float = float(os.getenv("MODEL_CANARY_PERCENT", "0"))
+    model_registry_check_interval: float = 10  # Как часто воркер проверяет состояние реестра (с)
+    # Версия, не прошедшая загрузку (недокопированный чекпойнт, сбой чтения), загружается повторно через столько секунд
+    model_load_retry_seconds: float = float(os.getenv("MODEL_LOAD_RETRY_SECONDS", "60"))
+    model_smoke_images: int = 4  # Сколько эталонных фото прогоняется перед заменой модели
+
     telegram_bot_token: str = os.getenv("TELEGRAM_BOT_TOKEN")
 
+    # Режим получения обновлений: "polling" или "webhook" (несколько реплик за балансировщиком)
+    telegram_mode: str = os.getenv("TELEGRAM_MODE", "polling")
+    telegram_webhook_url: str = os.getenv("TELEGRAM_WEBHOOK_URL", "")  # Публичный URL, регистрируется в Telegram
+    telegram_webhook_path: str = "/telegram/webhook"
+    telegram_webhook_secret: str = os.getenv("TELEGRAM_WEBHOOK_SECRET", "")
+    telegram_webhook_max_queue: int = 1000  # При переполнении очереди отвечаем 503, Telegram повторит позже
+    telegram_concurrent_updates: int = 16  # Сколько обновлений обрабатывается одновременно
+    # Адрес Bot API (можно направить на локальную заглушку app.stub_telegram)
+    telegram_api_base_url: str = os.getenv("TELEGRAM_API_BASE_URL", "https://api.telegram.org/bot")
+    telegram_api_base_file_url: str = os.getenv("TELEGRAM_API_BASE_FILE_URL", "https://api.telegram.org/file/bot")
+
+    # Эталонные фото грибов: исходники и нормализованная сборка (python -m app.assets)
+    reference_photo_dir: str = "mushroom_photo"
+    reference_assets_dir: str = os.getenv("REFERENCE_ASSETS_DIR", "mushroom_photo_cache")
+    reference_image_max_side: int = 1280  # Telegram всё равно ужимает фото до 1280px
+    reference_image_quality: int = 85
+    reference_cache_max_items: int = 32  # Ограничения кэша фото в памяти
+    reference_cache_max_bytes: int = 16 * 1024 * 1024
+
+    # Redis: общий пул соединений процесса (app/redis_client.py), брокер и backend Celery
+    redis_host: str = os.getenv("REDIS_HOST", "redis")
+    redis_port: int = int(os.getenv("REDIS_PORT", "6379"))
+    redis_db: int = int(os.getenv("REDIS_DB", "0"))
+    redis_password: str = os.getenv("REDIS_PASSWORD", "")
+    redis_max_connections: int = int(os.getenv("REDIS_MAX_CONNECTIONS", "50"))
+    redis_socket_timeout: float = 5
+    redis_socket_connect_timeout: float = 2
+    redis_health_check_interval: int = 30  # Проверка простаивающих соединений перед использованием (с)
+
+    # Хранилище состояний диалога: "redis" (несколько реплик) или "memory" (один узел)
+    state_store_backend: str = os.getenv("STATE_STORE_BACKEND", "redis")
+    state_ttl_seconds: int = 24 * 3600
+    state_max_entries: int = 100_000
+
+    # Порог уверенности (%), ниже которого результат считается ненадёжным
+    min_confidence_threshold: float = 50
+    result_top_k: int = 3  # Сколько классов попадает в результат классификации
+    # Test-time augmentation: запускается только если первый проход ниже порога
+    tta_enabled: bool = os.getenv("TTA_ENABLED", "true").lower() == "true"
+    tta_views: int = 6  # Число аугментированных видов (не больше 11)
+    tta_base_scale: float = 256 / 224  # Масштаб, с которого берутся кропы
+
+    # Предварительная проверка фото до постановки в очередь классификации (app/image_filter.py)
+    image_min_side: int = 224  # Вход модели: из размеров фото Telegram берётся наименьший не меньше этого
+    image_max_bytes: int = 10 * 1024 * 1024
+    image_max_pixels: int = 40_000_000  # Защита от "бомб распаковки" (и в бота, и в воркере)
+    image_min_stddev: float = 4.0  # Ниже - однотонное изображение (пустой кадр, закрытый объектив)
+
+    # Inline-подсказки: результаты одинаковы для всех, Telegram кэширует их на своей стороне
+    inline_cache_time: int = 3600  # Сколько секунд Telegram может отдавать ответ без запроса к боту
+    inline_cache_max_entries: int = 10_000  # Запросов в кэше бота (префиксы слов названий - заранее)
+    inline_choice_debounce_seconds: float = 2.0  # Повторный выбор того же результата в окне игнорируется
+
+    # Ограничения памяти долгоживущих процессов
+    label_tables_max_versions: int = 4  # Таблиц классов разных версий модели в памяти бота
+    # Перезапуск процесса воркера Celery: после N задач и при RSS выше порога (КБ) - страховка от утечек
+    celery_max_tasks_per_child: int = int(os.getenv("CELERY_MAX_TASKS_PER_CHILD", "5000"))
+    celery_max_memory_per_child_kb: int = int(os.getenv("CELERY_MAX_MEMORY_PER_CHILD_KB", str(3 * 1024 * 1024)))
+
+    # Деградация под нагрузкой (app/degradation.py): ступень по очереди Celery и p95 ответа воркеров
+    classification_timeout: float = float(os.getenv("CLASSIFICATION_TIMEOUT", "60"))  # Ожидание результата, с
+    celery_queue_name: str = "celery"  # Очередь задач классификации в брокере
+    degradation_queue_soft: int = int(os.getenv("DEGRADATION_QUEUE_SOFT", "50"))  # Дешёвый путь
+    degradation_queue_hard: int = int(os.getenv("DEGRADATION_QUEUE_HARD", "200"))  # Сразу "попробуйте позже"
+    degradation_latency_soft: float = 5.0  # p95 времени ответа (с) для дешёвого пути
+    degradation_latency_hard: float = 20.0  # p95 времени ответа (с) для отказа
+    degradation_window_seconds: float = 60  # Окно замеров времени ответа
+    degradation_check_interval: float = 1.0  # Как часто бот читает длину очереди (с)
+    result_cache_ttl: int = 24 * 3600  # Сколько хранится результат по хэшу фото
+
+    # Профилирование по запросу (POST /admin/profile, celery control profile)
+    admin_token: str = os.getenv("ADMIN_TOKEN", "")  # Заголовок X-Admin-Token; пусто - эндпоинты отключены
+    profile_dir: str = os.getenv("PROFILE_DIR", "profiles")  # Общий каталог профилей приложения и воркеров
+    profile_max_seconds: float = 60.0  # Верхняя граница длительности одного захвата
+    profile_sample_interval: float = 0.005  # Шаг семплирования стеков для cpu-профиля
+    profile_tracemalloc_frames: int = 10  # Глубина трассировки выделений памяти
+    profile_torch_iterations: int = 5  # Прямых проходов в трассе torch.profiler
+    # Монитор цикла событий бота: стек обработчика, блокирующего цикл дольше порога (0 - отключён)
+    event_loop_lag_threshold_ms: float = float(os.getenv("EVENT_LOOP_LAG_THRESHOLD_MS", "200"))
+
+    # Альбомы (media group): фото собираются в течение окна и классифицируются одним батчем
+    album_window_seconds: float = 1.5
+    album_max_photos: int = 10  # Telegram допускает до 10 фото в альбоме
+
+    # Пакетные задания (python -m app.bulk, POST /bulk/jobs)
+    bulk_jobs_dir: str = os.getenv("BULK_JOBS_DIR", "bulk_jobs")
+    bulk_batch_size: int = 32
+    bulk_decode_workers: int = 4
+    bulk_parquet_part_rows: int = 10_000  # Строк в одной части Parquet (и шаг сохранения прогресса)
+    bulk_queue_name: str = "bulk"  # Отдельная очередь: длинные задания не занимают интерактивных воркеров
+    bulk_lease_seconds: float = 300  # Аренда запуска задания, продлевается по ходу работы
+    bulk_queue_lease_seconds: float = 6 * 3600  # Аренда задания, которое ждёт своего воркера в очереди
+    bulk_upload_max_bytes: int = int(os.getenv("BULK_UPLOAD_MAX_BYTES", str(2 * 1024 ** 3)))  # Предел архива через API
+
+    # Индекс эмбеддингов для поиска похожих эталонных фото (python -m app.embedding_index build)
+    embedding_index_dir: str = os.getenv("EMBEDDING_INDEX_DIR", "mushroom_embeddings")
+    embedding_index_autobuild: bool = os.getenv("EMBEDDING_INDEX_AUTOBUILD", "true").lower() == "true"
+    embedding_ann_min_size: int = 50_000  # С какого размера галереи использовать ANN-индекс faiss
+    similar_k: int = 3  # Сколько похожих фото показывать (0 - отключить)
+
     mushroom_descriptions: dict = {
         'Stropharia aeruginosa': '🟢 Строфария сине-зелёная (Съедобен)',
         'Hericium coralloides': '🟢 Ежовик коралловидный (Съедобен)',
@@ -0,0 +1,130 @@
+# Ступени деградации классификации под нагрузкой
+#
+# 0 normal   - полный путь: TTA при сомнениях, поиск похожих фото, каскад с базовой моделью
+# 1 degraded - дешёвый путь: без TTA и похожих фото, в каскаде отвечает только студент
+# 2 shed     - новые фото не скачиваются и не ставятся в очередь, пользователь сразу получает "попробуйте позже"
+#
+# Ступень выбирается по длине очереди Celery в брокере и p95 времени ответа воркеров за окно.
+# В ступенях normal и degraded сначала проверяется кэш результатов в Redis (ключ - активная версия модели
+# и хэш фото): повторно присланное фото не стоит нового прохода модели.
+
+import hashlib
+import json
+import logging
+import time
+from collections import Counter, deque
+
+from app.config import settings
+from app.model_registry import DEFAULT_VERSION, STATE_KEY
+from app.redis_client import get_async_redis
+
+logger = logging.getLogger("app.degradation")
+
+NORMAL, DEGRADED, SHED = 0, 1, 2
+TIER_NAMES = ("normal", "degraded", "shed")
+CACHE_KEY = "classify_cache:"  # + версия модели + ":" + хэш фото
+
+
+class Overloaded(Exception):
+    """Классификация сейчас недоступна: очередь переполнена или воркеры не ответили вовремя"""
+
+
+def photo_key(photos) -> str:
+    """Хэш фото (или всех фото альбома) для кэша результатов"""
+    digest = hashlib.sha1()
+    for photo in photos:
+        digest.update(hashlib.sha1(photo).digest())
+    return digest.hexdigest()
+
+
+class LoadMonitor:
+    """Сигналы нагрузки процесса бота и текущая ступень деградации"""
+
+    def __init__(self, redis_client=None):
+        self.redis_client = redis_client or get_async_redis()
+        self.latencies = deque()  # (момент получения, время ответа воркера в секундах) за окно
+        self.queue_depth = 0
+        self.active_version = DEFAULT_VERSION
+        self.tier = NORMAL
+        self.requests = Counter()  # Исходы запросов: cache, normal, degraded, shed, timeout
+        self._checked_at = 0.0
+
+    def record_latency(self, seconds: float):
+        self.latencies.append((time.monotonic(), seconds))
+
+    def latency_p95(self) -> float:
+        """p95 времени ответа за окно; старые замеры отбрасываются, чтобы ступень могла снизиться"""
+        horizon = time.monotonic() - settings.degradation_window_seconds
+        while self.latencies and self.latencies[0][0] < horizon:
+            self.latencies.popleft()
+        if not self.latencies:
+            return 0.0
+        values = sorted(seconds for _, seconds in self.latencies)
+        return values[min(len(values) - 1, int(len(values) * 0.95))]
+
+    def _tier_for(self, depth: int, latency: float) -> int:
+        if depth >= settings.degradation_queue_hard or latency >= settings.degradation_latency_hard:
+            return SHED
+        if depth >= settings.degradation_queue_soft or latency >= settings.degradation_latency_soft:
+            return DEGRADED
+        return NORMAL
+
+    async def refresh(self):
+        """Длина очереди и активная версия модели из Redis (не чаще degradation_check_interval) и ступень"""
+        now = time.monotonic()
+        if now - self._checked_at >= settings.degradation_check_interval:
+            self._checked_at = now
+            try:
+                pipe = self.redis_client.pipeline(transaction=False)
+                pipe.llen(settings.celery_queue_name)
+                pipe.hget(STATE_KEY, "active")
+                self.queue_depth, active = await pipe.execute()
+                self.active_version = active.decode() if active else DEFAULT_VERSION
+            except Exception as e:
+                logger.warning(f"Не удалось прочитать длину очереди: {str(e)}")
+
+        tier = self._tier_for(self.queue_depth, self.latency_p95())
+        if tier != self.tier:
+            logger.warning(
+                f"Ступень деградации: {TIER_NAMES[self.tier]} -> {TIER_NAMES[tier]} "
+                f"(очередь {self.queue_depth}, p95 {self.latency_p95():.1f} с)"
+            )
+            self.tier = tier
+        return tier
+
+    async def cached_result(self, key: str):
+        """Компактный результат для фото на активной версии модели (None - нет в кэше)"""
+        try:
+            raw = await self.redis_client.get(f"{CACHE_KEY}{self.active_version}:{key}")
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать кэш результатов: {str(e)}")
+            return None
+        return json.loads(raw) if raw is not None else None
+
+    async def cache_result(self, key: str, compact: dict):
+        """Сохраняет результат под версией модели, которая его дала"""
+        try:
+            await self.redis_client.set(
+                f"{CACHE_KEY}{compact['v']}:{key}", json.dumps(compact), ex=settings.result_cache_ttl
+            )
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить результат в кэш: {str(e)}")
+
+    def metrics(self) -> str:
+        """Метрики в текстовом формате Prometheus (GET /metrics)"""
+        lines = [
+            "# HELP mushroom_degradation_tier Ступень деградации: 0 normal, 1 degraded, 2 shed",
+            "# TYPE mushroom_degradation_tier gauge",
+            f"mushroom_degradation_tier {self.tier}",
+            "# HELP mushroom_celery_queue_depth Задач в очереди Celery при последней проверке",
+            "# TYPE mushroom_celery_queue_depth gauge",
+            f"mushroom_celery_queue_depth {self.queue_depth}",
+            "# HELP mushroom_worker_latency_p95_seconds p95 времени ответа воркеров за окно",
+            "# TYPE mushroom_worker_latency_p95_seconds gauge",
+            f"mushroom_worker_latency_p95_seconds {self.latency_p95():.3f}",
+            "# HELP mushroom_classification_requests_total Запросы классификации по исходу",
+            "# TYPE mushroom_classification_requests_total counter",
+        ]
+        for outcome in ("cache", "normal", "degraded", "shed", "timeout"):
+            lines.append(f'mushroom_classification_requests_total{{outcome="{outcome}"}} {self.requests[outcome]}')
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,139 @@
+# Адаптивный инференс ViT: промежуточные классификационные головы и ранний выход
+#
+# После выбранных слоёв энкодера CLS-токен подаётся в лёгкую голову (LayerNorm + Linear).
+# Если её уверенность выше откалиброванного порога, фото выходит из сети, остальные
+# продолжают путь по следующим слоям - число вычислений зависит от сложности фото.
+# Головы и пороги обучаются скриптом python -m training.early_exit и лежат рядом с моделью.
+
+import json
+import logging
+import os
+
+import torch
+from safetensors.torch import load_file, save_file
+from transformers.modeling_outputs import ImageClassifierOutput
+
+logger = logging.getLogger("app.early_exit")
+
+HEADS_FILE = "early_exit.safetensors"
+CONFIG_FILE = "early_exit.json"
+
+
+def encoder_layers(vit):
+    """Слои энкодера ViTModel: encoder.layer в transformers 4.x, layers в 5.x"""
+    if hasattr(vit, "encoder"):
+        return vit.encoder.layer
+    return vit.layers
+
+
+def run_layer(layer, hidden_states):
+    """Прямой проход одного слоя; в transformers 4.x слой возвращает кортеж"""
+    output = layer(hidden_states)
+    return output[0] if isinstance(output, tuple) else output
+
+
+def make_exit_head(model):
+    """Голова раннего выхода, инициализированная финальными LayerNorm и классификатором"""
+    hidden_size = model.config.hidden_size
+    head = torch.nn.Sequential(
+        torch.nn.LayerNorm(hidden_size, eps=model.config.layer_norm_eps),
+        torch.nn.Linear(hidden_size, model.config.num_labels),
+    )
+    head[0].load_state_dict(model.vit.layernorm.state_dict())
+    head[1].load_state_dict(model.classifier.state_dict())
+    return head
+
+
+class EarlyExitViT(torch.nn.Module):
+    """ViTForImageClassification с ранним выходом; совместим по вызову model(pixel_values=...).logits"""
+
+    def __init__(self, model, exit_layers, thresholds=None):
+        super().__init__()
+        self.model = model
+        self.config = model.config
+        self.classifier = model.classifier
+        self.layers = encoder_layers(model.vit)
+        self.exit_heads = torch.nn.ModuleDict({str(layer): make_exit_head(model) for layer in exit_layers})
+        self.thresholds = {str(layer): 1.01 for layer in exit_layers}  # Порог выше 1 - выход отключён
+        self.thresholds.update({str(layer): t for layer, t in (thresholds or {}).items()})
+        self.images_seen = 0  # Счётчики для средней глубины: сколько фото и сколько слоёв на них
+        self.layers_executed = 0
+
+    @classmethod
+    def from_pretrained_heads(cls, model, directory):
+        """Оборачивает модель, если рядом с ней сохранены головы раннего выхода, иначе возвращает None"""
+        config_path = os.path.join(directory, CONFIG_FILE)
+        if not os.path.exists(config_path):
+            return None
+        with open(config_path, encoding="utf-8") as f:
+            config = json.load(f)
+        wrapper = cls(model, config["exit_layers"], config["thresholds"])
+        wrapper.exit_heads.load_state_dict(load_file(os.path.join(directory, HEADS_FILE)))
+        wrapper.to(model.device)
+        wrapper.eval()
+        logger.info(f"Ранний выход включён: слои {config['exit_layers']}, пороги {config['thresholds']}")
+        return wrapper
+
+    def save_heads(self, directory, report=None):
+        save_file(self.exit_heads.state_dict(), os.path.join(directory, HEADS_FILE))
+        config = {
+            "exit_layers": [int(layer) for layer in self.exit_heads],
+            "thresholds": self.thresholds,
+            "report": report or {},
+        }
+        with open(os.path.join(directory, CONFIG_FILE), "w", encoding="utf-8") as f:
+            json.dump(config, f, ensure_ascii=False, indent=4)
+
+    @property
+    def device(self):
+        return self.model.device
+
+    def num_parameters(self):
+        return self.model.num_parameters()
+
+    @property
+    def average_layers(self):
+        return self.layers_executed / max(self.images_seen, 1)
+
+    def cls_features(self, pixel_values):
+        """CLS-токены после каждого слоя с головой и финальное распределение (для калибровки)"""
+        hidden_states = self.model.vit.embeddings(pixel_values)
+        features = {}
+        for i, layer in enumerate(self.layers, 1):
+            hidden_states = run_layer(layer, hidden_states)
+            if str(i) in self.exit_heads:
+                features[str(i)] = hidden_states[:, 0]
+        logits = self.classifier(self.model.vit.layernorm(hidden_states)[:, 0])
+        return features, logits
+
+    def forward(self, pixel_values, use_exits=True):
+        hidden_states = self.model.vit.embeddings(pixel_values)
+        num_images = hidden_states.shape[0]
+        logits = None
+        active = torch.arange(num_images, device=hidden_states.device)
+
+        for i, layer in enumerate(self.layers, 1):
+            hidden_states = run_layer(layer, hidden_states)
+            self.layers_executed += len(active)
+
+            key = str(i)
+            if not use_exits or key not in self.exit_heads or i == len(self.layers):
+                continue
+            exit_logits = self.exit_heads[key](hidden_states[:, 0])
+            if logits is None:
+                logits = exit_logits.new_empty(num_images, exit_logits.shape[-1])
+            confident = torch.softmax(exit_logits, dim=-1).max(dim=-1).values >= self.thresholds[key]
+            if bool(confident.any()):
+                # Уверенные фото выходят, дальше батч продолжает путь без них
+                logits[active[confident]] = exit_logits[confident]
+                hidden_states, active = hidden_states[~confident], active[~confident]
+                if not len(active):
+                    break
+
+        if len(active):
+            final_logits = self.classifier(self.model.vit.layernorm(hidden_states)[:, 0])
+            if logits is None:
+                logits = final_logits.new_empty(num_images, final_logits.shape[-1])
+            logits[active] = final_logits
+        self.images_seen += num_images
+        return ImageClassifierOutput(logits=logits)
@@ -0,0 +1,309 @@
+# Индекс эмбеддингов для поиска визуально похожих эталонных фото
+#
+# Векторы хранятся сегментами vectors-NNNNN.npy (float32, L2-нормированы) и открываются
+# через memmap; каждое пополнение галереи дописывает новый сегмент, старые не пересчитываются.
+#
+# собрать: python -m app.embedding_index build                       (эталонные фото бота)
+#          python -m app.embedding_index build --gallery /path/to/dir  (<латинское название>/<фото>)
+#          python -m app.embedding_index build --ann                   (дополнительно ANN-индекс faiss)
+#          python -m app.embedding_index build --model-version v2      (индекс для версии из реестра)
+
+import argparse
+import fcntl
+import json
+import logging
+import os
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+from PIL import Image
+
+from app.config import settings
+
+logger = logging.getLogger("app.embedding_index")
+
+META_NAME = "meta.json"
+ANN_NAME = "ann.faiss"
+LOCK_NAME = ".lock"
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+
+try:
+    import faiss
+except ImportError:  # ANN-индекс необязателен, точный поиск работает без него
+    faiss = None
+
+
+def version_index_dir(version):
+    """Индекс строится отдельно для каждой версии модели - эмбеддинги разных версий несравнимы"""
+    return os.path.join(settings.embedding_index_dir, version)
+
+
+@contextmanager
+def index_lock(index_dir):
+    """Межпроцессная блокировка директории индекса: пополнять его может только один процесс за раз"""
+    os.makedirs(index_dir, exist_ok=True)
+    with open(os.path.join(index_dir, LOCK_NAME), "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class EmbeddingIndex:
+    """Сегментированный индекс векторов: точный поиск матричным произведением, ANN - опционально"""
+
+    def __init__(self, index_dir=None):
+        self.index_dir = index_dir or settings.embedding_index_dir
+        self.meta = {"dim": None, "embedding_model": None, "segments": []}
+        self.items = []
+        self._segments = []
+        self._ann = None
+        self._lock = threading.Lock()
+
+        meta_path = os.path.join(self.index_dir, META_NAME)
+        if os.path.exists(meta_path):
+            with open(meta_path, encoding="utf-8") as f:
+                self.meta = json.load(f)
+            for segment in self.meta["segments"]:
+                self._open_segment(segment)
+            logger.info(f"Индекс эмбеддингов загружен: {len(self)} векторов, {len(self._segments)} сегментов")
+
+    def __len__(self):
+        return len(self.items)
+
+    @property
+    def paths(self):
+        return {item["path"] for item in self.items}
+
+    def _open_segment(self, segment):
+        # mmap_mode="r": векторы не копируются в память процесса, страницы общие для воркеров
+        vectors = np.load(os.path.join(self.index_dir, segment["vectors"]), mmap_mode="r")
+        with open(os.path.join(self.index_dir, segment["items"]), encoding="utf-8") as f:
+            items = [json.loads(line) for line in f]
+        if len(items) != len(vectors):
+            raise ValueError(f"Сегмент {segment['vectors']} повреждён: {len(vectors)} векторов, {len(items)} записей")
+        self._segments.append(vectors)
+        self.items.extend(items)
+
+    def add(self, vectors, items, embedding_model=None):
+        """Дописывает новый сегмент (N, dim) с метаданными items и атомарно обновляет meta.json.
+
+        Вызывается под index_lock: индекс должен быть открыт уже после взятия блокировки.
+        """
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        if len(vectors) != len(items):
+            raise ValueError("Число векторов и записей не совпадает")
+        if not len(vectors):
+            return
+        if self.meta["dim"] is not None and vectors.shape[1] != self.meta["dim"]:
+            raise ValueError(f"Размерность {vectors.shape[1]} не совпадает с индексом ({self.meta['dim']})")
+        if self.meta["embedding_model"] and embedding_model and embedding_model != self.meta["embedding_model"]:
+            raise ValueError(
+                f"Индекс построен на модели '{self.meta['embedding_model']}', а не '{embedding_model}'"
+            )
+
+        with self._lock:
+            os.makedirs(self.index_dir, exist_ok=True)
+            number = len(self.meta["segments"])
+            segment = {
+                "vectors": f"vectors-{number:05d}.npy",
+                "items": f"items-{number:05d}.jsonl",
+                "count": len(vectors),
+            }
+            np.save(os.path.join(self.index_dir, segment["vectors"]), vectors)
+            with open(os.path.join(self.index_dir, segment["items"]), "w", encoding="utf-8") as f:
+                for item in items:
+                    f.write(json.dumps(item, ensure_ascii=False) + "\n")
+
+            meta = dict(self.meta)
+            meta["dim"] = int(vectors.shape[1])
+            meta["embedding_model"] = self.meta["embedding_model"] or embedding_model
+            meta["segments"] = self.meta["segments"] + [segment]
+            meta_path = os.path.join(self.index_dir, META_NAME)
+            tmp_path = f"{meta_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(meta, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, meta_path)
+
+            self.meta = meta
+            self._open_segment(segment)
+            self._ann = None
+        logger.info(f"В индекс добавлен сегмент {segment['vectors']}: {len(vectors)} векторов")
+
+    def build_ann(self):
+        """Строит HNSW-индекс faiss по всем сегментам и сохраняет его рядом с векторами"""
+        if faiss is None:
+            raise RuntimeError("Для ANN-индекса требуется пакет faiss-cpu")
+        ann = faiss.IndexHNSWFlat(self.meta["dim"], 32, faiss.METRIC_INNER_PRODUCT)
+        for vectors in self._segments:
+            ann.add(np.ascontiguousarray(vectors))
+        faiss.write_index(ann, os.path.join(self.index_dir, ANN_NAME))
+        self._ann = ann
+        logger.info(f"ANN-индекс построен: {ann.ntotal} векторов")
+
+    def _get_ann(self):
+        """ANN-индекс используется только для больших галерей и только если он актуален"""
+        if faiss is None or len(self) < settings.embedding_ann_min_size:
+            return None
+        if self._ann is None:
+            path = os.path.join(self.index_dir, ANN_NAME)
+            if not os.path.exists(path):
+                return None
+            ann = faiss.read_index(path, faiss.IO_FLAG_MMAP)
+            if ann.ntotal != len(self):
+                logger.warning("ANN-индекс устарел, используется точный поиск")
+                return None
+            self._ann = ann
+        return self._ann
+
+    def search(self, queries, k=None):
+        """Ближайшие записи для векторов (dim,) или (Q, dim): списки {**item, id, score}, id - номер в галерее"""
+        k = k or settings.similar_k
+        queries = np.asarray(queries, dtype=np.float32)
+        single = queries.ndim == 1
+        queries = np.atleast_2d(queries)
+        if not len(self):
+            return [] if single else [[] for _ in queries]
+
+        ann = self._get_ann()
+        if ann is not None:
+            scores, ids = ann.search(np.ascontiguousarray(queries), min(k, len(self)))
+        else:
+            scores, ids = self._exact_search(queries, k)
+
+        results = [
+            [{**self.items[i], "id": int(i), "score": round(float(s), 4)}
+             for s, i in zip(row_scores, row_ids) if i >= 0]
+            for row_scores, row_ids in zip(scores, ids)
+        ]
+        return results[0] if single else results
+
+    def _exact_search(self, queries, k):
+        """Косинусная близость = скалярное произведение; top-k по сегментам, затем слияние"""
+        best_scores, best_ids = [], []
+        offset = 0
+        for vectors in self._segments:
+            scores = queries @ vectors.T
+            top = min(k, scores.shape[1])
+            ids = np.argpartition(-scores, top - 1, axis=1)[:, :top]
+            best_scores.append(np.take_along_axis(scores, ids, axis=1))
+            best_ids.append(ids + offset)
+            offset += len(vectors)
+
+        scores = np.concatenate(best_scores, axis=1)
+        ids = np.concatenate(best_ids, axis=1)
+        order = np.argsort(-scores, axis=1)[:, :k]
+        return np.take_along_axis(scores, order, axis=1), np.take_along_axis(ids, order, axis=1)
+
+
+def reference_gallery(catalog=None):
+    """Галерея из эталонных фото бота: (путь, латинское название, русское имя)"""
+    if catalog is None:
+        from app.assets import ReferencePhotoCatalog
+        catalog = ReferencePhotoCatalog()
+    return [(catalog.paths[name], entry["latin"], name) for name, entry in catalog.entries.items()]
+
+
+def directory_gallery(gallery_dir):
+    """Галерея из директории <латинское название>/<фото>"""
+    from app.catalog import get_catalog
+
+    catalog = get_catalog()
+    gallery = []
+    for label in sorted(os.listdir(gallery_dir)):
+        class_dir = os.path.join(gallery_dir, label)
+        if not os.path.isdir(class_dir):
+            continue
+        for filename in sorted(os.listdir(class_dir)):
+            if filename.lower().endswith(IMAGE_EXTENSIONS):
+                entry = catalog.by_latin.get(label)
+                name = (entry.photo_name or entry.russian) if entry else None
+                gallery.append((os.path.join(class_dir, filename), label, name))
+    return gallery
+
+
+def index_gallery(index, classifier, gallery, batch_size=32):
+    """Добавляет в индекс фото галереи, которых в нём ещё нет; возвращает число новых векторов"""
+    known = index.paths
+    pending = [entry for entry in gallery if entry[0] not in known]
+    if not pending:
+        logger.info("Новых фото в галерее нет, индекс актуален")
+        return 0
+
+    vectors, items = [], []
+    for start in range(0, len(pending), batch_size):
+        batch = pending[start:start + batch_size]
+        images = []
+        for path, _, _ in batch:
+            with Image.open(path) as image:
+                images.append(image.convert("RGB"))
+        _, embeddings = classifier.predict_embeddings(images)
+        vectors.append(embeddings.numpy())
+        items.extend({"path": path, "label": label, "name": name} for path, label, name in batch)
+        logger.info(f"Эмбеддинги: {start + len(batch)}/{len(pending)}")
+
+    index.add(np.concatenate(vectors), items, classifier.embedding_model)
+    return len(items)
+
+
+def ensure_index(classifier, gallery=None):
+    """Строит индекс версии по эталонным фото, если его ещё нет (при загрузке модели, не в задачах).
+
+    Процессы пула воркера загружают модель одновременно: строит индекс первый взявший блокировку,
+    остальные открывают уже готовый.
+    """
+    index_dir = version_index_dir(classifier.version)
+    with index_lock(index_dir):
+        index = EmbeddingIndex(index_dir)
+        if not len(index):
+            logger.info(f"Индекс эмбеддингов версии {classifier.version} пуст, строим его по эталонным фото")
+            index_gallery(index, classifier, gallery if gallery is not None else reference_gallery())
+    if len(index) and index.meta["embedding_model"] != classifier.embedding_model:
+        logger.warning(
+            f"Индекс построен на модели '{index.meta['embedding_model']}', "
+            f"классификатор использует '{classifier.embedding_model}' - поиск похожих отключён"
+        )
+    return index
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Индекс эмбеддингов для поиска похожих фото грибов")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build = subparsers.add_parser("build", help="построить или дополнить индекс")
+    build.add_argument("--gallery", default=None, help="директория <класс>/<фото> (по умолчанию эталонные фото)")
+    build.add_argument("--model-version", default=None, help="версия из реестра моделей")
+    build.add_argument("--batch-size", type=int, default=32)
+    build.add_argument("--ann", action="store_true", help="построить ANN-индекс faiss после пополнения")
+
+    search = subparsers.add_parser("search", help="найти похожие фото для изображения")
+    search.add_argument("image")
+    search.add_argument("--model-version", default=None, help="версия из реестра моделей")
+    search.add_argument("-k", type=int, default=None)
+    args = parser.parse_args()
+
+    from app.model_registry import ModelRegistry, DEFAULT_VERSION
+    from app.services import MushroomClassifier
+
+    version = args.model_version or DEFAULT_VERSION
+    model_dir, student_dir = ModelRegistry().model_dirs(version)
+    classifier = MushroomClassifier(model_dir=model_dir, student_dir=student_dir, version=version)
+
+    if args.command == "build":
+        gallery = directory_gallery(args.gallery) if args.gallery else reference_gallery()
+        with index_lock(version_index_dir(version)):
+            index = EmbeddingIndex(version_index_dir(version))
+            added = index_gallery(index, classifier, gallery, args.batch_size)
+            if args.ann:
+                index.build_ann()
+        print(f"Добавлено {added} векторов, всего в индексе {len(index)}")
+    else:
+        index = EmbeddingIndex(version_index_dir(version))
+        _, embedding = classifier.predict(args.image, with_embedding=True)
+        print(json.dumps(index.search(embedding.numpy(), args.k), ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+# Офлайн-оценка классификатора: точность, top-k, полнота по классам и профиль задержек
+#
+# запустить: python -m app.evaluate --data /path/to/labeled_dir --model-dir ./mushrooms_model_VIT
+#            python -m app.evaluate --data ... --backend cascade --student-dir ./mushrooms_model_student
+#            python -m app.evaluate --data ... --quantization dynamic_int8 --output report.json
+#            python -m app.evaluate --data ... --early-exit   (сравнить с прогоном без флага)
+# структура данных: <data>/<латинское название класса>/<фото>
+
+import argparse
+import json
+import logging
+import os
+import time
+from multiprocessing import Pool
+
+import numpy as np
+import torch
+from PIL import Image
+
+from app.early_exit import EarlyExitViT
+from app.services import MushroomClassifier, BACKENDS, QUANTIZATION_MODES
+
+logger = logging.getLogger("app.evaluate")
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+
+
+def collect_samples(data_dir, label2id, limit=None):
+    """Пары (путь, id класса); подпапки с неизвестными модели классами пропускаются"""
+    samples, skipped = [], []
+    for label in sorted(os.listdir(data_dir)):
+        class_dir = os.path.join(data_dir, label)
+        if not os.path.isdir(class_dir):
+            continue
+        if label not in label2id:
+            skipped.append(label)
+            continue
+        for filename in sorted(os.listdir(class_dir)):
+            if filename.lower().endswith(IMAGE_EXTENSIONS):
+                samples.append((os.path.join(class_dir, filename), label2id[label]))
+    if skipped:
+        logger.warning(f"Классы, неизвестные модели, пропущены: {', '.join(skipped)}")
+    if limit:
+        rng = np.random.default_rng(42)
+        samples = [samples[i] for i in sorted(rng.choice(len(samples), min(limit, len(samples)), replace=False))]
+    return samples
+
+
+def _decode(args):
+    """Декодирование в процессе пула; изображение сразу уменьшается до входа модели"""
+    path, label, size = args
+    started = time.perf_counter()
+    try:
+        with Image.open(path) as image:
+            image.draft("RGB", (size, size))
+            image = image.convert("RGB").resize((size, size), Image.BILINEAR)
+            array = np.asarray(image, dtype=np.uint8)
+    except Exception as e:
+        return path, label, None, str(e)
+    return path, label, array, time.perf_counter() - started
+
+
+def _percentiles(values):
+    if not values:
+        return {}
+    values = np.asarray(values) * 1000
+    return {
+        "mean": round(float(values.mean()), 2),
+        "p50": round(float(np.percentile(values, 50)), 2),
+        "p95": round(float(np.percentile(values, 95)), 2),
+        "p99": round(float(np.percentile(values, 99)), 2),
+        "max": round(float(values.max()), 2),
+    }
+
+
+def evaluate(classifier, samples, batch_size=32, workers=None, top_k=(1, 3, 5), with_confusion=False):
+    """Прогоняет выборку через классификатор батчами и считает метрики"""
+    id2label = {int(i): label for i, label in classifier.model.config.id2label.items()}
+    num_classes = len(id2label)
+    size = classifier.processor.size["height"]
+    max_k = max(top_k)
+
+    confusion = np.zeros((num_classes, num_classes), dtype=np.int64)
+    topk_hits = {k: 0 for k in top_k}
+    decode_times, batch_times, per_image_times, errors = [], [], [], []
+
+    def run_batch(images, labels):
+        started = time.perf_counter()
+        probs = classifier.predict_probs(images)
+        elapsed = time.perf_counter() - started
+        batch_times.append(elapsed)
+        per_image_times.append(elapsed / len(images))
+
+        labels = torch.tensor(labels)
+        top = torch.topk(probs, max_k, dim=-1).indices.cpu()
+        for k in top_k:
+            topk_hits[k] += int((top[:, :k] == labels[:, None]).any(dim=-1).sum())
+        np.add.at(confusion, (labels.numpy(), top[:, 0].numpy()), 1)
+
+    started = time.perf_counter()
+    images, labels = [], []
+    with Pool(workers or os.cpu_count()) as pool:
+        jobs = ((path, label, size) for path, label in samples)
+        for path, label, array, info in pool.imap(_decode, jobs, chunksize=8):
+            if array is None:
+                errors.append({"path": path, "error": info})
+                continue
+            decode_times.append(info)
+            images.append(Image.fromarray(array))
+            labels.append(label)
+            if len(images) == batch_size:
+                run_batch(images, labels)
+                images, labels = [], []
+        if images:
+            run_batch(images, labels)
+    wall_time = time.perf_counter() - started
+
+    total = int(confusion.sum())
+    support = confusion.sum(axis=1)
+    recall = np.divide(np.diag(confusion), support, out=np.zeros(num_classes), where=support > 0)
+    present = support > 0
+
+    report = {
+        "backend": classifier.backend,
+        "quantization": classifier.quantization,
+        "device": str(classifier.device),
+        "samples": total,
+        "decode_errors": errors,
+        "accuracy": round(float(np.trace(confusion) / max(total, 1)), 4),
+        "top_k_accuracy": {f"top{k}": round(topk_hits[k] / max(total, 1), 4) for k in top_k},
+        "macro_recall": round(float(recall[present].mean()), 4) if present.any() else 0.0,
+        "per_class": {
+            id2label[i]: {"support": int(support[i]), "recall": round(float(recall[i]), 4)}
+            for i in range(num_classes) if support[i] > 0
+        },
+        "latency_ms": {
+            "decode_per_image": _percentiles(decode_times),
+            "inference_per_batch": _percentiles(batch_times),
+            "inference_per_image": _percentiles(per_image_times),
+        },
+        "throughput_images_per_s": round(total / wall_time, 2) if wall_time else 0.0,
+        "batch_size": batch_size,
+    }
+    if isinstance(classifier.model, EarlyExitViT):
+        num_layers = classifier.model.config.num_hidden_layers
+        report["early_exit"] = {
+            "average_layers": round(classifier.model.average_layers, 2),
+            "num_layers": num_layers,
+            "layer_speedup": round(num_layers / max(classifier.model.average_layers, 1e-9), 2),
+        }
+    if classifier.student is not None:
+        report["cascade_fallback_rate"] = round(classifier.cascade_fallbacks / max(classifier.cascade_calls, 1), 4)
+    if with_confusion:
+        report["confusion_matrix"] = {"labels": [id2label[i] for i in range(num_classes)],
+                                      "matrix": confusion.tolist()}
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн-оценка качества и скорости классификатора грибов")
+    parser.add_argument("--data", required=True, help="директория <класс>/<фото>")
+    parser.add_argument("--backend", choices=BACKENDS, default=None)
+    parser.add_argument("--quantization", choices=QUANTIZATION_MODES, default=None)
+    parser.add_argument("--model-dir", default=None, help="локальная директория ViT-base (иначе Google Диск)")
+    parser.add_argument("--student-dir", default=None, help="локальная директория модели-студента")
+    parser.add_argument("--early-exit", action="store_true", help="ранний выход (нужны головы early_exit.*)")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=None, help="процессы декодирования")
+    parser.add_argument("--limit", type=int, default=None, help="случайная подвыборка заданного размера")
+    parser.add_argument("--confusion", action="store_true", help="добавить матрицу ошибок в отчёт")
+    parser.add_argument("--output", default=None, help="файл отчёта JSON (по умолчанию stdout)")
+    args = parser.parse_args()
+
+    classifier = MushroomClassifier(
+        backend=args.backend,
+        quantization=args.quantization,
+        model_dir=args.model_dir,
+        student_dir=args.student_dir,
+        early_exit=args.early_exit or None
+    )
+    label2id = {label: int(i) for i, label in classifier.model.config.id2label.items()}
+    samples = collect_samples(args.data, label2id, args.limit)
+    logger.info(f"Оценка на {len(samples)} изображениях")
+
+    report = evaluate(classifier, samples, args.batch_size, args.workers, with_confusion=args.confusion)
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+        logger.info(f"Отчёт сохранён в {args.output}")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+# Дешёвая предварительная проверка фото до постановки в очередь классификации
+#
+# Из размеров фото Telegram скачивается наименьший, который ещё не меньше входа модели (224px).
+# Загруженный файл проверяется по заголовку без полного декодирования, число пикселей
+# ограничивается (защита от "бомб распаковки"), однотонные кадры отсекаются по уменьшенной
+# копии. Прохода ViT удостаиваются только пригодные изображения.
+
+import io
+import logging
+
+from PIL import Image, ImageStat
+
+from app.config import settings
+
+logger = logging.getLogger("app.image_filter")
+
+ALLOWED_FORMATS = ("JPEG", "PNG", "WEBP")
+STAT_SIDE = 64  # Размер копии для оценки однотонности
+
+
+class ImageRejected(ValueError):
+    """Изображение непригодно для классификации; текст исключения - причина для пользователя"""
+
+
+def select_photo_size(photo_sizes, min_side: int = None):
+    """Наименьший размер фото Telegram, обе стороны которого не меньше входа модели (иначе наибольший)"""
+    min_side = min_side or settings.image_min_side
+    sizes = sorted(photo_sizes, key=lambda size: size.width * size.height)
+    for size in sizes:
+        if min(size.width, size.height) >= min_side:
+            return size
+    return sizes[-1]
+
+
+def check_photo_size(photo_size):
+    """Проверка по метаданным Telegram, ещё до скачивания"""
+    if min(photo_size.width, photo_size.height) < settings.image_min_side:
+        raise ImageRejected(f"Фото слишком маленькое ({photo_size.width}×{photo_size.height}).")
+    if photo_size.file_size and photo_size.file_size > settings.image_max_bytes:
+        raise ImageRejected("Файл фото слишком большой.")
+
+
+def check_pixels(image):
+    """Ограничение числа пикселей: проверяется по заголовку, до декодирования"""
+    width, height = image.size
+    if width * height > settings.image_max_pixels:
+        raise ImageRejected(f"Изображение слишком большое ({width}×{height}).")
+
+
+def check_image(data: bytes):
+    """Проверка скачанного фото; ImageRejected, если оно не стоит прохода модели"""
+    if len(data) > settings.image_max_bytes:
+        raise ImageRejected("Файл фото слишком большой.")
+    try:
+        image = Image.open(io.BytesIO(data))  # Читается только заголовок
+    except Image.DecompressionBombError:
+        raise ImageRejected("Изображение слишком большое.")
+    except Exception:
+        raise ImageRejected("Файл не похож на изображение.")
+    if image.format not in ALLOWED_FORMATS:
+        raise ImageRejected(f"Неподдерживаемый формат изображения: {image.format}.")
+    check_pixels(image)
+    if min(image.size) < settings.image_min_side:
+        raise ImageRejected(f"Фото слишком маленькое ({image.width}×{image.height}).")
+
+    # Однотонность оцениваем по уменьшенной копии: JPEG сразу декодируется в масштабе до 1/8
+    try:
+        image.draft("L", (STAT_SIDE, STAT_SIDE))
+        thumbnail = image.convert("L")
+        thumbnail.thumbnail((STAT_SIDE, STAT_SIDE))
+    except Exception as e:
+        logger.info(f"Повреждённое изображение: {e}")
+        raise ImageRejected("Файл изображения повреждён.")
+    if ImageStat.Stat(thumbnail).stddev[0] < settings.image_min_stddev:
+        raise ImageRejected("На фото ничего не видно (однотонный кадр).")
@@ -0,0 +1,64 @@
+# Таблица классов: id -> (латинское название, русское название, съедобность)
+#
+# Строится один раз из model.config.id2label и каталога видов (app/catalog.py); постобработка батча
+# индексирует её массивы сразу для всех top-k id, без поиска по словарю для каждого элемента.
+# Через result backend Celery передаётся только компактная форма (id и уверенности, для похожих
+# фото - номер в галерее индекса и близость), названия и пути восстанавливаются на стороне бота.
+
+import numpy as np
+
+from app.catalog import EDIBILITY_MARKERS, EDIBILITY_UNKNOWN, get_catalog
+from app.models import ClassificationResult
+
+
+class LabelTable:
+    """Массивы названий и съедобности, индексируемые id класса модели"""
+
+    def __init__(self, id2label: dict, catalog=None):
+        entries = (catalog or get_catalog()).for_labels(id2label)
+        latin = [id2label[i] for i in range(len(id2label))]
+        self.latin = np.array(latin, dtype=object)
+        self.russian = np.array([e.russian if e else name for e, name in zip(entries, latin)], dtype=object)
+        self.edibility = np.array([e.edibility if e else EDIBILITY_UNKNOWN for e in entries], dtype=object)
+
+    def __len__(self):
+        return len(self.latin)
+
+    def lookup(self, ids):
+        """Названия и съедобность для массива id любой формы одним индексированием"""
+        ids = np.asarray(ids)
+        return self.latin[ids], self.russian[ids], self.edibility[ids]
+
+    def expand(self, compact: dict, gallery: dict = None) -> dict:
+        """Полный результат (схема ClassificationResult) из компактной формы compact_result.
+
+        gallery: номер элемента галереи -> (name, label, path); неизвестные номера пропускаются.
+        """
+        gallery = gallery or {}
+        latin, russian, edibility = self.lookup(compact["ids"])
+        result = {
+            "model_version": compact["v"],
+            "confident": bool(compact["c"]),
+            "class_ids": compact["ids"],
+            "confidences": compact["p"],
+            "latin": latin.tolist(),
+            "russian": russian.tolist(),
+            "edibility": edibility.tolist(),
+            "similar": [
+                dict(zip(("name", "label", "path"), gallery[item_id]), score=score)
+                for item_id, score in compact["s"] if item_id in gallery
+            ],
+        }
+        return ClassificationResult(**result).model_dump()
+
+
+def compact_result(result: dict, similar=()) -> dict:
+    """Компактная форма результата для result backend: версия, флаг, id и уверенности без строк;
+    похожие фото - пары [номер в галерее индекса, близость]"""
+    return {
+        "v": result["model_version"],
+        "c": int(result["confident"]),
+        "ids": result["class_ids"],
+        "p": result["confidences"],
+        "s": [[item["id"], item["score"]] for item in similar],
+    }
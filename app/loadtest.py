@@ -0,0 +1,376 @@
+# Сквозной нагрузочный тест бота: синтетические обновления через обработчики TelegramBot
+#
+# Обновления (фото из mushroom_photo/, inline-запросы, текстовый поиск, нажатия кнопок, выбор
+# inline-результата) подаются в Application.process_update с заданной частотой, ответы бота
+# уходят в заглушку Bot API (app.stub_telegram), Postgres и Redis - локальные контейнеры
+# (или БД в памяти). Частота поднимается ступенями до точки насыщения.
+#
+# запустить: docker-compose up -d db redis celery
+#            python -m app.loadtest --rates 5 10 20 40 --duration 30 [--db memory] [--eager]
+# адреса контейнеров: POSTGRES_HOST=localhost REDIS_HOST=localhost
+# проверка на утечки: python -m app.loadtest --soak 100000 --max-growth-mb 50 (код выхода 1 при превышении)
+
+import argparse
+import asyncio
+import gc
+import glob
+import itertools
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+from telegram import Update
+
+from app.config import settings
+from app.stub_telegram import make_text_update
+
+logger = logging.getLogger("app.loadtest")
+
+DEFAULT_MIX = "photo=0.2,text=0.3,inline=0.3,chosen=0.1,callback=0.1"
+SEARCH_QUERIES = ["лисичка", "мухомор", "опёнок", "белый", "подосиновик", "трутовик", "сморчок", "груздь"]
+CALLBACKS = ["identify", "search", "back_to_start"]
+
+
+class MemoryDataBase:
+    """БД в памяти с интерфейсом DataBase: нагрузка на бота без Postgres"""
+
+    def __init__(self):
+        self.users = {}
+        self.queries = []
+
+    def get_user_by_telegram_id(self, telegram_user_id):
+        return (telegram_user_id,) if telegram_user_id in self.users else None
+
+    def create_user(self, username, telegram_user_id):
+        self.users[telegram_user_id] = username
+        return telegram_user_id
+
+    def save_query(self, user_id, query_type, mushroom_image=None, query_text=None):
+        self.queries.append((user_id, query_type, query_text))
+
+    def save_queries(self, user_id, query_type, mushroom_images):
+        self.queries.extend((user_id, query_type, None) for _ in mushroom_images)
+
+
+def _user(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": "load", "username": f"load_{user_id}"}
+
+
+def make_photo_update(update_id, user_id):
+    """Фото пользователя: файл по file_id отдаёт заглушка (случайное эталонное фото)"""
+    update = make_text_update(update_id, user_id, "")
+    message = update["message"]
+    del message["text"]
+    message["photo"] = [
+        {"file_id": f"load-{update_id}-{size}", "file_unique_id": f"load-{update_id}-{size}",
+         "width": size, "height": size * 3 // 4, "file_size": size * 100}
+        for size in (320, 800, 1280)
+    ]
+    return update
+
+
+def make_inline_update(update_id, user_id, query):
+    return {
+        "update_id": update_id,
+        "inline_query": {"id": str(update_id), "from": _user(user_id), "query": query, "offset": ""},
+    }
+
+
+def make_chosen_update(update_id, user_id, query, result_id="0"):
+    return {
+        "update_id": update_id,
+        "chosen_inline_result": {"result_id": result_id, "from": _user(user_id), "query": query},
+    }
+
+
+def make_callback_update(update_id, user_id, data):
+    message = make_text_update(update_id, user_id, "🍄 Грибной Помощник")["message"]
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id), "from": _user(user_id), "chat_instance": str(user_id),
+            "data": data, "message": message,
+        },
+    }
+
+
+def make_update(kind, update_id, user_id, entries):
+    """Синтетическое обновление заданного вида"""
+    if kind == "photo":
+        return make_photo_update(update_id, user_id)
+    if kind == "text":
+        return make_text_update(update_id, user_id, random.choice(SEARCH_QUERIES))
+    if kind == "inline":
+        query = random.choice(SEARCH_QUERIES)
+        return make_inline_update(update_id, user_id, query[:random.randint(2, len(query))])
+    if kind == "chosen":
+        entry = random.choice(entries)  # id результата - id вида в каталоге
+        return make_chosen_update(update_id, user_id, entry.key[:4], str(entry.id))
+    if kind == "callback":
+        data = random.choice(CALLBACKS + [f"select_{random.choice(entries).id}"])
+        return make_callback_update(update_id, user_id, data)
+    raise ValueError(f"Неизвестный вид обновления: {kind}")
+
+
+def parse_mix(mix):
+    """'photo=0.2,text=0.8' -> (виды, веса)"""
+    pairs = [item.split("=") for item in mix.split(",") if item]
+    return [kind for kind, _ in pairs], [float(weight) for _, weight in pairs]
+
+
+def _percentiles(latencies):
+    latencies = sorted(latencies)
+    if not latencies:
+        return {}
+    percentile = lambda p: latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000
+    return {"p50": round(percentile(0.50), 2), "p95": round(percentile(0.95), 2),
+            "p99": round(percentile(0.99), 2), "max": round(latencies[-1] * 1000, 2)}
+
+
+async def run_step(bot, rate, duration, users, kinds, weights, concurrency, update_ids):
+    """Открытая нагрузка с постоянной частотой: задержка считается от планового момента прихода,
+    поэтому ожидание в очереди при перегрузке входит в хвост распределения"""
+    entries = bot.catalog.searchable
+    semaphore = asyncio.Semaphore(concurrency)  # Как concurrent_updates у настоящего бота
+    latencies = {kind: [] for kind in kinds}
+    errors = {kind: 0 for kind in kinds}
+    failed_updates = bot.loadtest_failed_updates
+
+    async def handle(kind, update, planned):
+        async with semaphore:
+            await bot.app.process_update(update)
+        latencies[kind].append(time.perf_counter() - planned)
+        if update.update_id in failed_updates:
+            failed_updates.discard(update.update_id)
+            errors[kind] += 1
+
+    tasks = []
+    started = time.perf_counter()
+    for i in itertools.count():
+        planned = started + i / rate
+        if planned - started >= duration:
+            break
+        await asyncio.sleep(max(0.0, planned - time.perf_counter()))
+        kind = random.choices(kinds, weights)[0]
+        data = make_update(kind, next(update_ids), random.randint(1, users), entries)
+        tasks.append(asyncio.create_task(handle(kind, Update.de_json(data, bot.app.bot), planned)))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+
+    all_latencies = [value for values in latencies.values() for value in values]
+    return {
+        "offered_rps": rate,
+        "processed": len(all_latencies),
+        "throughput_rps": round(len(all_latencies) / elapsed, 2),
+        "errors": sum(errors.values()),
+        "error_rate": round(sum(errors.values()) / max(1, len(all_latencies)), 4),
+        "latency_ms": _percentiles(all_latencies),
+        "handlers": {
+            kind: {"count": len(values), "errors": errors[kind], "latency_ms": _percentiles(values)}
+            for kind, values in latencies.items() if values
+        },
+    }
+
+
+def _saturated(step, slo_ms, max_error_rate):
+    """Ступень перегружена: пропускная способность отстаёт от частоты, p99 вышел за SLO
+    или доля ответов с ошибкой выше допустимой"""
+    return (
+        step["throughput_rps"] < 0.95 * step["offered_rps"]
+        or step["latency_ms"]["p99"] > slo_ms
+        or step["error_rate"] > max_error_rate
+    )
+
+
+def rss_mb():
+    """Текущий RSS процесса (Linux /proc), на других ОС - пиковый по getrusage"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def open_fds():
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except OSError:
+        return None
+
+
+def _temp_images():
+    return len(glob.glob(os.path.join(tempfile.gettempdir(), "*.jpg")))
+
+
+async def run_soak(bot, args, kinds, weights, update_ids):
+    """Долгий прогон без пауз между обновлениями: после прогрева RSS не должен расти больше порога"""
+    entries = bot.catalog.searchable
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def handle(kind):
+        data = make_update(kind, next(update_ids), random.randint(1, args.users), entries)
+        async with semaphore:
+            await bot.app.process_update(Update.de_json(data, bot.app.bot))
+
+    async def run(count):
+        await asyncio.gather(*(handle(random.choices(kinds, weights)[0]) for _ in range(count)))
+
+    # Прогрев: кэши заполняются до своих потолков, аллокаторы набирают рабочий объём
+    await run(args.soak_warmup)
+    gc.collect()
+    baseline, fds, temp_files = rss_mb(), open_fds(), _temp_images()
+    logger.info(f"Прогрев завершён, RSS {baseline:.1f} МБ")
+
+    samples, done = [], 0
+    chunk = max(1, args.soak // 50)
+    started = time.perf_counter()
+    while done < args.soak:
+        count = min(chunk, args.soak - done)
+        await run(count)
+        done += count
+        samples.append({"requests": done, "rss_mb": round(rss_mb(), 1)})
+        logger.info(f"{done} обновлений, RSS {samples[-1]['rss_mb']} МБ")
+    gc.collect()
+
+    growth = rss_mb() - baseline
+    return {
+        "requests": done,
+        "throughput_rps": round(done / (time.perf_counter() - started), 1),
+        "errors": len(bot.loadtest_failed_updates),
+        "rss_baseline_mb": round(baseline, 1),
+        "rss_growth_mb": round(growth, 1),
+        "max_growth_mb": args.max_growth_mb,
+        "open_fds_growth": None if fds is None else open_fds() - fds,
+        "temp_images_left": _temp_images() - temp_files,  # Временные файлы задач (--eager)
+        "inline_cache_entries": len(bot.inline_cache),
+        "passed": growth <= args.max_growth_mb,
+        "samples": samples,
+    }
+
+
+def start_stub(port):
+    """Заглушка Bot API в отдельном процессе, чтобы она не делила GIL с ботом"""
+    process = subprocess.Popen([sys.executable, "-m", "app.stub_telegram", "serve", "--host", "127.0.0.1",
+                                "--port", str(port)])
+    url = f"http://127.0.0.1:{port}/botload/getMe"
+    for _ in range(100):
+        try:
+            httpx.get(url, timeout=1)
+            return process
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("Заглушка Bot API не запустилась")
+
+
+async def run_load_test(args):
+    from app.DataBase import DataBase
+    from app.telegram_bot import TelegramBot
+
+    if args.eager:
+        # Задачи классификации выполняются в этом же процессе, без отдельного воркера
+        from app.celery_app import celery_app
+        celery_app.conf.task_always_eager = True
+
+    bot = TelegramBot("load", MemoryDataBase() if args.db == "memory" else DataBase())
+    bot.loadtest_failed_updates = set()
+
+    # Ошибки считаются и те, что вылетели из обработчика, и те, что он перехватил сам и ответил "❌"
+    def on_handler_error(update, error):
+        if isinstance(update, Update):
+            bot.loadtest_failed_updates.add(update.update_id)
+
+    async def on_error(update, context):
+        logger.error(f"Ошибка обработчика: {context.error}")
+        on_handler_error(update, context.error)
+
+    bot.on_handler_error = on_handler_error
+    bot.app.add_error_handler(on_error)
+    await bot.app.initialize()
+
+    kinds, weights = parse_mix(args.mix)
+    update_ids = itertools.count(1)
+    if args.soak:
+        try:
+            return {"mix": dict(zip(kinds, weights)), **await run_soak(bot, args, kinds, weights, update_ids)}
+        finally:
+            await bot.app.shutdown()
+
+    steps, saturation_rps = [], None
+    try:
+        for rate in args.rates:
+            step = await run_step(bot, rate, args.duration, args.users, kinds, weights, args.concurrency, update_ids)
+            steps.append(step)
+            logger.info(
+                f"{rate} обн/с: {step['throughput_rps']} обн/с, p99 {step['latency_ms'].get('p99')} мс, "
+                f"ошибок {step['errors']}"
+            )
+            if _saturated(step, args.slo_ms, args.max_error_rate):
+                break
+            saturation_rps = rate
+    finally:
+        await bot.app.shutdown()
+
+    return {
+        "mix": dict(zip(kinds, weights)),
+        "concurrency": args.concurrency,
+        "slo_p99_ms": args.slo_ms,
+        "max_error_rate": args.max_error_rate,
+        "max_sustained_rps": saturation_rps,  # Последняя ступень без насыщения
+        "steps": steps,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сквозной нагрузочный тест бота с заглушкой Bot API")
+    parser.add_argument("--rates", type=float, nargs="+", default=[5, 10, 20, 40, 80], help="ступени, обн/с")
+    parser.add_argument("--duration", type=float, default=30, help="длительность ступени, сек")
+    parser.add_argument("--users", type=int, default=1000, help="число синтетических пользователей")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="доли видов обновлений")
+    parser.add_argument("--concurrency", type=int, default=settings.telegram_concurrent_updates)
+    parser.add_argument("--slo-ms", type=float, default=5000, help="допустимый p99, мс")
+    parser.add_argument("--max-error-rate", type=float, default=0.01, help="допустимая доля ответов с ошибкой")
+    parser.add_argument("--db", choices=("postgres", "memory"), default="postgres")
+    parser.add_argument("--eager", action="store_true", help="классифицировать в процессе теста, без воркера")
+    parser.add_argument("--stub-port", type=int, default=8081)
+    parser.add_argument("--stub-url", default=None, help="уже запущенная заглушка, например http://localhost:8081")
+    parser.add_argument("--output", default=None, help="сохранить отчёт в JSON")
+    parser.add_argument("--soak", type=int, default=0, help="режим проверки утечек: столько обновлений подряд")
+    parser.add_argument("--soak-warmup", type=int, default=2000, help="обновлений до замера исходного RSS")
+    parser.add_argument("--max-growth-mb", type=float, default=50, help="допустимый рост RSS за прогон")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    stub = None
+    if args.stub_url is None:
+        stub = start_stub(args.stub_port)
+        args.stub_url = f"http://127.0.0.1:{args.stub_port}"
+    settings.telegram_api_base_url = f"{args.stub_url}/bot"
+    settings.telegram_api_base_file_url = f"{args.stub_url}/file/bot"
+
+    try:
+        report = asyncio.run(run_load_test(args))
+    finally:
+        if stub is not None:
+            stub.terminate()
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    print(text)
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    if args.soak and not report["passed"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -14,13 +14,23 @@
 # логи БД: docker logs mushroom-classification-db-1
 
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import FileResponse, PlainTextResponse
 from app.config import logger
 import asyncio
+import os
+import re
+import time
+import uuid
 from app.telegram_bot import TelegramBot
-from app.services import MushroomClassifier
 from app.config import settings
 from app.DataBase import DataBase  # Импортируем DataBase для добавления пользователя
+from app.bulk import JobProgress, OUTPUT_FORMATS, PROGRESS_NAME
+from app.models import BulkJobRequest
+from app.tasks import run_bulk_classification
+from app.celery_app import celery_app
+from app.profiling import PROFILE_KINDS, profile_path, start_capture
+import secrets
 
 app = FastAPI(
     title="Mushroom Classification API",
@@ -29,6 +39,7 @@ app = FastAPI(
 )
 
 db = DataBase()  # Создаём объект для работы с БД
+bot = None  # Экземпляр TelegramBot, создаётся при старте
 
 def read_token_from_file():
     try:
@@ -43,6 +54,7 @@ def read_token_from_file():
 
 @app.on_event("startup")
 async def startup_event():
+    global bot
     logger.info("Запуск сервера и бота...")
 
     # Добавляем задержку перед подключением к БД
@@ -50,10 +62,186 @@ async def startup_event():
 
     # Инициализируем бота с передачей объекта базы данных
     token = read_token_from_file()
-    classifier = MushroomClassifier()  # Создаём экземпляр классификатора
-    bot = TelegramBot(token, classifier, db)  # Передаем db и классификатор в конструктор бота
+    bot = TelegramBot(token, db)  # Передаем объект базы данных в конструктор бота
 
     # Запускаем бота в фоновом режиме
     asyncio.create_task(bot.run())
 
     logger.info("Сервер и бот успешно запущены")
+
+
+@app.post(settings.telegram_webhook_path)
+async def telegram_webhook(request: Request):
+    """Приём обновлений Telegram в режиме webhook"""
+    if settings.telegram_webhook_secret and not secrets.compare_digest(
+            request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), settings.telegram_webhook_secret):
+        raise HTTPException(status_code=403, detail="Неверный секрет webhook")
+    if bot is None:
+        raise HTTPException(status_code=503, detail="Бот ещё не запущен")
+
+    data = await request.json()
+    if not await bot.process_webhook_update(data):
+        # Telegram повторит доставку, а балансировщик отдаст её менее загруженной реплике
+        raise HTTPException(status_code=503, detail="Очередь обновлений переполнена")
+    return {"ok": True}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Ступень деградации и сигналы нагрузки бота в формате Prometheus"""
+    if bot is None:
+        raise HTTPException(status_code=503, detail="Бот ещё не запущен")
+    await bot.load_monitor.refresh()
+    return bot.load_monitor.metrics()
+
+
+def _require_admin(request: Request):
+    """Служебные эндпоинты доступны только с X-Admin-Token; без ADMIN_TOKEN они отключены"""
+    if not settings.admin_token:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not secrets.compare_digest(request.headers.get("X-Admin-Token", ""), settings.admin_token):
+        raise HTTPException(status_code=403, detail="Неверный токен администратора")
+
+
+def _job_dir(job_id: str) -> str:
+    """Директория задания; id проверяется, чтобы нельзя было выйти за пределы bulk_jobs_dir"""
+    if not re.fullmatch(r"[0-9a-f]{32}", job_id):
+        raise HTTPException(status_code=404, detail="Задание не найдено")
+    job_dir = os.path.join(settings.bulk_jobs_dir, job_id)
+    if not os.path.exists(os.path.join(job_dir, PROGRESS_NAME)):
+        raise HTTPException(status_code=404, detail="Задание не найдено")
+    return job_dir
+
+
+def _submit_bulk_job(source: str, output_format: str):
+    if output_format not in OUTPUT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Формат должен быть одним из: {', '.join(OUTPUT_FORMATS)}")
+    job_id = uuid.uuid4().hex
+    job_dir = os.path.join(settings.bulk_jobs_dir, job_id)
+    progress = JobProgress.load_or_create(job_dir, source, output_format)
+    task_id = uuid.uuid4().hex
+    # Аренда выдаётся задаче ещё в очереди: resume не поставит второй запуск, пока она ждёт воркера
+    progress.save(lease_owner=task_id, lease_until=time.time() + settings.bulk_queue_lease_seconds)
+    run_bulk_classification.apply_async(args=[source, job_dir, output_format], task_id=task_id)
+    logger.info(f"Пакетное задание {job_id} поставлено в очередь: {source}")
+    return {"job_id": job_id, "status": progress.data["status"]}
+
+
+def _bulk_source(source: str) -> str:
+    """Источник задания: только внутри bulk_jobs_dir (после разрешения символических ссылок)"""
+    root = os.path.realpath(settings.bulk_jobs_dir)
+    path = os.path.realpath(source)
+    if os.path.commonpath([root, path]) != root:
+        raise HTTPException(status_code=400, detail="Источник должен находиться в каталоге пакетных заданий")
+    if not os.path.exists(path):
+        raise HTTPException(status_code=400, detail="Источник не найден")
+    return path
+
+
+@app.post("/bulk/jobs")
+async def create_bulk_job(request: Request, job: BulkJobRequest):
+    """Пакетное задание по директории или архиву, уже лежащему в каталоге пакетных заданий"""
+    _require_admin(request)
+    return _submit_bulk_job(_bulk_source(job.source), job.format)
+
+
+@app.post("/bulk/jobs/upload")
+async def upload_bulk_job(request: Request, filename: str, format: str = "csv"):
+    """Пакетное задание по загруженному архиву (тело запроса - .zip или .tar(.gz), пишется на диск потоком)"""
+    _require_admin(request)
+    if not filename.lower().endswith((".zip", ".tar", ".tar.gz", ".tgz")):
+        raise HTTPException(status_code=400, detail="Ожидается архив .zip или .tar(.gz)")
+    too_large = HTTPException(status_code=413, detail="Архив больше допустимого размера")
+    if int(request.headers.get("Content-Length") or 0) > settings.bulk_upload_max_bytes:
+        raise too_large
+    upload_dir = os.path.join(settings.bulk_jobs_dir, "uploads")
+    os.makedirs(upload_dir, exist_ok=True)
+    path = os.path.join(upload_dir, f"{uuid.uuid4().hex}-{os.path.basename(filename)}")
+    written = 0
+    try:
+        with open(path, "wb") as f:
+            async for chunk in request.stream():
+                written += len(chunk)
+                if written > settings.bulk_upload_max_bytes:  # Content-Length может отсутствовать или лгать
+                    raise too_large
+                f.write(chunk)
+    except BaseException:
+        os.remove(path)  # Недокачанный архив не должен занимать диск
+        raise
+    return _submit_bulk_job(path, format)
+
+
+@app.get("/bulk/jobs/{job_id}")
+async def get_bulk_job(request: Request, job_id: str):
+    _require_admin(request)
+    return JobProgress.load(_job_dir(job_id)).data
+
+
+@app.post("/bulk/jobs/{job_id}/resume")
+async def resume_bulk_job(request: Request, job_id: str):
+    """Повторный запуск прерванного задания: обработка продолжится с сохранённого прогресса"""
+    _require_admin(request)
+    job_dir = _job_dir(job_id)
+    progress = JobProgress.load(job_dir)
+    if progress.data["status"] == "done":
+        raise HTTPException(status_code=409, detail="Задание уже завершено")
+    task_id = uuid.uuid4().hex
+    if not progress.claim(task_id, settings.bulk_queue_lease_seconds):
+        raise HTTPException(status_code=409, detail="Задание уже выполняется или ждёт в очереди")
+    run_bulk_classification.apply_async(
+        args=[progress.data["source"], job_dir, progress.data["format"]], task_id=task_id
+    )
+    return {"job_id": job_id, "status": progress.data["status"]}
+
+
+@app.get("/bulk/jobs/{job_id}/results")
+async def get_bulk_job_results(request: Request, job_id: str):
+    """CSV с результатами (в том числе частичными); для Parquet - список готовых частей"""
+    _require_admin(request)
+    job_dir = _job_dir(job_id)
+    progress = JobProgress.load(job_dir)
+    if progress.data["format"] == "csv":
+        path = os.path.join(job_dir, "results.csv")
+        if not os.path.exists(path):
+            raise HTTPException(status_code=404, detail="Результаты ещё не готовы")
+        return FileResponse(path, media_type="text/csv", filename=f"{job_id}.csv")
+    return {"parts": sorted(f for f in os.listdir(job_dir) if f.startswith("part-") and f.endswith(".parquet"))}
+
+
+@app.post("/admin/profile")
+async def create_profile(request: Request, kind: str = "cpu", seconds: float = 10.0, target: str = "app"):
+    """Профиль на заданное время: target=app - этот процесс (API и бот), worker - воркеры Celery"""
+    _require_admin(request)
+    if kind not in PROFILE_KINDS:
+        raise HTTPException(status_code=400, detail=f"Вид профиля должен быть одним из: {', '.join(PROFILE_KINDS)}")
+    if target == "worker" or kind == "torch":  # Модель загружена только в воркерах
+        replies = await asyncio.to_thread(
+            celery_app.control.broadcast, "profile", arguments={"kind": kind, "seconds": seconds},
+            reply=True, timeout=2.0,
+        )
+        return {"target": "worker", "replies": replies}
+    if target != "app":
+        raise HTTPException(status_code=400, detail="target должен быть app или worker")
+    path = profile_path(kind, "app")
+    if not start_capture(kind, seconds, path):
+        raise HTTPException(status_code=409, detail="Профиль уже снимается")
+    return {"target": "app", "file": os.path.basename(path), "seconds": min(seconds, settings.profile_max_seconds)}
+
+
+@app.get("/admin/profiles")
+async def list_profiles(request: Request):
+    """Готовые файлы профилей, новые первыми"""
+    _require_admin(request)
+    if not os.path.isdir(settings.profile_dir):
+        return {"files": []}
+    return {"files": sorted(os.listdir(settings.profile_dir), reverse=True)}
+
+
+@app.get("/admin/profiles/{name}")
+async def get_profile(request: Request, name: str):
+    """Скачивание файла профиля по имени из списка"""
+    _require_admin(request)
+    path = os.path.join(settings.profile_dir, os.path.basename(name))
+    if not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail="Профиль не найден")
+    return FileResponse(path, filename=os.path.basename(path))
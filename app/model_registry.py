@@ -0,0 +1,333 @@
+# Реестр версий модели и горячая замена в воркерах без перезапуска
+#
+# Файлы версий лежат в MODEL_REGISTRY_DIR/<версия>/ (save_pretrained, студент - в подпапке student/),
+# активная версия и канарейка хранятся в Redis и читаются воркерами между задачами.
+#
+# python -m app.model_registry register v2 --model-dir ./mushrooms_model_VIT [--student-dir ./mushrooms_model_student]
+# python -m app.model_registry canary v2 --percent 10
+# python -m app.model_registry promote v2
+# python -m app.model_registry status
+
+import argparse
+import json
+import logging
+import math
+import os
+import random
+import shutil
+import threading
+import time
+
+from PIL import Image
+
+from app.config import settings
+from app.redis_client import get_redis
+
+logger = logging.getLogger("app.model_registry")
+
+DEFAULT_VERSION = "default"  # Модель из настроек (MODEL_DIR или Google Диск), если реестр пуст
+STATE_KEY = "model_registry:state"
+LABELS_KEY = "model_registry:labels:"  # + версия: порядок классов модели для восстановления результатов
+GALLERY_KEY = "model_registry:gallery:"  # + версия: хэш номер в галерее индекса -> [name, label, path]
+REQUIRED_FILES = ("config.json", "model.safetensors", "preprocessor_config.json")
+
+
+class ModelRegistry:
+    """Версии модели в локальной директории и их статус (active/canary) в Redis"""
+
+    def __init__(self, registry_dir=None, redis_client=None):
+        self.registry_dir = registry_dir or settings.model_registry_dir
+        self.redis_client = redis_client or get_redis()
+
+    def version_dir(self, version):
+        return os.path.join(self.registry_dir, version)
+
+    def versions(self):
+        """Зарегистрированные версии (директории с полным набором файлов модели)"""
+        if not os.path.isdir(self.registry_dir):
+            return []
+        return sorted(
+            name for name in os.listdir(self.registry_dir)
+            if all(os.path.exists(os.path.join(self.registry_dir, name, f)) for f in REQUIRED_FILES)
+        )
+
+    def model_dirs(self, version):
+        """(model_dir, student_dir) версии; для версии по умолчанию - из настроек"""
+        if version == DEFAULT_VERSION:
+            return None, None
+        directory = self.version_dir(version)
+        if not os.path.exists(os.path.join(directory, "config.json")):
+            raise FileNotFoundError(f"Версия модели {version} не найдена в {self.registry_dir}")
+        student_dir = os.path.join(directory, "student")
+        return directory, student_dir if os.path.isdir(student_dir) else None
+
+    def register(self, version, model_dir, student_dir=None):
+        """Копирует файлы модели в реестр; версия становится видимой только после полной записи"""
+        if version == DEFAULT_VERSION or os.sep in version:
+            raise ValueError(f"Недопустимое имя версии: {version}")
+        target = self.version_dir(version)
+        if os.path.exists(target):
+            raise FileExistsError(f"Версия {version} уже зарегистрирована")
+
+        tmp_target = f"{target}.tmp"
+        shutil.rmtree(tmp_target, ignore_errors=True)
+        shutil.copytree(model_dir, tmp_target)
+        if student_dir:
+            shutil.copytree(student_dir, os.path.join(tmp_target, "student"))
+        with open(os.path.join(tmp_target, "registry.json"), "w", encoding="utf-8") as f:
+            json.dump({"version": version, "source": model_dir, "student_source": student_dir,
+                       "registered_at": time.time()}, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_target, target)
+        logger.info(f"Версия модели {version} зарегистрирована в {target}")
+
+    def get_state(self):
+        """Текущее состояние: активная версия, версия-канарейка и её доля трафика (%)"""
+        active, canary, percent = self.redis_client.hmget(STATE_KEY, "active", "canary", "canary_percent")
+        return {
+            "active": active.decode() if active else DEFAULT_VERSION,
+            "canary": canary.decode() if canary else None,
+            "canary_percent": float(percent) if percent else settings.model_canary_percent,
+        }
+
+    def publish_labels(self, version, id2label):
+        """Публикует порядок классов версии: бот восстанавливает по нему названия из id"""
+        labels = [id2label[i] for i in range(len(id2label))]
+        self.redis_client.set(LABELS_KEY + version, json.dumps(labels))
+
+    def get_labels(self, version):
+        """id2label версии, опубликованный воркером при её загрузке"""
+        raw = self.redis_client.get(LABELS_KEY + version)
+        if raw is None:
+            raise RuntimeError(f"Порядок классов версии {version} не опубликован")
+        return dict(enumerate(json.loads(raw)))
+
+    def publish_gallery(self, version, items):
+        """Публикует галерею индекса похожих фото версии: в результатах задач только номера элементов"""
+        pipe = self.redis_client.pipeline(transaction=False)
+        for start in range(0, len(items), 1000):  # Большие галереи - порциями, без одной огромной команды
+            pipe.hset(GALLERY_KEY + version, mapping={
+                start + i: json.dumps([item["name"], item["label"], item["path"]], ensure_ascii=False)
+                for i, item in enumerate(items[start:start + 1000])
+            })
+        pipe.execute()
+
+    def get_gallery_items(self, version, ids):
+        """{номер: (name, label, path)} для номеров галереи версии; неопубликованные номера пропускаются"""
+        ids = list(ids)
+        if not ids:
+            return {}
+        raw = self.redis_client.hmget(GALLERY_KEY + version, ids)
+        return {i: tuple(json.loads(value)) for i, value in zip(ids, raw) if value is not None}
+
+    def _check_version(self, version):
+        if version != DEFAULT_VERSION and version not in self.versions():
+            raise ValueError(f"Версия {version} не зарегистрирована")
+
+    def promote(self, version):
+        """Делает версию активной и снимает канарейку"""
+        self._check_version(version)
+        pipe = self.redis_client.pipeline()
+        pipe.hset(STATE_KEY, "active", version)
+        pipe.hdel(STATE_KEY, "canary", "canary_percent")
+        pipe.execute()
+        logger.info(f"Активная версия модели: {version}")
+
+    def set_canary(self, version, percent):
+        """Направляет percent% запросов на версию-канарейку"""
+        self._check_version(version)
+        if not 0 <= percent <= 100:
+            raise ValueError("Доля канарейки должна быть в диапазоне 0-100")
+        self.redis_client.hset(STATE_KEY, mapping={"canary": version, "canary_percent": percent})
+        logger.info(f"Канарейка: {version} ({percent}% трафика)")
+
+    def clear_canary(self):
+        self.redis_client.hdel(STATE_KEY, "canary", "canary_percent")
+
+
+def reference_images(photo_dir=None, limit=None):
+    """Первые эталонные фото в RGB - вход проверочного прогона и профилирования модели"""
+    photo_dir = photo_dir or settings.reference_photo_dir
+    limit = limit or settings.model_smoke_images
+    filenames = sorted(f for f in os.listdir(photo_dir) if f.lower().endswith(".jpg"))[:limit]
+    if not filenames:
+        raise RuntimeError(f"Нет эталонных фото в {photo_dir}")
+
+    images = []
+    for filename in filenames:
+        with Image.open(os.path.join(photo_dir, filename)) as image:
+            images.append(image.convert("RGB"))
+    return images
+
+
+def smoke_test(classifier, photo_dir=None, limit=None):
+    """Проверочный прогон на эталонных фото: форма выхода, конечность и нормировка вероятностей"""
+    images = reference_images(photo_dir, limit)
+
+    started = time.perf_counter()
+    probs = classifier.predict_probs(images)
+    elapsed = time.perf_counter() - started
+
+    num_labels = len(classifier.model.config.id2label)
+    if tuple(probs.shape) != (len(images), num_labels):
+        raise RuntimeError(f"Неожиданная форма выхода модели: {tuple(probs.shape)}")
+    sums = probs.sum(dim=-1)
+    if not bool(probs.isfinite().all()) or not all(math.isclose(float(s), 1.0, abs_tol=1e-3) for s in sums):
+        raise RuntimeError("Модель вернула некорректные вероятности")
+    unknown = set(classifier.model.config.id2label.values()) - set(settings.mushroom_descriptions)
+    if unknown:
+        logger.warning(f"Для {len(unknown)} классов модели нет описаний: {', '.join(sorted(unknown)[:5])}")
+    logger.info(f"Проверка модели пройдена: {len(images)} фото за {elapsed * 1000:.0f} мс")
+
+
+class ModelManager:
+    """Классификаторы процесса воркера: активная версия и канарейка, фоновая подгрузка и атомарная замена"""
+
+    def __init__(self, registry=None, check_interval=None):
+        self.registry = registry or ModelRegistry()
+        self.check_interval = check_interval if check_interval is not None else settings.model_registry_check_interval
+        self._models = {}  # версия -> MushroomClassifier; заменяется целиком, а не изменяется
+        self._state = None
+        self._checked_at = 0.0
+        self._loading = set()
+        self._failed = {}  # версия -> момент неудачной загрузки; повтор через model_load_retry_seconds
+        self._lock = threading.Lock()
+
+    def _load(self, version):
+        from app.services import MushroomClassifier
+
+        model_dir, student_dir = self.registry.model_dirs(version)
+        classifier = MushroomClassifier(model_dir=model_dir, student_dir=student_dir, version=version)
+        smoke_test(classifier)
+        self.registry.publish_labels(version, classifier.model.config.id2label)
+        self._prepare_index(classifier)
+        return classifier
+
+    def _prepare_index(self, classifier):
+        """Индекс похожих фото строится вместе с загрузкой версии, а не в первой задаче пользователя"""
+        if not settings.similar_k or not settings.embedding_index_autobuild:
+            return
+        from app.embedding_index import ensure_index
+
+        try:
+            ensure_index(classifier)
+        except Exception as e:
+            # Модель остаётся рабочей: задачи отвечают без похожих фото, пока индекс не появится
+            logger.error(f"Не удалось построить индекс эмбеддингов версии {classifier.version}: {str(e)}", exc_info=True)
+
+    def _install(self, version, classifier):
+        """Атомарная замена набора моделей: задачи, уже получившие классификатор, дорабатывают на нём"""
+        with self._lock:
+            wanted = {self._state["active"], self._state["canary"]} if self._state else {version}
+            models = {v: c for v, c in self._models.items() if v in wanted}
+            models[version] = classifier
+            self._models = models
+            self._loading.discard(version)
+            self._failed.pop(version, None)
+        logger.info(f"Версия модели {version} загружена и готова к работе")
+
+    def _preload(self, version):
+        try:
+            classifier = self._load(version)
+        except Exception as e:
+            logger.error(f"Версия модели {version} не прошла загрузку или проверку: {str(e)}", exc_info=True)
+            with self._lock:
+                self._loading.discard(version)
+                self._failed[version] = time.monotonic()
+            return
+        self._install(version, classifier)
+
+    def refresh(self, force=False):
+        """Читает состояние реестра (не чаще check_interval) и подгружает новые версии в фоне"""
+        now = time.monotonic()
+        if not force and now - self._checked_at < self.check_interval:
+            return
+        self._checked_at = now
+        try:
+            state = self.registry.get_state()
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать состояние реестра моделей: {str(e)}")
+            if self._state is not None:
+                return
+            state = {"active": DEFAULT_VERSION, "canary": None, "canary_percent": 0}
+        self._state = state
+
+        wanted = [version for version in (state["active"], state["canary"]) if version is not None]
+        if all(version in self._models for version in wanted) and len(self._models) > len(wanted):
+            # Все нужные версии готовы - освобождаем память от снятых с работы
+            with self._lock:
+                self._models = {version: self._models[version] for version in wanted}
+
+        for version in wanted:
+            if version in self._models:
+                continue
+            failed_at = self._failed.get(version)
+            if failed_at is not None and now - failed_at < settings.model_load_retry_seconds:
+                continue
+            with self._lock:
+                if version in self._loading:
+                    continue
+                self._loading.add(version)
+            # Первую модель процесса загружаем синхронно, следующие - в фоне между задачами
+            if not self._models:
+                self._preload(version)
+            else:
+                logger.info(f"Фоновая подгрузка версии модели {version}")
+                threading.Thread(target=self._preload, args=(version,), daemon=True).start()
+
+    def versions(self):
+        """Версии, загруженные в процесс сейчас"""
+        return set(self._models)
+
+    def get(self):
+        """(версия, классификатор) для очередной задачи с учётом доли канарейки"""
+        self.refresh()
+        models = self._models
+        if not models:
+            raise RuntimeError("Нет ни одной загруженной версии модели")
+
+        state = self._state
+        canary = state["canary"]
+        if canary in models and random.random() * 100 < state["canary_percent"]:
+            return canary, models[canary]
+        if state["active"] in models:
+            return state["active"], models[state["active"]]
+        # Новая активная версия ещё загружается - продолжаем работать на прежней
+        version = next((v for v in models if v != canary), next(iter(models)))
+        return version, models[version]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Реестр версий модели классификации грибов")
+    parser.add_argument("--registry-dir", default=None)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    register = subparsers.add_parser("register", help="добавить версию в реестр")
+    register.add_argument("version")
+    register.add_argument("--model-dir", required=True)
+    register.add_argument("--student-dir", default=None)
+
+    canary = subparsers.add_parser("canary", help="направить часть трафика на версию")
+    canary.add_argument("version")
+    canary.add_argument("--percent", type=float, default=settings.model_canary_percent)
+
+    promote = subparsers.add_parser("promote", help="сделать версию активной")
+    promote.add_argument("version")
+
+    subparsers.add_parser("rollback", help="снять канарейку")
+    subparsers.add_parser("status", help="версии и текущее состояние")
+    args = parser.parse_args()
+
+    registry = ModelRegistry(args.registry_dir)
+    if args.command == "register":
+        registry.register(args.version, args.model_dir, args.student_dir)
+    elif args.command == "canary":
+        registry.set_canary(args.version, args.percent)
+    elif args.command == "promote":
+        registry.promote(args.version)
+    elif args.command == "rollback":
+        registry.clear_canary()
+    print(json.dumps({"versions": registry.versions(), **registry.get_state()}, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,30 @@
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
 
 class PredictionResult(BaseModel):
     class_name: str
     confidence: float
 
 class TopPredictions(BaseModel):
-    predictions: List[PredictionResult]
\ No newline at end of file
+    predictions: List[PredictionResult]
+
+class SimilarPhoto(BaseModel):
+    name: Optional[str]
+    label: Optional[str]
+    path: Optional[str] = None  # У видов без эталонного фото пути нет
+    score: float
+
+class ClassificationResult(BaseModel):
+    """Фиксированная схема результата, который бот восстанавливает из компактной формы: параллельные списки top-k"""
+    model_version: str
+    confident: bool  # Уверенность первого класса не ниже min_confidence_threshold
+    class_ids: List[int]
+    confidences: List[float]  # В процентах
+    latin: List[str]
+    russian: List[str]
+    edibility: List[str]
+    similar: List[SimilarPhoto] = []
+
+class BulkJobRequest(BaseModel):
+    source: str  # Директория, tar или zip, доступные серверу и воркерам
+    format: str = "csv"
\ No newline at end of file
@@ -0,0 +1,174 @@
+# Профилирование работающих процессов по запросу администратора
+#
+# cpu    - семплирующий профиль стеков всех потоков (формат folded: flamegraph.pl, speedscope)
+# memory - разница снимков tracemalloc за интервал: где выделялась память и сколько
+# torch  - трасса операторов torch.profiler для прямого прохода (chrome://tracing, Perfetto)
+#
+# Захват ограничен по времени и идёт в фоновом потоке, файлы пишутся в PROFILE_DIR.
+# Запуск: POST /admin/profile (приложение и бот) или celery control profile (воркеры).
+# Монитор задержки цикла событий пишет в лог стек обработчика, заблокировавшего цикл.
+
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+from collections import Counter
+
+from app.config import settings
+
+logger = logging.getLogger("app.profiling")
+
+PROFILE_KINDS = ("cpu", "memory", "torch")
+EXTENSIONS = {"cpu": "folded", "memory": "txt", "torch": "json"}
+
+_capture_lock = threading.Lock()  # Один захват на процесс: профили не должны мешать друг другу
+
+
+def profile_path(kind: str, label: str) -> str:
+    """Путь файла профиля: время, процесс и вид в имени, чтобы файлы разных реплик не пересекались"""
+    os.makedirs(settings.profile_dir, exist_ok=True)
+    name = f"{time.strftime('%Y%m%d-%H%M%S')}-{label}-{os.getpid()}-{kind}.{EXTENSIONS[kind]}"
+    return os.path.join(settings.profile_dir, name)
+
+
+def _clamp_seconds(seconds):
+    return max(0.1, min(float(seconds), settings.profile_max_seconds))
+
+
+def _frame_stack(frame):
+    """Стек от корня к листу в виде 'файл:функция'"""
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return stack[::-1]
+
+
+def capture_cpu(seconds, path, interval=None):
+    """Семплирование стеков всех потоков процесса через sys._current_frames (без внешних зависимостей)"""
+    interval = interval or settings.profile_sample_interval
+    own_id = threading.get_ident()
+    samples = Counter()
+    deadline = time.monotonic() + _clamp_seconds(seconds)
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id != own_id:
+                samples[";".join([names.get(thread_id, str(thread_id))] + _frame_stack(frame))] += 1
+        time.sleep(interval)
+
+    with open(path, "w", encoding="utf-8") as f:
+        for stack, count in samples.most_common():
+            f.write(f"{stack} {count}\n")
+    return path
+
+
+def capture_memory(seconds, path, limit=50):
+    """Разница снимков tracemalloc за интервал: рост по местам выделения с трассировкой"""
+    started_here = not tracemalloc.is_tracing()
+    if started_here:
+        tracemalloc.start(settings.profile_tracemalloc_frames)
+    try:
+        before = tracemalloc.take_snapshot()
+        time.sleep(_clamp_seconds(seconds))
+        after = tracemalloc.take_snapshot()
+    finally:
+        if started_here:
+            tracemalloc.stop()
+
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    diff = after.filter_traces(filters).compare_to(before.filter_traces(filters), "traceback")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(f"Рост памяти за {seconds} с, первые {limit} мест выделения\n\n")
+        for stat in diff[:limit]:
+            f.write(f"{stat.size_diff / 1024:+.1f} КБ ({stat.count_diff:+d} блоков), всего {stat.size / 1024:.1f} КБ\n")
+            f.write("\n".join(f"    {line}" for line in stat.traceback.format()) + "\n\n")
+    return path
+
+
+def capture_torch(classifier, path, images, iterations=5):
+    """Трасса операторов прямого прохода (с предобработкой) и сводная таблица рядом с ней"""
+    import torch
+
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    classifier.predict_probs(images)  # Прогрев, чтобы в трассу не попала ленивая инициализация
+    with torch.profiler.profile(activities=activities, record_shapes=True) as profiler:
+        for _ in range(iterations):
+            with torch.profiler.record_function("predict_probs"):
+                classifier.predict_probs(images)
+    profiler.export_chrome_trace(path)
+    with open(path[:-len(".json")] + ".txt", "w", encoding="utf-8") as f:
+        f.write(profiler.key_averages().table(sort_by="self_cpu_time_total", row_limit=40))
+    return path
+
+
+def start_capture(kind, seconds, path):
+    """Запускает захват cpu или memory в фоновом потоке; False, если в процессе уже идёт захват"""
+    if kind not in ("cpu", "memory"):
+        raise ValueError(f"Фоновый захват возможен только для cpu и memory, а не {kind}")
+    if not _capture_lock.acquire(blocking=False):
+        return False
+
+    def run():
+        try:
+            (capture_cpu if kind == "cpu" else capture_memory)(seconds, path)
+            logger.info(f"Профиль {kind} записан: {path}")
+        except Exception as e:
+            logger.error(f"Ошибка профилирования {kind}: {str(e)}", exc_info=True)
+        finally:
+            _capture_lock.release()
+
+    threading.Thread(target=run, name=f"profile-{kind}", daemon=True).start()
+    return True
+
+
+class EventLoopLagMonitor:
+    """Следит за циклом событий: если он не отвечает дольше порога, пишет в лог стек его потока,
+    то есть обработчик, который выполняет блокирующую работу"""
+
+    def __init__(self, threshold_ms=None, interval=None):
+        self.threshold = (threshold_ms or settings.event_loop_lag_threshold_ms) / 1000
+        self.interval = interval or self.threshold / 4
+        self.stalls = 0
+        self.max_lag = 0.0
+        self._beat = time.monotonic()
+        self._loop_thread_id = None
+
+    async def _heartbeat(self):
+        while True:
+            self._beat = time.monotonic()
+            await asyncio.sleep(self.interval)
+
+    def _watchdog(self):
+        reported = None  # Момент последнего сердцебиения, о задержке после которого уже сообщили
+        while True:
+            time.sleep(self.interval)
+            beat = self._beat
+            lag = time.monotonic() - beat
+            if lag < self.threshold:
+                if reported is not None:
+                    logger.warning(f"Цикл событий снова отвечает после блокировки ~{self.max_lag * 1000:.0f} мс")
+                    reported = None
+                continue
+            self.max_lag = max(self.max_lag, lag)
+            if reported == beat:
+                continue
+            reported = beat
+            self.stalls += 1
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = "".join(traceback.format_stack(frame, limit=15)) if frame else "стек недоступен"
+            logger.warning(f"Цикл событий заблокирован дольше {self.threshold * 1000:.0f} мс:\n{stack}")
+
+    def start(self):
+        """Вызывается из работающего цикла событий"""
+        self._loop_thread_id = threading.get_ident()
+        asyncio.get_running_loop().create_task(self._heartbeat())
+        threading.Thread(target=self._watchdog, name="loop-lag-monitor", daemon=True).start()
+        logger.info(f"Монитор задержки цикла событий: порог {self.threshold * 1000:.0f} мс")
@@ -0,0 +1,56 @@
+# Общие пулы соединений Redis (синхронный и asyncio) для бота, задач, кэшей и Celery
+#
+# Пулы создаются один раз на процесс по настройкам REDIS_*; redis-py сам пересоздаёт
+# соединения пула после fork, поэтому пул безопасен для процессов Celery prefork.
+
+import logging
+from urllib.parse import quote
+
+import redis
+import redis.asyncio as aioredis
+
+from app.config import settings
+
+logger = logging.getLogger("app.redis_client")
+
+_pool = None
+_async_pool = None
+
+
+def redis_url(db: int = None) -> str:
+    """URL подключения (для Celery и внешних утилит)"""
+    # Пароль экранируется: символы вроде @, : и / иначе ломают разбор URL в Celery
+    auth = f":{quote(settings.redis_password, safe='')}@" if settings.redis_password else ""
+    db = settings.redis_db if db is None else db
+    return f"redis://{auth}{settings.redis_host}:{settings.redis_port}/{db}"
+
+
+def _pool_kwargs():
+    return dict(
+        host=settings.redis_host,
+        port=settings.redis_port,
+        db=settings.redis_db,
+        password=settings.redis_password or None,
+        max_connections=settings.redis_max_connections,
+        socket_timeout=settings.redis_socket_timeout,
+        socket_connect_timeout=settings.redis_socket_connect_timeout,
+        health_check_interval=settings.redis_health_check_interval,
+    )
+
+
+def get_redis() -> redis.Redis:
+    """Синхронный клиент поверх общего пула процесса"""
+    global _pool
+    if _pool is None:
+        _pool = redis.ConnectionPool(**_pool_kwargs())
+        logger.info(f"Пул Redis: {settings.redis_host}:{settings.redis_port}, до {settings.redis_max_connections} соединений")
+    return redis.Redis(connection_pool=_pool)
+
+
+def get_async_redis() -> aioredis.Redis:
+    """asyncio-клиент поверх общего пула (используется в цикле событий бота)"""
+    global _async_pool
+    if _async_pool is None:
+        _async_pool = aioredis.ConnectionPool(**_pool_kwargs())
+        logger.info(f"Пул Redis (asyncio): {settings.redis_host}:{settings.redis_port}")
+    return aioredis.Redis(connection_pool=_async_pool)
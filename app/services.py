@@ -1,5 +1,10 @@
 import torch
-from transformers import ViTForImageClassification, ViTImageProcessor
+from transformers import (
+    ViTForImageClassification,
+    ViTImageProcessor,
+    AutoModelForImageClassification,
+    AutoImageProcessor,
+)
 from PIL import Image
 import os
 import tempfile
@@ -7,15 +12,43 @@ from shutil import rmtree
 import gdown
 import logging
 from .config import settings
+from .early_exit import EarlyExitViT
+from .labels import LabelTable
+from .image_filter import check_pixels
+
+
+BACKENDS = ("base", "student", "cascade")
+QUANTIZATION_MODES = ("none", "dynamic_int8")
 
 
 class MushroomClassifier:
-    def __init__(self):
+    def __init__(self, backend: str = None, quantization: str = None, model_dir: str = None,
+                 student_dir: str = None, version: str = "default", early_exit: bool = None):
         self.logger = logging.getLogger("app.services")
+        self.version = version  # Версия из реестра моделей - попадает в результаты и ключи кэшей
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        self.logger.info(f"Инициализация классификатора. Устройство: {self.device}")
+        self.backend = backend or settings.model_backend
+        if self.backend not in BACKENDS:
+            raise ValueError(f"Неизвестный backend классификатора: {self.backend}")
+        self.quantization = quantization or settings.model_quantization
+        if self.quantization not in QUANTIZATION_MODES:
+            raise ValueError(f"Неизвестный режим квантизации: {self.quantization}")
+        self.early_exit = settings.early_exit_enabled if early_exit is None else early_exit
+        # Локальные директории моделей; если не заданы - модели загружаются с Google Диска
+        self.model_dir = model_dir or settings.model_dir
+        self.student_dir = student_dir or settings.student_model_dir
+        self.logger.info(
+            f"Инициализация классификатора. Устройство: {self.device}, backend: {self.backend}, "
+            f"квантизация: {self.quantization}"
+        )
         self.model = None
         self.processor = None
+        self.labels = None  # Таблица id -> названия и съедобность, строится после загрузки модели
+        # Компактная модель-студент для каскада: отвечает первой, базовая модель - только при сомнениях
+        self.student = None
+        self.student_processor = None
+        self.cascade_calls = 0  # Счётчики каскада: сколько фото видел студент и сколько ушло в базовую
+        self.cascade_fallbacks = 0
         self.load_model()
 
     def download_file_from_gdrive(self, file_id, filename, temp_dir):
@@ -33,6 +66,77 @@ class MushroomClassifier:
             raise
 
     def load_model(self):
+        """Загрузка моделей выбранного backend'а (локально или с Google Диска)"""
+        if self.backend == "student":
+            self.model, self.processor = self._load(
+                settings.gdrive_student_file_ids, self.student_dir,
+                AutoModelForImageClassification, AutoImageProcessor
+            )
+            self.labels = LabelTable(self.model.config.id2label)
+            return
+
+        self.model, self.processor = self._load(
+            settings.gdrive_file_ids, self.model_dir, ViTForImageClassification, ViTImageProcessor
+        )
+        if self.backend == "cascade":
+            self.student, self.student_processor = self._load(
+                settings.gdrive_student_file_ids, self.student_dir,
+                AutoModelForImageClassification, AutoImageProcessor
+            )
+            if self.student.config.id2label != self.model.config.id2label:
+                raise RuntimeError("Классы модели-студента не совпадают с классами базовой модели")
+        self.labels = LabelTable(self.model.config.id2label)
+
+    def _load(self, file_ids: dict, local_dir, model_cls, processor_cls):
+        if local_dir:
+            self.logger.info(f"Загрузка модели из локальной директории {local_dir}")
+            try:
+                return self._load_pretrained(local_dir, model_cls, processor_cls)
+            except Exception as e:
+                self.logger.error(f"Критическая ошибка при загрузке модели: {str(e)}")
+                raise RuntimeError(f"Ошибка загрузки модели: {e}")
+        return self._load_from_gdrive(file_ids, model_cls, processor_cls)
+
+    def _load_pretrained(self, directory, model_cls, processor_cls):
+        """Загрузка модели и процессора из директории с применением квантизации"""
+        self.logger.info("Загрузка модели в память...")
+        model = model_cls.from_pretrained(
+            directory,
+            local_files_only=True,
+            use_safetensors=True
+        ).to(self.device)
+        model.eval()
+        num_parameters = model.num_parameters()
+
+        if self.early_exit and model_cls is ViTForImageClassification:
+            early_exit_model = EarlyExitViT.from_pretrained_heads(model, directory)
+            if early_exit_model is None:
+                self.logger.warning(f"Головы раннего выхода не найдены в {directory}, используется полная модель")
+            else:
+                model = early_exit_model
+                if settings.similar_k:
+                    # Эмбеддинг индекса похожих фото считается на полной глубине: с поиском похожих
+                    # задачи бота проходят сеть целиком, ранний выход остаётся только для ступени degraded
+                    self.logger.warning(
+                        "Ранний выход включён вместе с поиском похожих фото (similar_k > 0): "
+                        "в обычных задачах бота он не используется, задайте SIMILAR_K=0 для ускорения"
+                    )
+
+        if self.quantization == "dynamic_int8":
+            if self.device.type != "cpu":
+                self.logger.warning("Динамическая int8-квантизация поддерживается только на CPU, пропускаем")
+            else:
+                # Веса Linear-слоёв (основная часть вычислений ViT) хранятся в int8
+                model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+        processor = processor_cls.from_pretrained(
+            directory,
+            local_files_only=True
+        )
+        self.logger.info(f"Модель успешно загружена! Параметров: {num_parameters / 1e6:.1f}M")
+        return model, processor
+
+    def _load_from_gdrive(self, file_ids: dict, model_cls, processor_cls):
         """Загрузка модели и процессора с Google Диска"""
         self.logger.info("Начало загрузки модели с Google Диска")
         temp_dir = tempfile.mkdtemp()
@@ -40,7 +144,10 @@ class MushroomClassifier:
 
         try:
             # Загружаем все необходимые файлы
-            for name, file_id in settings.gdrive_file_ids.items():
+            for name, file_id in file_ids.items():
+                if not file_id:
+                    self.logger.debug(f"Для файла {name} не задан ID, пропускаем")
+                    continue
                 self.logger.debug(f"Загрузка файла модели: {name}")
                 self.download_file_from_gdrive(file_id, name, temp_dir)
 
@@ -53,18 +160,7 @@ class MushroomClassifier:
                     raise FileNotFoundError(error_msg)
 
             # Загружаем модель и процессор из временной директории
-            self.logger.info("Загрузка модели в память...")
-            self.model = ViTForImageClassification.from_pretrained(
-                temp_dir,
-                local_files_only=True,
-                use_safetensors=True
-            ).to(self.device)
-
-            self.processor = ViTImageProcessor.from_pretrained(
-                temp_dir,
-                local_files_only=True
-            )
-            self.logger.info("Модель успешно загружена!")
+            return self._load_pretrained(temp_dir, model_cls, processor_cls)
 
         except Exception as e:
             self.logger.error(f"Критическая ошибка при загрузке модели: {str(e)}")
@@ -76,36 +172,179 @@ class MushroomClassifier:
             except Exception as e:
                 self.logger.warning(f"Не удалось удалить временную директорию: {str(e)}")
 
-    def predict(self, image_path: str):
-        """Предсказание классов грибов по изображению"""
-        self.logger.info(f"Начало обработки изображения: {image_path}")
+    @property
+    def embedding_model(self):
+        """Какая модель даёт эмбеддинги: индекс похожих фото должен строиться на ней же"""
+        return "student" if self.student is not None else "base"
+
+    def _forward(self, pixel_values, model=None, with_embeddings=False):
+        """Один батчевый прямой проход: (N, 3, H, W) -> (вероятности (N, num_classes), эмбеддинги или None).
+
+        Эмбеддинг - вход классификационной головы (CLS-токен после финальной нормализации),
+        перехватывается хуком в том же прямом проходе.
+        """
+        model = model or self.model
+        captured = {}
+        handle = None
+        kwargs = {}
+        if with_embeddings:
+            if isinstance(model, EarlyExitViT):
+                # Эмбеддинги индекса посчитаны на полной глубине, ранний выход их бы исказил
+                kwargs["use_exits"] = False
+            handle = model.classifier.register_forward_hook(
+                lambda module, inputs, output: captured.setdefault("embeddings", inputs[0])
+            )
         try:
-            image = Image.open(image_path)
+            with torch.no_grad():
+                logits = model(pixel_values=pixel_values.to(self.device), **kwargs).logits
+        finally:
+            if handle is not None:
+                handle.remove()
+
+        probs = torch.nn.functional.softmax(logits, dim=-1)
+        embeddings = captured.get("embeddings")
+        if embeddings is not None:
+            if embeddings.dim() == 3:
+                embeddings = embeddings[:, 0]
+            embeddings = torch.nn.functional.normalize(embeddings.float(), dim=-1).cpu()
+        return probs, embeddings
+
+    def _forward_probs(self, pixel_values, model=None):
+        """Один батчевый прямой проход: (N, 3, H, W) -> вероятности (N, num_classes)"""
+        return self._forward(pixel_values, model)[0]
+
+    def _probs(self, images: list, with_embeddings=False, cascade_fallback=True):
+        """Вероятности (и эмбеддинги) для списка изображений; в режиме каскада сначала спрашиваем студента.
+
+        Эмбеддинги всегда берутся из первой модели каскада, чтобы пространство индекса было одним.
+        С cascade_fallback=False (деградация под нагрузкой) отвечает только студент.
+        """
+        if self.student is None:
+            pixel_values = self.processor(images=images, return_tensors="pt")["pixel_values"]
+            return self._forward(pixel_values, with_embeddings=with_embeddings)
+
+        pixel_values = self.student_processor(images=images, return_tensors="pt")["pixel_values"]
+        probs, embeddings = self._forward(pixel_values, self.student, with_embeddings)
+
+        if not cascade_fallback:
+            return probs, embeddings
+        # Базовая модель перепроверяет только те фото, в которых студент не уверен
+        uncertain = (probs.max(dim=-1).values * 100 < settings.cascade_threshold).nonzero().flatten().tolist()
+        self.cascade_calls += len(images)
+        self.cascade_fallbacks += len(uncertain)
+        if uncertain:
+            self.logger.debug(f"Студент не уверен в {len(uncertain)} из {len(images)} фото, запускаем базовую модель")
+            base_pixel_values = self.processor(
+                images=[images[i] for i in uncertain], return_tensors="pt"
+            )["pixel_values"]
+            probs[uncertain] = self._forward_probs(base_pixel_values)
+        return probs, embeddings
+
+    def _tta_views(self, image, k: int):
+        """K аугментированных видов одного фото (отражения, кропы, масштабы) одним тензором"""
+        size = self.processor.size["height"]
+        base_size = int(size * settings.tta_base_scale)
+        base = self.processor(
+            images=image,
+            size={"height": base_size, "width": base_size},
+            return_tensors="pt"
+        )["pixel_values"]
+
+        # Классический ten-crop: центр и углы base_size-изображения + уменьшенное целиком
+        offset = base_size - size
+        center = offset // 2
+        resized = torch.nn.functional.interpolate(base, size=(size, size), mode="bilinear", align_corners=False)
+        crops = [
+            base[..., center:center + size, center:center + size],
+            base[..., :size, :size],
+            base[..., :size, offset:],
+            base[..., offset:, :size],
+            base[..., offset:, offset:],
+        ]
+        views = [torch.flip(resized, dims=[-1])]
+        for crop in crops:
+            views.extend([crop, torch.flip(crop, dims=[-1])])
+        return torch.cat(views[:k], dim=0)
+
+    def _load_image(self, image_path: str):
+        """Открывает изображение и приводит его к RGB"""
+        with Image.open(image_path) as image:
+            check_pixels(image)  # До декодирования: фото могло прийти не через бота
             self.logger.debug("Изображение успешно открыто")
+            # convert загружает пиксели в копию, поэтому файл закрывается сразу, а не при сборке мусора
+            return image.convert("RGB")
+
+    def postprocess(self, probs, k: int = None, threshold: float = None):
+        """Результаты фиксированной схемы для батча вероятностей (N, num_classes).
 
-            if image.mode != "RGB":
-                self.logger.debug("Конвертация изображения в RGB")
-                image = image.convert("RGB")
+        top-k, порог уверенности и названия классов считаются для всего батча сразу:
+        один torch.topk, одно сравнение с порогом и индексирование массивов LabelTable.
+        """
+        k = k or settings.result_top_k
+        threshold = settings.min_confidence_threshold if threshold is None else threshold
+        top_probs, top_ids = torch.topk(probs, k, dim=-1)
+        confidences = torch.round(top_probs.double() * 100, decimals=2)
+        confident = (confidences[:, 0] >= threshold).tolist()
 
-            self.logger.debug("Подготовка входных данных для модели")
-            inputs = self.processor(images=image, return_tensors="pt").to(self.device)
+        ids = top_ids.cpu().numpy()
+        latin, russian, edibility = self.labels.lookup(ids)
+        confidences, ids = confidences.tolist(), ids.tolist()
+        return [
+            {
+                "model_version": self.version,
+                "confident": confident[i],
+                "class_ids": ids[i],
+                "confidences": confidences[i],
+                "latin": latin[i].tolist(),
+                "russian": russian[i].tolist(),
+                "edibility": edibility[i].tolist(),
+            }
+            for i in range(len(ids))
+        ]
+
+    def predict_probs(self, images: list):
+        """Вероятности классов (N, num_classes) для уже открытых RGB-изображений одним батчем"""
+        return self._probs(images)[0]
+
+    def predict_embeddings(self, images: list):
+        """Вероятности и L2-нормированные эмбеддинги (N, dim) из одного прямого прохода"""
+        return self._probs(images, with_embeddings=True)
+
+    def predict(self, image_path: str, tta_threshold: float = None, with_embedding: bool = False,
+                cascade_fallback: bool = True):
+        """Предсказание классов грибов по изображению.
+
+        Если задан tta_threshold и уверенность первого прохода ниже него, выполняется
+        test-time augmentation: K видов фото одним батчем, вероятности усредняются.
+        С with_embedding=True возвращает пару (результаты, эмбеддинг фото).
+        """
+        self.logger.info(f"Начало обработки изображения: {image_path}")
+        try:
+            image = self._load_image(image_path)
 
             self.logger.debug("Выполнение предсказания")
-            with torch.no_grad():
-                outputs = self.model(**inputs)
+            probs, embeddings = self._probs([image], with_embeddings=with_embedding, cascade_fallback=cascade_fallback)
+            probs = probs[0]
 
-            probs = torch.nn.functional.softmax(outputs.logits, dim=-1)[0]
-            top5_probs, top5_indices = torch.topk(probs, 5)
+            if tta_threshold is not None and float(probs.max()) * 100 < tta_threshold:
+                self.logger.info(f"Уверенность {float(probs.max()) * 100:.1f}% ниже порога, запускаем TTA")
+                views = self._tta_views(image, settings.tta_views)
+                if self.student is not None:
+                    # В каскаде первый проход мог дать студент, а виды считает базовая модель: вероятности
+                    # разных моделей откалиброваны по-разному, поэтому исходный вид пересчитывается базовой
+                    # моделью в том же батче
+                    identity = self.processor(images=image, return_tensors="pt")["pixel_values"]
+                    probs = self._forward_probs(torch.cat([identity, views], dim=0)).mean(dim=0)
+                else:
+                    # Усредняем вероятности первого прохода и всех видов
+                    view_probs = self._forward_probs(views)
+                    probs = torch.cat([probs.unsqueeze(0), view_probs], dim=0).mean(dim=0)
 
-            results = []
-            for prob, idx in zip(top5_probs, top5_indices):
-                class_name = self.model.config.id2label[idx.item()]
-                results.append({
-                    "class_name": class_name,
-                    "confidence": float(prob) * 100
-                })
+            results = self.postprocess(probs.unsqueeze(0))[0]
 
             self.logger.info("Предсказание успешно завершено")
+            if with_embedding:
+                return results, embeddings[0]
             return results
 
         except FileNotFoundError:
@@ -114,4 +353,29 @@ class MushroomClassifier:
             raise ValueError(error_msg)
         except Exception as e:
             self.logger.error(f"Ошибка при выполнении предсказания: {str(e)}")
-            raise
\ No newline at end of file
+            raise
+
+    def predict_album(self, image_paths: list, with_embedding: bool = False, cascade_fallback: bool = True):
+        """Предсказание по нескольким фото одного гриба: один батч, вероятности объединяются"""
+        self.logger.info(f"Начало обработки альбома из {len(image_paths)} фото")
+        try:
+            images = [self._load_image(path) for path in image_paths]
+            probs, embeddings = self._probs(images, with_embeddings=with_embedding, cascade_fallback=cascade_fallback)
+            # Слияние ракурсов: среднее логарифмов вероятностей (геометрическое среднее),
+            # согласующиеся между фото классы усиливаются, случайные выбросы гасятся
+            fused = torch.nn.functional.softmax(torch.log(probs.clamp_min(1e-12)).mean(dim=0), dim=-1)
+
+            results = self.postprocess(fused.unsqueeze(0))[0]
+            self.logger.info("Предсказание по альбому успешно завершено")
+            if with_embedding:
+                # Эмбеддинг альбома - нормированное среднее эмбеддингов ракурсов
+                return results, torch.nn.functional.normalize(embeddings.mean(dim=0), dim=-1)
+            return results
+
+        except FileNotFoundError as e:
+            error_msg = f"Файл {e.filename} не найден!"
+            self.logger.error(error_msg)
+            raise ValueError(error_msg)
+        except Exception as e:
+            self.logger.error(f"Ошибка при выполнении предсказания по альбому: {str(e)}")
+            raise
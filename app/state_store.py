@@ -0,0 +1,206 @@
+import time
+from abc import ABC, abstractmethod
+import logging
+from collections import OrderedDict
+
+from app.config import settings
+from app.redis_client import get_async_redis
+
+logger = logging.getLogger("app.state_store")
+
+
+class BaseStateStore(ABC):
+    """Хранилище состояний диалога: набор полей (state, last_suggestion_msg_id, ...) на пользователя"""
+
+    @abstractmethod
+    async def get(self, user_id) -> dict:
+        """Все поля состояния пользователя (пустой словарь, если состояния нет)"""
+
+    @abstractmethod
+    async def update(self, user_id, **fields):
+        """Записывает поля и продлевает TTL состояния"""
+
+    @abstractmethod
+    async def remove(self, user_id, *fields):
+        """Удаляет перечисленные поля, а без аргументов - всё состояние пользователя"""
+
+    @abstractmethod
+    async def claim(self, user_id, key, ttl: float) -> bool:
+        """Атомарно занимает отметку key пользователя на ttl секунд; False - отметка уже занята"""
+
+
+class InMemoryStateStore(BaseStateStore):
+    """Состояния в памяти процесса с TTL и ограничением числа пользователей (один узел)"""
+
+    def __init__(self, ttl: int, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._states = OrderedDict()  # user_id -> (expires_at, fields)
+        self._claims = OrderedDict()  # (user_id, key) -> expires_at
+
+    def _evict(self, now):
+        # Записи упорядочены по времени последнего обновления, поэтому просроченные - в начале
+        while self._states:
+            user_id, (expires_at, _) = next(iter(self._states.items()))
+            if expires_at > now and len(self._states) <= self.max_entries:
+                break
+            self._states.popitem(last=False)
+
+    async def get(self, user_id) -> dict:
+        item = self._states.get(user_id)
+        if item is None:
+            return {}
+        expires_at, fields = item
+        if expires_at <= time.monotonic():
+            self._states.pop(user_id, None)
+            return {}
+        return dict(fields)
+
+    async def update(self, user_id, **fields):
+        now = time.monotonic()
+        _, current = self._states.pop(user_id, (None, {}))
+        current.update({key: str(value) for key, value in fields.items()})
+        self._states[user_id] = (now + self.ttl, current)
+        self._evict(now)
+
+    async def remove(self, user_id, *fields):
+        if not fields:
+            self._states.pop(user_id, None)
+            return
+        item = self._states.get(user_id)
+        if item is not None:
+            for field in fields:
+                item[1].pop(field, None)
+
+    async def claim(self, user_id, key, ttl: float) -> bool:
+        # Проверка и запись без await между ними: в одном цикле событий это атомарно
+        now = time.monotonic()
+        while self._claims:
+            _, expires_at = next(iter(self._claims.items()))
+            if expires_at > now and len(self._claims) <= self.max_entries:
+                break
+            self._claims.popitem(last=False)
+        expires_at = self._claims.get((user_id, key))
+        if expires_at is not None and expires_at > now:
+            return False
+        self._claims.pop((user_id, key), None)
+        self._claims[(user_id, key)] = now + ttl
+        return True
+
+
+class RedisStateStore(BaseStateStore):
+    """Состояния в Redis-хэшах с TTL - общие для всех реплик бота"""
+
+    def __init__(self, client, ttl: int, prefix: str = "bot:state:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def _key(self, user_id):
+        return f"{self.prefix}{user_id}"
+
+    async def get(self, user_id) -> dict:
+        raw = await self.client.hgetall(self._key(user_id))
+        return {
+            (key.decode() if isinstance(key, bytes) else key):
+                (value.decode() if isinstance(value, bytes) else value)
+            for key, value in raw.items()
+        }
+
+    async def update(self, user_id, **fields):
+        key = self._key(user_id)
+        # Запись полей и продление TTL одним обращением к Redis
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.hset(key, mapping={name: str(value) for name, value in fields.items()})
+            pipe.expire(key, self.ttl)
+            await pipe.execute()
+
+    async def remove(self, user_id, *fields):
+        key = self._key(user_id)
+        if fields:
+            await self.client.hdel(key, *fields)
+        else:
+            await self.client.delete(key)
+
+    async def claim(self, user_id, key, ttl: float) -> bool:
+        # SET NX: из одновременных запросов (в том числе на разных репликах) отметку получает один
+        ttl_ms = max(1, int(ttl * 1000))
+        return bool(await self.client.set(f"{self._key(user_id)}:claim:{key}", 1, nx=True, px=ttl_ms))
+
+
+def create_state_store() -> BaseStateStore:
+    """Создаёт хранилище состояний согласно настройке state_store_backend"""
+    backend = settings.state_store_backend
+    if backend == "redis":
+        client = get_async_redis()
+        logger.info("Хранилище состояний: Redis")
+        return RedisStateStore(client, ttl=settings.state_ttl_seconds)
+    if backend == "memory":
+        logger.info("Хранилище состояний: память процесса")
+        return InMemoryStateStore(ttl=settings.state_ttl_seconds, max_entries=settings.state_max_entries)
+    raise ValueError(f"Неизвестный тип хранилища состояний: {backend}")
+
+
+class BaseAlbumBuffer(ABC):
+    """Буфер фото альбома (media group) на время окна сбора: обновления в виде JSON"""
+
+    @abstractmethod
+    async def add(self, group_id, update_json: str) -> bool:
+        """Добавляет фото альбома; True - этот процесс первым увидел альбом и обрабатывает его"""
+
+    @abstractmethod
+    async def take(self, group_id, limit: int) -> list:
+        """Забирает до limit фото альбома (в порядке прихода) и очищает буфер"""
+
+
+class InMemoryAlbumBuffer(BaseAlbumBuffer):
+    """Альбомы в памяти процесса (один узел)"""
+
+    def __init__(self):
+        self._albums = {}
+
+    async def add(self, group_id, update_json: str) -> bool:
+        album = self._albums.get(group_id)
+        if album is None:
+            self._albums[group_id] = [update_json]
+            return True
+        album.append(update_json)
+        return False
+
+    async def take(self, group_id, limit: int) -> list:
+        return self._albums.pop(group_id, [])[:limit]
+
+
+class RedisAlbumBuffer(BaseAlbumBuffer):
+    """Альбомы в Redis: фото одного альбома, пришедшие на разные реплики, собираются в один список,
+    а обработку забирает одна реплика (SET NX) - пользователь получает один общий ответ"""
+
+    def __init__(self, client, ttl: int, prefix: str = "bot:album:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    async def add(self, group_id, update_json: str) -> bool:
+        key = f"{self.prefix}{group_id}"
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.rpush(key, update_json)
+            pipe.expire(key, self.ttl)
+            # Ключ владельца живёт дольше окна: опоздавшее фото не запустит второй ответ
+            pipe.set(f"{key}:owner", 1, nx=True, ex=self.ttl)
+            _, _, owner = await pipe.execute()
+        return bool(owner)
+
+    async def take(self, group_id, limit: int) -> list:
+        key = f"{self.prefix}{group_id}"
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.lrange(key, 0, limit - 1)
+            pipe.delete(key)
+            items, _ = await pipe.execute()
+        return [item.decode() if isinstance(item, bytes) else item for item in items]
+
+
+def create_album_buffer() -> BaseAlbumBuffer:
+    """Буфер альбомов в том же хранилище, что и состояния диалога"""
+    if settings.state_store_backend == "redis":
+        return RedisAlbumBuffer(get_async_redis(), ttl=int(settings.album_window_seconds * 4) + 60)
+    return InMemoryAlbumBuffer()
@@ -0,0 +1,197 @@
+# Локальная заглушка Telegram Bot API и генератор нагрузки на webhook
+#
+# запустить заглушку: python -m app.stub_telegram serve --port 8081
+# направить бота на неё: TELEGRAM_API_BASE_URL=http://localhost:8081/bot
+#                        TELEGRAM_API_BASE_FILE_URL=http://localhost:8081/file/bot
+# нагрузить webhook: python -m app.stub_telegram load --url http://localhost:8000/telegram/webhook --rate 200
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import re
+import time
+from urllib.parse import parse_qsl
+
+import httpx
+from fastapi import FastAPI, Request
+from fastapi.responses import Response
+
+from app.config import settings
+
+STUB_BOT = {
+    "id": 1,
+    "is_bot": True,
+    "first_name": "Stub",
+    "username": "stub_mushroom_bot",
+    "can_join_groups": False,
+    "can_read_all_group_messages": False,
+    "supports_inline_queries": True,
+}
+
+# Методы, которые в настоящем Bot API возвращают просто True
+TRUE_METHODS = {
+    "answerCallbackQuery", "answerInlineQuery", "setWebhook", "deleteWebhook",
+    "setMyCommands", "deleteMessage", "sendChatAction",
+}
+
+stub_app = FastAPI(title="Telegram Bot API stub")
+_message_ids = itertools.count(1)
+stats = {"calls": {}}
+
+
+def _message(chat_id, **extra):
+    message = {
+        "message_id": next(_message_ids),
+        "date": int(time.time()),
+        "chat": {"id": int(chat_id or 0), "type": "private"},
+        "from": STUB_BOT,
+    }
+    message.update(extra)
+    return message
+
+
+_MULTIPART_FIELD = re.compile(rb'name="([^"]+)"\r\n(?:Content-Type: text/plain[^\r]*\r\n)?\r\n(.*?)\r\n--', re.S)
+
+
+async def _params(request: Request) -> dict:
+    """PTB отправляет параметры формой (или multipart при загрузке файлов)"""
+    content_type = request.headers.get("content-type", "")
+    body = await request.body()
+    if content_type.startswith("application/json"):
+        return json.loads(body or b"{}")
+    if content_type.startswith("multipart/form-data"):
+        # Достаточно текстовых полей (chat_id, caption); содержимое файлов заглушке не нужно
+        return {
+            name.decode(): value.decode("utf-8", "replace")
+            for name, value in _MULTIPART_FIELD.findall(body)
+            if len(value) < 4096
+        }
+    return dict(parse_qsl(body.decode()))
+
+
+@stub_app.post("/bot{token}/{method}")
+@stub_app.get("/bot{token}/{method}")
+async def bot_api(token: str, method: str, request: Request):
+    stats["calls"][method] = stats["calls"].get(method, 0) + 1
+    params = await _params(request)
+
+    if method == "getMe":
+        result = STUB_BOT
+    elif method in TRUE_METHODS:
+        result = True
+    elif method == "getFile":
+        file_id = params.get("file_id", "stub")
+        result = {"file_id": file_id, "file_unique_id": file_id, "file_size": 0, "file_path": f"photos/{file_id}.jpg"}
+    elif method in ("sendPhoto", "sendMediaGroup"):
+        photo = [{"file_id": f"stub-{next(_message_ids)}", "file_unique_id": "stub", "width": 1280, "height": 960}]
+        message = _message(params.get("chat_id"), photo=photo, caption=params.get("caption"))
+        result = [message] if method == "sendMediaGroup" else message
+    elif method in ("sendMessage", "editMessageText", "editMessageCaption"):
+        result = _message(params.get("chat_id"), text=params.get("text", ""))
+    elif method == "getUpdates":
+        # Заглушка не генерирует обновления для polling, имитируем пустой long poll
+        await asyncio.sleep(1)
+        result = []
+    else:
+        result = True
+
+    return {"ok": True, "result": result}
+
+
+@stub_app.get("/file/bot{token}/{file_path:path}")
+async def file_api(token: str, file_path: str):
+    """Отдаёт случайное эталонное фото вместо файла пользователя"""
+    folder = settings.reference_photo_dir
+    photos = sorted(name for name in os.listdir(folder) if name.lower().endswith(".jpg"))
+    with open(os.path.join(folder, random.choice(photos)), "rb") as f:
+        return Response(content=f.read(), media_type="image/jpeg")
+
+
+@stub_app.get("/stats")
+async def get_stats():
+    return stats
+
+
+def make_text_update(update_id: int, user_id: int, text: str) -> dict:
+    """Синтетическое обновление с текстовым сообщением"""
+    user = {"id": user_id, "is_bot": False, "first_name": "load", "username": f"load_{user_id}"}
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": user,
+            "text": text,
+        },
+    }
+
+
+async def run_load(url: str, rate: float, duration: float, users: int, secret: str):
+    """Отправляет обновления на webhook с постоянной частотой и печатает задержки приёма"""
+    queries = ["лисичка", "мухомор", "опёнок", "белый", "подосиновик", "трутовик"]
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+    latencies, statuses = [], {}
+
+    async with httpx.AsyncClient(timeout=30) as client:
+        async def send(update):
+            started = time.perf_counter()
+            try:
+                response = await client.post(url, json=update, headers=headers)
+                status = response.status_code
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            latencies.append(time.perf_counter() - started)
+            statuses[status] = statuses.get(status, 0) + 1
+
+        tasks = []
+        started = time.perf_counter()
+        for update_id in itertools.count(1):
+            planned = started + update_id / rate
+            if planned - started > duration:
+                break
+            await asyncio.sleep(max(0.0, planned - time.perf_counter()))
+            update = make_text_update(update_id, random.randint(1, users), random.choice(queries))
+            tasks.append(asyncio.create_task(send(update)))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    percentile = lambda p: latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000
+    print(json.dumps({
+        "sent": len(latencies),
+        "throughput_rps": round(len(latencies) / elapsed, 1),
+        "statuses": {str(key): value for key, value in statuses.items()},
+        "latency_ms": {"p50": round(percentile(0.50), 2), "p95": round(percentile(0.95), 2),
+                       "p99": round(percentile(0.99), 2), "max": round(latencies[-1] * 1000, 2)},
+    }, ensure_ascii=False, indent=2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Заглушка Telegram Bot API и нагрузка на webhook")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    serve = sub.add_parser("serve", help="запустить заглушку Bot API")
+    serve.add_argument("--host", default="0.0.0.0")
+    serve.add_argument("--port", type=int, default=8081)
+
+    load = sub.add_parser("load", help="нагрузить webhook синтетическими обновлениями")
+    load.add_argument("--url", default=f"http://localhost:8000{settings.telegram_webhook_path}")
+    load.add_argument("--rate", type=float, default=50, help="обновлений в секунду")
+    load.add_argument("--duration", type=float, default=30, help="длительность, сек")
+    load.add_argument("--users", type=int, default=1000, help="число синтетических пользователей")
+    load.add_argument("--secret", default=settings.telegram_webhook_secret)
+
+    args = parser.parse_args()
+    if args.command == "serve":
+        import uvicorn
+        uvicorn.run(stub_app, host=args.host, port=args.port)
+    else:
+        asyncio.run(run_load(args.url, args.rate, args.duration, args.users, args.secret))
+
+
+if __name__ == "__main__":
+    main()
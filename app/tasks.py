@@ -1,69 +1,204 @@
+import os
 import tempfile
+import time
 import base64
-import redis
-import pickle
-from app.services import MushroomClassifier
+import binascii
+from contextlib import contextmanager
+from celery.signals import worker_process_init
+from celery.worker.control import control_command
+from PIL import Image, UnidentifiedImageError
+from app.model_registry import ModelManager, reference_images
+from app.bulk import JobLeased, run_bulk_job
+from app.labels import compact_result
+from app.embedding_index import EmbeddingIndex, version_index_dir
+from app.image_filter import ImageRejected
+from app.profiling import PROFILE_KINDS, capture_torch, profile_path, start_capture
 from app.config import settings
 import logging
 from app.celery_app import celery_app
 
-@celery_app.task(bind=True)
-def classify_mushroom_image(self, photo_base64: str):
-    """Фоновая задача для классификации гриба по изображению"""
+_model_manager = None
+
+# Непригодное фото повтором не исправить: такие задачи завершаются сразу, без self.retry
+INVALID_IMAGE_ERRORS = (ImageRejected, UnidentifiedImageError, Image.DecompressionBombError, binascii.Error)
+
+
+def _get_model_manager():
+    """Менеджер моделей живёт в процессе воркера: модель загружается один раз, а не в каждой задаче"""
+    global _model_manager
+    if _model_manager is None:
+        _model_manager = ModelManager()
+    return _model_manager
+
+
+@worker_process_init.connect
+def _preload_model(**kwargs):
+    """Загрузка модели при старте процесса воркера, до первой задачи"""
     try:
-        # Извлекаем модель из Redis
-        redis_client = redis.StrictRedis(host='redis', port=6379, db=0)
-        classifier_data = redis_client.get('mushroom_classifier')
+        _get_model_manager().refresh(force=True)
+    except Exception as e:
+        logging.error(f"Не удалось загрузить модель при старте воркера: {str(e)}", exc_info=True)
+
+
+def _get_classifier():
+    """(версия, классификатор) для очередной задачи: активная версия или канарейка"""
+    return _get_model_manager().get()
+
+
+_embedding_indexes = {}  # версия модели -> (индекс или None, момент открытия)
+
 
-        if classifier_data is None:
-            # Если модель не найдена в Redis, создаем новую
-            classifier = MushroomClassifier()
+def _get_embedding_index(classifier):
+    """Индекс похожих фото версии, открытый только для чтения (memmap); строится при загрузке модели.
+
+    Если индекса ещё нет или он построен на другой модели, попытка открыть его повторяется
+    не чаще model_registry_check_interval - поиск похожих не отключается до конца жизни процесса.
+    """
+    # Индексы версий, которые менеджер уже выгрузил, закрываем вместе с моделями
+    loaded = _get_model_manager().versions()
+    for version in [v for v in _embedding_indexes if v not in loaded and v != classifier.version]:
+        del _embedding_indexes[version]
+    index, opened_at = _embedding_indexes.get(classifier.version, (None, None))
+    if opened_at is None or (index is None and time.monotonic() - opened_at >= settings.model_registry_check_interval):
+        index = EmbeddingIndex(version_index_dir(classifier.version))
+        if not len(index) or index.meta["embedding_model"] != classifier.embedding_model:
+            index = None
         else:
-            classifier = pickle.loads(classifier_data)
-
-        # Декодируем изображение из base64
-        photo_bytes = base64.b64decode(photo_base64)
-
-        # Создаем временный файл для изображения
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as temp_file:
-            temp_file.write(photo_bytes)
-            temp_file_path = temp_file.name
-
-        # Теперь передаем путь к временно сохраненному файлу в сервис для классификации
-        predictions = classifier.predict(temp_file_path)
-
-        # Формируем результаты
-
-        min_threshold_ = 50
-        top_prediction = predictions[0]
-        if top_prediction['confidence'] < min_threshold_:
-            response = [{
-                'class_name': 'Недостаточная уверенность',
-                'confidence': top_prediction['confidence'],
-                'description': (
-                    "❌ Изображение возможно некорректное или гриб не различим. "
-                    "Попробуйте другое фото или убедитесь в чёткости этого изображения"
-                )
-            }]
-            logging.info("Низкая уверенность предсказания – сформировано предупреждение.")
-            return response
-
-        response = []
-        for pred in predictions[:3]:
-            class_name = pred['class_name']
-            description = settings.mushroom_descriptions.get(
-                class_name,
-                f"{class_name}. Информация о съедобности отсутствует"
-            )
-            response.append({
-                'class_name': class_name,
-                'confidence': pred['confidence'],
-                'description': description
-            })
-
-        logging.info("Результаты классификации сформированы.")
-        return response
+            # Бот восстанавливает похожие фото по номеру в галерее, как названия - по id класса
+            _get_model_manager().registry.publish_gallery(classifier.version, index.items)
+        _embedding_indexes[classifier.version] = (index, time.monotonic())
+    return index
+
 
+def _find_similar(classifier, embedding):
+    """Ближайшие фото галереи к эмбеддингу запроса (пустой список, если поиск отключён)"""
+    if not settings.similar_k or embedding is None:
+        return []
+    try:
+        index = _get_embedding_index(classifier)
+        if index is None:
+            return []
+        matches = index.search(embedding.numpy(), settings.similar_k)
+    except Exception as e:
+        logging.warning(f"Не удалось выполнить поиск похожих фото: {str(e)}")
+        return []
+    return [{'id': m['id'], 'score': m['score']} for m in matches]
+
+
+def _rejected(e):
+    """Ошибка непригодного фото для бота: всегда ImageRejected с причиной для пользователя"""
+    logging.info(f"Изображение отклонено без повтора задачи: {str(e)}")
+    return e if isinstance(e, ImageRejected) else ImageRejected("Файл не похож на изображение.")
+
+
+@contextmanager
+def _temp_images(photos_base64: list):
+    """Декодирует изображения из base64 во временные файлы; файлы удаляются при любом исходе задачи"""
+    paths = []
+    try:
+        for photo_base64 in photos_base64:
+            with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as temp_file:
+                paths.append(temp_file.name)
+                temp_file.write(base64.b64decode(photo_base64))
+        yield paths
+    finally:
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError as e:
+                logging.warning(f"Не удалось удалить временный файл {path}: {e}")
+
+
+@celery_app.task(bind=True)
+def classify_mushroom_image(self, photo_base64: str, degraded: bool = False):
+    """Фоновая задача для классификации гриба по изображению.
+
+    degraded=True - дешёвый путь под нагрузкой: без TTA и похожих фото, в каскаде только студент.
+    """
+    try:
+        _, classifier = _get_classifier()
+
+        # При низкой уверенности классификатор сам выполнит TTA одним батчем
+        tta_threshold = settings.min_confidence_threshold if settings.tta_enabled and not degraded else None
+        # Эмбеддинг для поиска похожих фото берётся из того же прямого прохода
+        # (без поиска похожих эмбеддинг не запрашивается, и ранний выход не отключается)
+        with_embedding = bool(settings.similar_k) and not degraded
+        # Временный файл для изображения удаляется сразу после классификации
+        with _temp_images([photo_base64]) as (temp_file_path,):
+            result = classifier.predict(temp_file_path, tta_threshold=tta_threshold, with_embedding=with_embedding,
+                                        cascade_fallback=not degraded)
+        prediction, embedding = result if with_embedding else (result, None)
+
+        # В result backend уходят только id и уверенности, названия бот восстанавливает сам
+        return compact_result(prediction, _find_similar(classifier, embedding))
+
+    except INVALID_IMAGE_ERRORS as e:
+        raise _rejected(e)
     except Exception as e:
         logging.error(f"Ошибка при обработке изображения: {str(e)}", exc_info=True)
-        raise self.retry(exc=e)  # В случае ошибки повторяем задачу
\ No newline at end of file
+        raise self.retry(exc=e)  # В случае ошибки повторяем задачу
+
+
+@celery_app.task(bind=True)
+def classify_mushroom_album(self, photos_base64: list, degraded: bool = False):
+    """Фоновая задача для классификации гриба по альбому фото (один батч на все ракурсы)"""
+    try:
+        _, classifier = _get_classifier()
+
+        with_embedding = bool(settings.similar_k) and not degraded
+        with _temp_images(photos_base64) as temp_file_paths:
+            result = classifier.predict_album(temp_file_paths, with_embedding=with_embedding,
+                                              cascade_fallback=not degraded)
+        prediction, embedding = result if with_embedding else (result, None)
+
+        return compact_result(prediction, _find_similar(classifier, embedding))
+
+    except INVALID_IMAGE_ERRORS as e:
+        raise _rejected(e)
+    except Exception as e:
+        logging.error(f"Ошибка при обработке альбома: {str(e)}", exc_info=True)
+        raise self.retry(exc=e)
+
+
+@celery_app.task(bind=True, ignore_result=True, max_retries=3)
+def run_bulk_classification(self, source: str, job_dir: str, output_format: str = "csv"):
+    """Пакетное задание; при повторе продолжается с сохранённого прогресса"""
+    try:
+        _, classifier = _get_classifier()
+        # Аренда на id задачи: он не меняется при повторах, а после сбоя аренда ждёт повтора
+        hold = settings.bulk_lease_seconds if self.request.retries < self.max_retries else 0
+        run_bulk_job(source, job_dir, classifier, output_format, owner=self.request.id, hold_on_failure=hold)
+    except JobLeased as e:
+        logging.warning(str(e))
+    except Exception as e:
+        logging.error(f"Ошибка пакетного задания {job_dir}: {str(e)}", exc_info=True)
+        raise self.retry(exc=e, countdown=30)
+
+
+@celery_app.task(ignore_result=True)
+def profile_worker(kind: str, seconds: float, path: str):
+    """Профиль процесса пула, взявшего задачу: там загружена модель и идёт классификация"""
+    if kind == "torch":
+        _, classifier = _get_classifier()
+        capture_torch(classifier, path, reference_images(), settings.profile_torch_iterations)
+        logging.info(f"Профиль torch записан: {path}")
+    elif not start_capture(kind, seconds, path):
+        logging.warning(f"Профиль {kind} не снят: в процессе уже идёт захват")
+
+
+@control_command(
+    args=[("kind", str), ("seconds", float)],
+    signature="<cpu|memory|torch> [seconds]",
+)
+def profile(state, kind="cpu", seconds=10.0):
+    """celery -A app.celery_config.celery_app control profile cpu 30 - профиль воркера в PROFILE_DIR"""
+    if kind not in PROFILE_KINDS:
+        return {"error": f"Вид профиля должен быть одним из: {', '.join(PROFILE_KINDS)}"}
+    path = profile_path(kind, f"worker-{state.hostname}")
+    # При prefork команда выполняется в родительском процессе, а модель и задачи - в дочерних:
+    # захват передаётся задачей одному из процессов пула. В solo/threads пуле снимаем профиль на месте.
+    if kind == "torch" or "prefork" in type(state.consumer.pool).__module__:
+        profile_worker.apply_async(args=[kind, seconds, path])
+    elif not start_capture(kind, seconds, path):
+        return {"error": "В процессе уже идёт захват профиля"}
+    return {"ok": os.path.basename(path)}
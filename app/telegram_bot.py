@@ -1,12 +1,17 @@
+import functools
+import json
 import logging
 import os
+import time
 import asyncio
+from collections import OrderedDict
 from telegram import (
     Update,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
     InlineQueryResultArticle,
     InputTextMessageContent,
+    InputMediaPhoto,
     ReplyKeyboardMarkup,
     KeyboardButton,
 )
@@ -21,52 +26,60 @@ from telegram.ext import (
     ChosenInlineResultHandler,
 )
 from telegram.constants import ParseMode
-from app.services import MushroomClassifier
 from app.config import settings, logger
-from app.tasks import classify_mushroom_image
+from app.tasks import classify_mushroom_image, classify_mushroom_album
 from app.DataBase import DataBase
+from app.assets import ReferencePhotoCatalog
+from app.catalog import get_catalog, normalize_name
+from app.labels import EDIBILITY_MARKERS, LabelTable
+from app.image_filter import ImageRejected, select_photo_size, check_photo_size, check_image
+from app.model_registry import ModelRegistry
+from app.state_store import create_album_buffer, create_state_store
+from app.profiling import EventLoopLagMonitor
+from app.degradation import DEGRADED, SHED, LoadMonitor, Overloaded, photo_key
+from celery.exceptions import TimeoutError as CeleryTimeoutError
 
 
 import base64
-import redis
-import pickle
+
+
+OVERLOADED_TEXT = "⏳ Сейчас слишком много запросов на распознавание. Попробуйте отправить фото через пару минут."
+DEGRADED_NOTE = "\n\nℹ️ <i>Из-за высокой нагрузки ответ получен упрощённым способом, без похожих фото.</i>"
 
 
 class TelegramBot:
-    class FakeMessage:
-        def __init__(self, text, user):
-            self.text = text
-            self.from_user = user
-            self.chat = user  # Обычно chat также связан с пользователем
-            self.message_id = 1  # Минимально необходимый идентификатор сообщения
-
-        # Изменяем reply_text для возврата объекта с message_id
-        async def reply_text(self, text, parse_mode=None, reply_markup=None):
-            # В реальном боте этот метод отправляет текст. Здесь мы просто создаем объект для тестирования.
-            print(f"Replying with text: {text}")
-
-            # Возвращаем объект с атрибутом message_id
-            return TelegramBot.FakeReply(message_id=self.message_id)
-
-    class FakeReply:
-        def __init__(self, message_id):
-            self.message_id = message_id  # Имитация атрибута message_id, который нужен в handle_text
-
-    def __init__(self, token: str, classifier: MushroomClassifier, db: DataBase):
+    def __init__(self, token: str, db: DataBase):
+        # Модель загружается только в воркерах Celery (реестр моделей), боту она не нужна
         self.token = token
-        self.classifier = classifier
         self.db = db
 
-        self.redis_client = redis.StrictRedis(host='redis', port=6379, db=0)
-        # Сохраняем модель в Redis, используя pickle для сериализации
-        self.redis_client.set('mushroom_classifier', pickle.dumps(self.classifier))
-
         self.logger = logging.getLogger("app.telegram_bot")
-        self.app = Application.builder().token(self.token).build()
-        self.user_states = {}  # Для хранения состояний пользователей
-
-        # Загружаем изображения грибов
-        self.mushroom_images = self._load_mushroom_images()
+        builder = (
+            Application.builder()
+            .token(self.token)
+            .base_url(settings.telegram_api_base_url)
+            .base_file_url(settings.telegram_api_base_file_url)
+            .concurrent_updates(settings.telegram_concurrent_updates)
+        )
+        if settings.telegram_mode == "webhook":
+            # Обновления приходят через FastAPI-маршрут в app.update_queue, Updater не нужен
+            builder = builder.updater(None)
+        self.app = builder.build()
+        self.state_store = create_state_store()  # Состояния пользователей (общие для реплик)
+        self.album_buffer = create_album_buffer()  # media_group_id -> фото, собираемые в течение окна
+        self.album_tasks = set()  # Отложенные обработки альбомов
+        self.model_registry = ModelRegistry()
+        self.label_tables = OrderedDict()  # версия модели -> LabelTable (последние label_tables_max_versions)
+        self.gallery_items = OrderedDict()  # версия модели -> {номер в галерее: (name, label, path)}
+        self.load_monitor = LoadMonitor()  # Очередь Celery, время ответа воркеров и ступень деградации
+        self.on_handler_error = None  # hook(update, error): ошибки, перехваченные обработчиками
+
+        # Загружаем эталонные фото грибов (байты в LRU-кэше) и общий каталог видов
+        self.photo_catalog = ReferencePhotoCatalog()
+        self.photo_catalog.warm()
+        self.catalog = get_catalog()
+        self.inline_cache = OrderedDict()  # нормализованный запрос -> готовые inline-результаты
+        self._warm_inline_cache()
 
         # Регистрируем обработчики
         self.app.add_handler(CommandHandler("start", self.start_command))
@@ -77,33 +90,16 @@ class TelegramBot:
         self.app.add_handler(InlineQueryHandler(self.handle_inline_query))
         self.app.add_handler(ChosenInlineResultHandler(self.handle_chosen_inline_result))
 
-    def _load_mushroom_images(self):
-        """Загружает все изображения грибов из папки в память"""
-        folder_path = "mushroom_photo"
-        mushroom_images = {}
-
-        for filename in os.listdir(folder_path):
-            if filename.lower().endswith('.jpg'):
-                file_path = os.path.join(folder_path, filename)
-                mushroom_images[filename[:-4]] = file_path
-
-        self.logger.info(f"Загружено {len(mushroom_images)} изображений грибов")
-        return mushroom_images
+    def _handler_failed(self, update, error):
+        """Ошибка, которую обработчик перехватил сам (пользователь получил "❌"), - в on_handler_error"""
+        if self.on_handler_error is not None:
+            self.on_handler_error(update, error)
 
     def _find_similar_mushrooms(self, query: str, limit: int = 5):
-        """Находит грибы, названия которых содержат запрос (с ограничением количества)"""
-        self.logger.debug(f"Поиск грибов по запросу: '{query}'")
-        query = query.lower().strip()
-        matches = []
-
-        for name in self.mushroom_images.keys():
-            if query in name.lower():
-                matches.append(name)
-                if len(matches) >= limit:
-                    break
-
-        self.logger.debug(f"Найдено совпадений: {len(matches)}")
-        return sorted(matches)
+        """Виды с эталонным фото, названия которых содержат запрос (записи каталога, не больше limit)"""
+        matches = self.catalog.search(query, limit)
+        self.logger.debug(f"Поиск грибов по запросу '{query}': найдено {len(matches)}")
+        return matches
 
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /start с проверкой и добавлением пользователя в базу данных"""
@@ -111,10 +107,10 @@ class TelegramBot:
         username = update.message.from_user.username
 
         # Проверяем, есть ли уже пользователь в базе данных
-        existing_user = self.db.get_user_by_telegram_id(user_id)
+        existing_user = await asyncio.to_thread(self.db.get_user_by_telegram_id, user_id)
         if not existing_user:
             # Если пользователя нет, добавляем его
-            self.db.create_user(username, user_id)
+            await asyncio.to_thread(self.db.create_user, username, user_id)
             self.logger.info(f"Пользователь {username} с ID {user_id} добавлен в базу")
 
         # Отправляем приветственное сообщение пользователю
@@ -148,120 +144,263 @@ class TelegramBot:
             parse_mode=ParseMode.HTML
         )
 
-    # В обработчике inline-запроса
+    def _inline_results(self, query: str):
+        """Готовые inline-результаты для запроса: из кэша по префиксу или поиском с сохранением в кэш"""
+        results = self.inline_cache.get(query)
+        if results is not None:
+            self.inline_cache.move_to_end(query)
+            return results
+
+        results = [
+            InlineQueryResultArticle(
+                id=str(entry.id),  # Стабильный id каталога: один и тот же гриб для всех запросов и реплик
+                title=entry.russian,
+                input_message_content=InputTextMessageContent(
+                    message_text=f"🍄 {entry.russian}",
+                    parse_mode=ParseMode.HTML
+                ),
+                description=f"Нажмите, чтобы узнать больше о {entry.russian}"
+            )
+            for entry in self._find_similar_mushrooms(query, limit=10)
+        ]
+        self.inline_cache[query] = results
+        if len(self.inline_cache) > settings.inline_cache_max_entries:
+            self.inline_cache.popitem(last=False)
+        return results
+
+    def _warm_inline_cache(self):
+        """Заранее заполняет кэш для всех префиксов слов названий - так набирают запрос"""
+        prefixes = {
+            word[:length]
+            for entry in self.catalog.searchable
+            for word in entry.key.split()
+            for length in range(1, len(word) + 1)
+        }
+        for prefix in sorted(prefixes)[:settings.inline_cache_max_entries]:
+            self._inline_results(prefix)
+        self.logger.info(f"Кэш inline-подсказок: {len(self.inline_cache)} префиксов")
+
     async def handle_inline_query(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Обработчик inline-запросов для подсказок в реальном времени"""
-        query = update.inline_query.query
+        """Обработчик inline-запросов для подсказок в реальном времени (без побочных эффектов)"""
+        query = normalize_name(update.inline_query.query)
         if not query:
             return
 
-        user_id = update.inline_query.from_user.id
-
-        # Сохраняем запрос в БД с типом "search_by_name_inline" (инлайн-запрос)
-        query_type = "search_by_name_inline"
-        # Промежуточный запрос не сохраняем, сохраняем только итоговый
-        matches = self._find_similar_mushrooms(query, limit=10)
-        results = []
-
-        self.logger.debug(f"Обрабатываем inline запрос с текстом: '{query}'")
-
-        # Формируем результаты для инлайн-запроса
-        for idx, name in enumerate(matches):
-            results.append(
-                InlineQueryResultArticle(
-                    id=str(idx),
-                    title=name.capitalize(),
-                    input_message_content=InputTextMessageContent(
-                        message_text=f"🍄 {name.capitalize()}",
-                        parse_mode=ParseMode.HTML
-                    ),
-                    description=f"Нажмите, чтобы узнать больше о {name}"
-                )
-            )
-
+        # Результаты одинаковы для всех пользователей, поэтому Telegram может долго кэшировать их
+        # у себя и не спрашивать бота на каждое нажатие клавиши. Выбор сохраняется только
+        # в handle_chosen_inline_result
+        results = self._inline_results(query)
         self.logger.debug(f"Найдено {len(results)} результатов по запросу '{query}'")
 
         try:
-            # Отправляем результаты инлайн-запроса
-            await update.inline_query.answer(results, cache_time=1)
+            await update.inline_query.answer(
+                results, cache_time=settings.inline_cache_time, is_personal=False
+            )
         except Exception as e:
             self.logger.error(f"Ошибка при обработке inline-запроса: {str(e)}")
-
-        # Теперь вызовем handle_text, как будто пользователь ввел название гриба вручную
-        if results:
-            # Выбираем гриб по первому совпадению
-            chosen_name = results[0].input_message_content.message_text.strip("🍄 ").lower()
-            self.logger.debug(f"Выбранный гриб: {chosen_name}")
-
-            # Создаем фиктивный объект update для вызова handle_text
-            fake_message = self.FakeMessage(chosen_name, update.inline_query.from_user)
-            fake_update = type('FakeUpdate', (object,),
-                               {'message': fake_message, 'from_user': update.inline_query.from_user})
-
-            # Логируем вызов handle_text
-            self.logger.debug(f"Передаем выбранный гриб в handle_text: {chosen_name}")
-            # Передаем fake_update и context в handle_text
-            await self.handle_text(fake_update, context)
+            self._handler_failed(update, e)
 
     async def handle_chosen_inline_result(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Обработчик выбора гриба из inline-результатов"""
+        """Итоговый выбор гриба из inline-результатов: сохраняется в БД, пользователю уходит фото"""
         try:
             result = update.chosen_inline_result
-            query = result.query.strip().lower()
+            user_id = result.from_user.id
 
-            # Получаем выбранный гриб (result_id соответствует индексу в matches)
-            result_id = int(result.result_id)
-            matches = self._find_similar_mushrooms(query, limit=10)
+            # Стабильный id результата - id вида в каталоге
+            entry = self.catalog.get(int(result.result_id))
+            if entry is None:
+                self.logger.error(f"Не найден гриб по ID: {result.result_id} (запрос: {result.query})")
+                return
 
-            if not matches or result_id >= len(matches):
-                self.logger.error(f"Не найден гриб по ID: {result_id} (запрос: {query})")
+            # Повторный выбор того же гриба в окне debounce (двойное нажатие) не обрабатываем
+            if not await self.state_store.claim(
+                user_id, f"inline_choice:{result.result_id}", settings.inline_choice_debounce_seconds
+            ):
+                self.logger.debug(f"Повторный выбор гриба {entry.russian} пропущен")
                 return
 
-            mushroom_name = matches[result_id]
-            self.logger.info(f"Пользователь выбрал гриб: {mushroom_name}")
+            self.logger.info(f"Пользователь выбрал гриб: {entry.russian}")
+            await asyncio.to_thread(
+                self.db.save_query, user_id, "search_by_name_inline", query_text=f"🍄 {entry.russian}"
+            )
 
             # Отправляем фото гриба
-            if mushroom_name in self.mushroom_images:
-                photo_path = self.mushroom_images[mushroom_name]
-
-                caption = (
-                    f"🍄 <b>{mushroom_name.capitalize()}</b>\n\n"
-                )
-
+            if entry.photo_name:
+                caption = self._mushroom_caption(entry)
                 try:
-                    with open(photo_path, 'rb') as photo_file:
-                        await context.bot.send_photo(
-                            chat_id=result.from_user.id,
-                            photo=photo_file,
-                            caption=caption,
-                            parse_mode=ParseMode.HTML
-                        )
-                    self.logger.info(f"Фото гриба {mushroom_name} отправлено пользователю")
+                    await self._send_mushroom_photo(
+                        functools.partial(context.bot.send_photo, chat_id=user_id), entry, caption
+                    )
+                    self.logger.info(f"Фото гриба {entry.russian} отправлено пользователю")
                 except Exception as e:
                     self.logger.error(f"Ошибка при отправке фото: {str(e)}")
                     await context.bot.send_message(
-                        chat_id=result.from_user.id,
+                        chat_id=user_id,
+                        text=caption,
                         parse_mode=ParseMode.HTML
                     )
             else:
-                self.logger.error(f"Фото для гриба {mushroom_name} не найдено")
+                self.logger.error(f"Фото для гриба {entry.russian} не найдено")
                 await context.bot.send_message(
-                    chat_id=result.from_user.id,
-                    text=f"❌ Фото гриба '{mushroom_name}' не найдено в базе."
+                    chat_id=user_id,
+                    text=f"❌ Фото гриба '{entry.russian}' не найдено в базе."
                 )
 
         except Exception as e:
             self.logger.error(f"Ошибка в handle_chosen_inline_result: {str(e)}", exc_info=True)
+            self._handler_failed(update, e)
+
+    def _label_table(self, version):
+        table = self.label_tables.get(version)
+        if table is None:
+            table = self.label_tables[version] = LabelTable(self.model_registry.get_labels(version))
+            if len(self.label_tables) > settings.label_tables_max_versions:
+                self.label_tables.popitem(last=False)
+        else:
+            self.label_tables.move_to_end(version)
+        return table
+
+    def _fetch_result(self, task):
+        """Ждёт компактный результат задачи не дольше classification_timeout и сразу удаляет его из Redis"""
+        try:
+            return task.get(timeout=settings.classification_timeout)
+        finally:
+            task.forget()
+
+    def _gallery_items(self, version, ids):
+        """Элементы галереи похожих фото по номерам: кэш процесса на версию, недостающие - из Redis"""
+        items = self.gallery_items.get(version)
+        if items is None:
+            items = self.gallery_items[version] = {}
+            if len(self.gallery_items) > settings.label_tables_max_versions:
+                self.gallery_items.popitem(last=False)
+        else:
+            self.gallery_items.move_to_end(version)
+        missing = [i for i in ids if i not in items]
+        if missing:
+            items.update(self.model_registry.get_gallery_items(version, missing))
+        return items
+
+    def _expand_result(self, compact):
+        """Полная схема результата по таблице классов и галерее его версии модели"""
+        gallery = self._gallery_items(compact['v'], [item_id for item_id, _ in compact['s']])
+        return self._label_table(compact['v']).expand(compact, gallery)
+
+    async def _shed(self) -> bool:
+        """True - бот в ступени shed: фото не скачиваем и не сохраняем, сразу отвечаем "попробуйте позже" """
+        if await self.load_monitor.refresh() != SHED:
+            return False
+        self.load_monitor.requests['shed'] += 1
+        return True
+
+    async def _classify(self, task, payload, photos):
+        """(результат, упрощён ли) с учётом нагрузки: кэш по хэшу фото, дешёвый путь или Overloaded"""
+        monitor = self.load_monitor
+        tier = await monitor.refresh()
+        key = photo_key(photos)
+        compact = await monitor.cached_result(key)
+        if compact is not None:
+            monitor.requests['cache'] += 1
+            return await asyncio.to_thread(self._expand_result, compact), False
+        if tier == SHED:
+            monitor.requests['shed'] += 1
+            raise Overloaded()
+
+        degraded = tier == DEGRADED
+        started = time.monotonic()
+        async_result = task.apply_async(args=[payload], kwargs={'degraded': degraded})
+        try:
+            compact = await asyncio.to_thread(self._fetch_result, async_result)
+        except CeleryTimeoutError:
+            # Таймаут тоже замер нагрузки; задачу снимаем, чтобы воркер не тратил на неё время
+            monitor.record_latency(time.monotonic() - started)
+            monitor.requests['timeout'] += 1
+            async_result.revoke()
+            raise Overloaded()
+        monitor.record_latency(time.monotonic() - started)
+        monitor.requests['degraded' if degraded else 'normal'] += 1
+        if not degraded:
+            await monitor.cache_result(key, compact)
+        return await asyncio.to_thread(self._expand_result, compact), degraded
+
+    def _render_predictions(self, result, title="🍄 <b>Результаты анализа:</b>"):
+        """Текст ответа по результату классификации (схема MushroomClassifier.postprocess)"""
+        if not result['confident']:
+            return (
+                "⚠️ <b>Я не смог уверенно распознать гриб</b>\n\n"
+                f"Точность предсказания слишком низкая (<b>{result['confidences'][0]:.1f}%</b>).\n"
+                "❌ Изображение возможно некорректное или гриб не различим. "
+                "Попробуйте другое фото или убедитесь в чёткости этого изображения"
+            )
+
+        response = f"{title}\n\n"
+        rows = zip(result['latin'], result['russian'], result['edibility'], result['confidences'])
+        for i, (latin, russian, edibility, confidence) in enumerate(rows, 1):
+            marker = EDIBILITY_MARKERS.get(edibility, "⚪")
+            response += (
+                f"{i}. <b>{latin.capitalize()}</b>\n"
+                f"<i>{marker} {russian} ({edibility})</i>\n"
+                f"Точность: {confidence:.1f}%\n\n"
+            )
+
+        response += (
+            "\n⚠️ <b>Внимание!</b> Бот не является профессиональным микологом. "
+            "Всегда перепроверяйте информацию перед употреблением грибов в пищу."
+        )
+        return response
+
+    def _read_similar_photo(self, item):
+        """Байты похожего фото: эталонные берутся из кэша каталога, остальные - с диска"""
+        if item['name'] in self.photo_catalog.entries:
+            return self.photo_catalog.get_bytes(item['name'])
+        if item['path'] and os.path.exists(item['path']):
+            with open(item['path'], 'rb') as f:
+                return f.read()
+        return None
+
+    async def _send_similar_photos(self, message, similar):
+        """Отправляет визуально похожие фото из индекса эмбеддингов одним альбомом"""
+        media = []
+        for item in similar:
+            photo = await asyncio.to_thread(self._read_similar_photo, item)
+            if photo is None:
+                continue
+            caption = f"{item['name'] or item['label']} (сходство {item['score'] * 100:.0f}%)"
+            media.append(InputMediaPhoto(photo, caption=caption))
+        if not media:
+            return
+
+        try:
+            if len(media) == 1:
+                await message.reply_photo(media[0].media, caption=media[0].caption)
+            else:
+                await message.reply_media_group(media)
+        except Exception as e:
+            self.logger.warning(f"Не удалось отправить похожие фото: {str(e)}")
 
     async def handle_photo(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик фотографий"""
+        # Фото из альбома собираем и классифицируем одним запросом
+        if update.message.media_group_id:
+            await self._collect_album_photo(update, context)
+            return
+
         try:
+            # Под перегрузкой не тратим время на скачивание фото и запись в БД
+            if await self._shed():
+                await update.message.reply_text(OVERLOADED_TEXT)
+                return
+
             # Отправляем сообщение, что начинаем анализ
             message = await update.message.reply_text("🔬 Анализирую изображение...")
 
-            # Получаем изображение из сообщения
-            photo_file = await update.message.photo[-1].get_file()
-            photo_bytes = await photo_file.download_as_bytearray()
+            # Скачиваем наименьший размер фото, достаточный для модели, и отсеиваем непригодные
+            try:
+                photo_bytes = await self._download_checked_photo(update.message)
+            except ImageRejected as e:
+                self.logger.info(f"Фото отклонено до классификации: {e}")
+                await message.edit_text(f"❌ {e} Отправьте, пожалуйста, чёткое фото гриба.")
+                return
 
             # Получаем ID пользователя
             user_id = update.message.from_user.id
@@ -270,53 +409,24 @@ class TelegramBot:
             # Сохраняем запрос в БД с типом "define_by_photo" (по фото)
             query_type = "define_by_photo"
             mushroom_image = photo_bytes  # Сохраняем само изображение
-            self.db.save_query(user_id, query_type, mushroom_image)
+            # Блокирующие вызовы выносим в поток, чтобы не останавливать обработку других обновлений
+            await asyncio.to_thread(self.db.save_query, user_id, query_type, mushroom_image)
 
-            # Преобразуем фото в base64 и передаем в задачу Celery для классификации
+            # Преобразуем фото в base64 и передаем в задачу Celery для классификации (или берём из кэша)
             photo_base64 = base64.b64encode(photo_bytes).decode('utf-8')
-            task = classify_mushroom_image.apply_async(args=[photo_base64])
-
-            # Получаем результат из задачи
-            predictions = task.get()
-
-            if len(predictions) == 1 and predictions[0]['class_name'] == 'Недостаточная уверенность':
-                warn = predictions[0]
-                warn_msg = (
-                    "⚠️ <b>Я не смог уверенно распознать гриб</b>\n\n"
-                    f"Точность предсказания слишком низкая (<b>{warn['confidence']:.1f}%</b>).\n"
-                    f"{warn['description']}"
-                )
-
-                # Обновляем «🔬 Анализирую…» на предупреждение
-                await message.edit_text(warn_msg, parse_mode=ParseMode.HTML)
-
-                # Кнопка «Назад»
-                keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data='back_to_start')]]
-                await update.message.reply_text("Что дальше?", reply_markup=InlineKeyboardMarkup(keyboard))
+            try:
+                result, degraded = await self._classify(classify_mushroom_image, photo_base64, [bytes(photo_bytes)])
+            except Overloaded:
+                await message.edit_text(OVERLOADED_TEXT)
+                return
+            except ImageRejected as e:  # Воркер отклонил фото при открытии (задача не повторяется)
+                await message.edit_text(f"❌ {e} Отправьте, пожалуйста, чёткое фото гриба.")
                 return
 
-                # Формируем ответ с результатами
-            response = "🍄 <b>Результаты анализа:</b>\n\n"
-            for i, pred in enumerate(predictions[:5], 1):
-                class_name = pred['class_name']
-                confidence = pred['confidence']
-                description = settings.mushroom_descriptions.get(
-                    class_name,
-                    f"{class_name}. Информация о съедобности отсутствует"
-                )
-                response += (
-                    f"{i}. <b>{class_name.capitalize()}</b>\n"
-                    f"<i>{description}</i>\n"
-                    f"Точность: {confidence:.1f}%\n\n"
-                )
-
-            response += (
-                "\n⚠️ <b>Внимание!</b> Бот не является профессиональным микологом. "
-                "Всегда перепроверяйте информацию перед употреблением грибов в пищу."
-            )
-
-            # Обновляем сообщение с результатами
-            await message.edit_text(response, parse_mode=ParseMode.HTML)
+            # Обновляем «🔬 Анализирую…» на результаты или предупреждение
+            text = self._render_predictions(result) + (DEGRADED_NOTE if degraded else "")
+            await message.edit_text(text, parse_mode=ParseMode.HTML)
+            await self._send_similar_photos(update.message, result['similar'])
 
             # Кнопка "Назад"
             keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data='back_to_start')]]
@@ -328,23 +438,105 @@ class TelegramBot:
 
         except Exception as e:
             logging.error(f"Ошибка обработки фото: {str(e)}", exc_info=True)
+            self._handler_failed(update, e)
             await update.message.reply_text(
                 "❌ Произошла ошибка при обработке фото. Попробуйте отправить другое изображение."
             )
 
+    async def _download_checked_photo(self, message):
+        """Скачивает фото в размере, достаточном для модели; ImageRejected для непригодных"""
+        photo_size = select_photo_size(message.photo)
+        check_photo_size(photo_size)
+        photo_file = await photo_size.get_file()
+        photo_bytes = await photo_file.download_as_bytearray()
+        await asyncio.to_thread(check_image, bytes(photo_bytes))
+        return photo_bytes
+
+    async def _collect_album_photo(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Добавляет фото в общий буфер альбома; реплика, первой увидевшая альбом, обрабатывает его целиком"""
+        group_id = update.message.media_group_id
+        if await self.album_buffer.add(group_id, update.to_json()):
+            task = asyncio.create_task(self._process_album(group_id, context))
+            # Ссылка на задачу держится до её завершения, иначе сборщик мусора может её уничтожить
+            self.album_tasks.add(task)
+            task.add_done_callback(self.album_tasks.discard)
+
+    async def _process_album(self, group_id, context: ContextTypes.DEFAULT_TYPE):
+        """Классифицирует альбом одним батчем и отправляет один общий ответ"""
+        # Telegram присылает фото альбома отдельными обновлениями почти одновременно
+        await asyncio.sleep(settings.album_window_seconds)
+        raw_updates = await self.album_buffer.take(group_id, settings.album_max_photos)
+        updates = [Update.de_json(json.loads(raw), context.bot) for raw in raw_updates]
+        if not updates:
+            return
+
+        first_message = updates[0].message
+        try:
+            if await self._shed():
+                await first_message.reply_text(OVERLOADED_TEXT)
+                return
+
+            message = await first_message.reply_text(f"🔬 Анализирую {len(updates)} фото...")
+
+            # Скачиваем все фото альбома параллельно, непригодные в классификацию не идут
+            downloads = await asyncio.gather(
+                *(self._download_checked_photo(u.message) for u in updates), return_exceptions=True
+            )
+            for download in downloads:
+                if isinstance(download, Exception) and not isinstance(download, ImageRejected):
+                    raise download
+            photos = [download for download in downloads if not isinstance(download, Exception)]
+            if not photos:
+                await message.edit_text(f"❌ {downloads[0]} Отправьте, пожалуйста, чёткие фото гриба.")
+                return
+
+            user_id = first_message.from_user.id
+            await asyncio.to_thread(self.db.save_queries, user_id, "define_by_photo", photos)
+
+            photos_base64 = [base64.b64encode(photo).decode('utf-8') for photo in photos]
+            try:
+                result, degraded = await self._classify(
+                    classify_mushroom_album, photos_base64, [bytes(photo) for photo in photos]
+                )
+            except Overloaded:
+                await message.edit_text(OVERLOADED_TEXT)
+                return
+            except ImageRejected as e:
+                await message.edit_text(f"❌ {e} Отправьте, пожалуйста, чёткие фото гриба.")
+                return
+
+            title = f"🍄 <b>Результаты анализа по {len(photos)} фото:</b>"
+            text = self._render_predictions(result, title) + (DEGRADED_NOTE if degraded else "")
+            await message.edit_text(text, parse_mode=ParseMode.HTML)
+            await self._send_similar_photos(first_message, result['similar'])
+
+            keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data='back_to_start')]]
+            await first_message.reply_text("Что дальше?", reply_markup=InlineKeyboardMarkup(keyboard))
+
+        except Exception as e:
+            logging.error(f"Ошибка обработки альбома: {str(e)}", exc_info=True)
+            self._handler_failed(updates[0], e)
+            await first_message.reply_text(
+                "❌ Произошла ошибка при обработке фото. Попробуйте отправить другое изображение."
+            )
+
     async def handle_text(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик текстовых сообщений (поиск гриба по названию)"""
         try:
             user_id = update.message.from_user.id
             query = update.message.text.strip()
 
+            # Сообщение, отправленное выбором inline-результата, обрабатывает handle_chosen_inline_result
+            if update.message.via_bot and update.message.via_bot.id == context.bot.id:
+                return
+
             # Логируем полученный запрос
             self.logger.debug(f"Получен текстовый запрос: '{query}' от пользователя {user_id}")
 
             # Если запрос начинается с "🍄", это финальный запрос, сохраняем его в БД
             if query.startswith("🍄 "):
                 query_type = "search_by_name"
-                self.db.save_query(user_id, query_type, query_text=query)
+                await asyncio.to_thread(self.db.save_query, user_id, query_type, query_text=query)
 
             # Если это команды /start или /help, обрабатываем их отдельно
             if query == "/start":
@@ -358,8 +550,11 @@ class TelegramBot:
             if query.startswith("🍄 "):
                 query = query[2:].strip()  # Убираем символ "🍄" если он есть
 
+            # Состояние и id последней подсказки читаем одним запросом
+            user_state = await self.state_store.get(user_id)
+
             # Если пользователь в режиме поиска (нажал "Найти гриб по названию")
-            if self.user_states.get(user_id) == 'searching':
+            if user_state.get('state') == 'searching':
                 matches = self._find_similar_mushrooms(query, limit=5)
 
                 self.logger.debug(f"Найдено {len(matches)} грибов по запросу '{query}'")
@@ -371,10 +566,8 @@ class TelegramBot:
                     return
 
                 # Формируем кнопки для подсказок
-                buttons = []
-                for name in matches:
-                    display_name = name.capitalize()
-                    buttons.append([InlineKeyboardButton(display_name, callback_data=f"select_{name}")])
+                # В callback_data - id каталога: русское название может не уложиться в лимит 64 байта
+                buttons = [[InlineKeyboardButton(entry.russian, callback_data=f"select_{entry.id}")] for entry in matches]
 
                 # Добавляем кнопку "Назад"
                 buttons.append([InlineKeyboardButton("🔙 Назад", callback_data='back_to_start')])
@@ -387,11 +580,11 @@ class TelegramBot:
                     "Выберите нужный гриб из списка ниже:"
                 )
 
-                if 'last_suggestion_msg_id' in context.user_data:
+                if 'last_suggestion_msg_id' in user_state:
                     try:
                         await context.bot.edit_message_text(
                             chat_id=update.message.chat_id,
-                            message_id=context.user_data['last_suggestion_msg_id'],
+                            message_id=int(user_state['last_suggestion_msg_id']),
                             text=response,
                             reply_markup=reply_markup,
                             parse_mode=ParseMode.HTML
@@ -403,20 +596,20 @@ class TelegramBot:
                             reply_markup=reply_markup,
                             parse_mode=ParseMode.HTML
                         )
-                        context.user_data['last_suggestion_msg_id'] = msg.message_id
+                        await self.state_store.update(user_id, last_suggestion_msg_id=msg.message_id)
                 else:
                     msg = await update.message.reply_text(
                         response,
                         reply_markup=reply_markup,
                         parse_mode=ParseMode.HTML
                     )
-                    context.user_data['last_suggestion_msg_id'] = msg.message_id
+                    await self.state_store.update(user_id, last_suggestion_msg_id=msg.message_id)
 
-                # Если введено полное совпадение - показываем результат
-                if query.lower() in [m.lower() for m in matches]:
-                    await self._send_mushroom_details(update, context, query)
-                    context.user_data.pop('last_suggestion_msg_id', None)
-                    self.user_states.pop(user_id, None)
+                # Если введено полное совпадение - показываем результат и сбрасываем состояние
+                entry = self.catalog.find(query)
+                if entry in matches:
+                    await self._send_mushroom_details(update, context, entry)
+                    await self.state_store.remove(user_id)
 
             else:
                 # Обычный обработчик текста
@@ -438,10 +631,10 @@ class TelegramBot:
                 if len(matches) == 1:
                     await self._send_mushroom_details(update, context, matches[0])
                 else:
-                    buttons = []
-                    for name in matches[:10]:
-                        display_name = name.capitalize()
-                        buttons.append([InlineKeyboardButton(display_name, callback_data=f"select_{name}")])
+                    buttons = [
+                        [InlineKeyboardButton(entry.russian, callback_data=f"select_{entry.id}")]
+                        for entry in matches[:10]
+                    ]
 
                     buttons.append([InlineKeyboardButton("🔙 Назад", callback_data="back_to_start")])
 
@@ -460,6 +653,7 @@ class TelegramBot:
 
         except Exception as e:
             self.logger.error(f"Ошибка обработки текста: {str(e)}", exc_info=True)
+            self._handler_failed(update, e)
             await update.message.reply_text("❌ Произошла ошибка при обработке запроса.")
 
     async def send_help_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -505,7 +699,7 @@ class TelegramBot:
                 reply_markup=reply_markup,
                 parse_mode=ParseMode.HTML
             )
-            self.user_states[user_id] = 'identifying'
+            await self.state_store.update(user_id, state='identifying')
 
         elif query.data == 'search':
             bot_username = context.bot.username
@@ -525,46 +719,42 @@ class TelegramBot:
                 reply_markup=reply_markup,
                 parse_mode=ParseMode.HTML
             )
-            self.user_states[user_id] = 'searching'
+            await self.state_store.update(user_id, state='searching')
 
         elif query.data.startswith("select_"):
-            mushroom_name = query.data[7:]
+            # id каталога; в кнопках старых сообщений - русское название
+            selected = query.data[7:]
+            entry = self.catalog.get(int(selected)) if selected.isdigit() else self.catalog.find(selected)
+            if entry is None:
+                await query.edit_message_text(f"❌ Информация о грибе '{selected}' не найдена.")
+                return
 
             # Сохраняем в базу данных выбранный гриб
             query_type = "search_by_name"
-            self.db.save_query(user_id, query_type, query_text=f'🍄 {mushroom_name}')
+            await asyncio.to_thread(self.db.save_query, user_id, query_type, query_text=f'🍄 {entry.russian}')
 
             # Отправляем пользователю подробности о выбранном грибе
-            await self._send_mushroom_details_query(query, context, mushroom_name)
+            await self._send_mushroom_details_query(update, context, entry)
 
             # Снимаем состояние пользователя
-            self.user_states.pop(user_id, None)
+            await self.state_store.remove(user_id)
 
         elif query.data == 'back_to_start':
             await self.start_command(query, context)
-            self.user_states.pop(user_id, None)
+            await self.state_store.remove(user_id)
+
+    def _mushroom_caption(self, entry):
+        return f"🍄 <b>{entry.russian}</b>\n<i>{entry.latin}</i>\n{entry.marker} {entry.edibility}"
 
-    async def _send_mushroom_details(self, update, context, mushroom_name):
-        """Отправляет детальную информацию о грибе"""
+    async def _send_mushroom_details(self, update, context, entry):
+        """Отправляет детальную информацию о грибе (запись каталога)"""
         try:
-            if mushroom_name not in self.mushroom_images:
-                await update.message.reply_text(f"❌ Информация о грибе '{mushroom_name}' не найдена.")
+            if not entry.photo_name:
+                await update.message.reply_text(f"❌ Информация о грибе '{entry.russian}' не найдена.")
                 return
 
-            # Получаем путь к изображению гриба
-            photo_path = self.mushroom_images[mushroom_name]
-
-            formatted_desc = (
-                f"🍄 <b>{mushroom_name.capitalize()}</b>\n\n"
-            )
-
-            # Отправляем фото гриба и описание
-            with open(photo_path, 'rb') as photo_file:
-                await update.message.reply_photo(
-                    photo=photo_file,
-                    caption=formatted_desc,
-                    parse_mode=ParseMode.HTML
-                )
+            # Отправляем фото гриба (file_id или байты из кэша) и описание
+            await self._send_mushroom_photo(update.message.reply_photo, entry, self._mushroom_caption(entry))
 
             # Кнопка "Назад"
             keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data='back_to_start')]]
@@ -576,26 +766,18 @@ class TelegramBot:
 
         except Exception as e:
             self.logger.error(f"Ошибка отправки деталей гриба: {str(e)}")
+            self._handler_failed(update, e)
             await update.message.reply_text("❌ Произошла ошибка при отправке информации о грибе.")
 
-    async def _send_mushroom_details_query(self, query, context, mushroom_name):
+    async def _send_mushroom_details_query(self, update, context, entry):
         """Отправляет детальную информацию о грибе (для обработчика кнопок)"""
+        query = update.callback_query
         try:
-            if mushroom_name not in self.mushroom_images:
-                await query.edit_message_text(f"❌ Информация о грибе '{mushroom_name}' не найдена.")
+            if not entry.photo_name:
+                await query.edit_message_text(f"❌ Информация о грибе '{entry.russian}' не найдена.")
                 return
 
-            photo_path = self.mushroom_images[mushroom_name]
-
-            formatted_desc = (
-                f"🍄 <b>{mushroom_name.capitalize()}</b>\n\n"
-            )
-
-            await query.message.reply_photo(
-                photo=open(photo_path, 'rb'),
-                caption=formatted_desc,
-                parse_mode=ParseMode.HTML
-            )
+            await self._send_mushroom_photo(query.message.reply_photo, entry, self._mushroom_caption(entry))
 
             keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data='back_to_start')]]
             reply_markup = InlineKeyboardMarkup(keyboard)
@@ -606,26 +788,46 @@ class TelegramBot:
 
         except Exception as e:
             self.logger.error(f"Ошибка отправки деталей гриба: {str(e)}")
+            self._handler_failed(update, e)
             await query.edit_message_text("❌ Произошла ошибка при отправке информации о грибе.")
 
-    async def _send_mushroom_photo(self, update, context, mushroom_name):
-        """Отправляет фото гриба"""
-        try:
-            if mushroom_name in self.mushroom_images:
-                with open(self.mushroom_images[mushroom_name], 'rb') as photo_file:
-                    await update.message.reply_photo(
-                        photo=photo_file,
-                        caption=f"🍄 {mushroom_name.capitalize()}"
-                    )
-        except Exception as e:
-            self.logger.error(f"Ошибка отправки фото гриба: {str(e)}")
+    async def _send_mushroom_photo(self, send_photo, entry, caption):
+        """Отправляет эталонное фото: после первой загрузки - по file_id, без повторной передачи байтов"""
+        photo = entry.file_id or self.photo_catalog.get_bytes(entry.photo_name)
+        message = await send_photo(photo=photo, caption=caption, parse_mode=ParseMode.HTML)
+        if entry.file_id is None and message.photo:
+            entry.file_id = message.photo[-1].file_id
+        return message
+
+    async def process_webhook_update(self, data: dict) -> bool:
+        """Кладёт обновление из webhook в очередь приложения; False - если очередь переполнена"""
+        if self.app.update_queue.qsize() >= settings.telegram_webhook_max_queue:
+            self.logger.warning("Очередь обновлений переполнена, webhook-запрос отклонён")
+            return False
+        update = Update.de_json(data, self.app.bot)
+        await self.app.update_queue.put(update)
+        return True
 
     async def run(self):
-        """Запуск бота в режиме polling"""
-        self.logger.info("Бот запущен и ожидает сообщений...")
+        """Запуск бота в режиме polling или webhook"""
+        self.logger.info(f"Бот запущен в режиме {settings.telegram_mode} и ожидает сообщений...")
+        if settings.event_loop_lag_threshold_ms > 0:
+            EventLoopLagMonitor().start()
         await self.app.initialize()
         await self.app.start()
-        await self.app.updater.start_polling()
+
+        if settings.telegram_mode == "webhook":
+            # Все реплики регистрируют один и тот же URL балансировщика - вызов идемпотентен
+            if settings.telegram_webhook_url:
+                await self.app.bot.set_webhook(
+                    url=settings.telegram_webhook_url,
+                    secret_token=settings.telegram_webhook_secret or None,
+                    allowed_updates=Update.ALL_TYPES,
+                    max_connections=100
+                )
+                self.logger.info(f"Webhook зарегистрирован: {settings.telegram_webhook_url}")
+        else:
+            await self.app.updater.start_polling()
 
         while True:
             await asyncio.sleep(3600)
@@ -0,0 +1,40 @@
+from app.config import settings
+from app.model_registry import ModelManager
+
+
+class StubRegistry:
+    def get_state(self):
+        return {"active": "v2", "canary": None, "canary_percent": 0}
+
+
+class FlakyManager(ModelManager):
+    """Первая загрузка версии падает (чекпойнт ещё копируется), следующие проходят"""
+
+    def __init__(self):
+        super().__init__(registry=StubRegistry(), check_interval=0)
+        self.attempts = 0
+
+    def _load(self, version):
+        self.attempts += 1
+        if self.attempts == 1:
+            raise OSError("checkpoint is incomplete")
+        return f"classifier-{version}"
+
+
+def test_failed_version_waits_for_retry_interval(monkeypatch):
+    monkeypatch.setattr(settings, "model_load_retry_seconds", 3600)
+    manager = FlakyManager()
+    manager.refresh(force=True)
+    manager.refresh(force=True)
+    assert manager.attempts == 1
+    assert manager.versions() == set()
+
+
+def test_failed_version_is_reloaded_after_retry_interval(monkeypatch):
+    monkeypatch.setattr(settings, "model_load_retry_seconds", 0)
+    manager = FlakyManager()
+    manager.refresh(force=True)
+    manager.refresh(force=True)
+    assert manager.attempts == 2
+    assert manager.get() == ("v2", "classifier-v2")
+    assert "v2" not in manager._failed
@@ -0,0 +1,23 @@
+from app.catalog import get_catalog
+from app.labels import LabelTable, compact_result
+from app.models import SimilarPhoto
+
+
+def _entry_without_photo():
+    return next(entry for entry in get_catalog().entries if not entry.photo_name)
+
+
+def test_similar_photo_without_path():
+    entry = _entry_without_photo()
+    photo = SimilarPhoto(name=entry.russian, label=entry.latin, score=0.9)
+    assert photo.path is None
+    assert SimilarPhoto(name=entry.russian, label=entry.latin, path=None, score=0.9).path is None
+
+
+def test_expand_keeps_similar_hit_without_photo():
+    entry = _entry_without_photo()
+    table = LabelTable({0: entry.latin})
+    prediction = {"model_version": "v1", "confident": True, "class_ids": [0], "confidences": [97.5]}
+    compact = compact_result(prediction, [{"id": 3, "score": 0.8}])
+    result = table.expand(compact, {3: (entry.russian, entry.latin, None)})
+    assert result["similar"] == [{"name": entry.russian, "label": entry.latin, "path": None, "score": 0.8}]
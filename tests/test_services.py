@@ -0,0 +1,66 @@
+import logging
+from types import SimpleNamespace
+
+import pytest
+import torch
+from PIL import Image
+
+from app.config import settings
+from app.labels import LabelTable
+from app.services import MushroomClassifier
+
+SIZE = 32
+
+
+class StubModel(torch.nn.Module):
+    """Модель с фиксированным распределением вероятностей; считает, сколько изображений видела"""
+
+    def __init__(self, probs):
+        super().__init__()
+        self.logits = torch.log(torch.tensor(probs))
+        self.seen = 0
+
+    def forward(self, pixel_values):
+        self.seen += len(pixel_values)
+        return SimpleNamespace(logits=self.logits.expand(len(pixel_values), -1))
+
+
+class StubProcessor:
+    size = {"height": SIZE, "width": SIZE}
+
+    def __call__(self, images, size=None, return_tensors="pt"):
+        images = images if isinstance(images, list) else [images]
+        side = (size or self.size)["height"]
+        return {"pixel_values": torch.zeros(len(images), 3, side, side)}
+
+
+def make_cascade(student_probs, base_probs):
+    classifier = MushroomClassifier.__new__(MushroomClassifier)
+    classifier.logger = logging.getLogger("app.services")
+    classifier.version = "test"
+    classifier.device = torch.device("cpu")
+    classifier.model, classifier.processor = StubModel(base_probs), StubProcessor()
+    classifier.student, classifier.student_processor = StubModel(student_probs), StubProcessor()
+    classifier.labels = LabelTable({0: "Amanita muscaria", 1: "Boletus edulis", 2: "Cantharellus cibarius"})
+    classifier.cascade_calls = classifier.cascade_fallbacks = 0
+    return classifier
+
+
+@pytest.fixture
+def image_path(tmp_path):
+    path = tmp_path / "photo.jpg"
+    Image.new("RGB", (SIZE, SIZE), "brown").save(path)
+    return str(path)
+
+
+def test_cascade_tta_averages_base_model_views_only(image_path, monkeypatch):
+    monkeypatch.setattr(settings, "cascade_threshold", 40)
+    # Студент уверен выше порога каскада, но ниже порога TTA - базовая модель в первом проходе не нужна
+    classifier = make_cascade(student_probs=[0.45, 0.35, 0.20], base_probs=[0.10, 0.70, 0.20])
+
+    result = classifier.predict(image_path, tta_threshold=50)
+
+    assert classifier.student.seen == 1
+    assert classifier.model.seen == settings.tta_views + 1  # Исходный вид пересчитан базовой моделью
+    assert result["class_ids"][0] == 1
+    assert result["confidences"][0] == pytest.approx(70.0)
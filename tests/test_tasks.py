@@ -0,0 +1,60 @@
+import base64
+
+import pytest
+from PIL import Image
+
+from app import tasks
+from app.image_filter import ImageRejected
+
+
+class StubClassifier:
+    """Классификатор, который падает с заданной ошибкой и считает вызовы"""
+
+    version = "test"
+
+    def __init__(self, error):
+        self.error = error
+        self.calls = 0
+
+    def predict(self, image_path, **kwargs):
+        self.calls += 1
+        if self.error is None:
+            with Image.open(image_path):  # Как MushroomClassifier._load_image
+                pass
+        raise self.error
+
+    def predict_album(self, image_paths, **kwargs):
+        return self.predict(image_paths[0])
+
+
+@pytest.fixture
+def classifier(monkeypatch):
+    def install(error):
+        stub = StubClassifier(error)
+        monkeypatch.setattr(tasks, "_get_classifier", lambda: ("test", stub))
+        return stub
+    return install
+
+
+PHOTO = base64.b64encode(b"not an image").decode()
+
+
+def test_rejected_image_is_not_retried(classifier):
+    stub = classifier(ImageRejected("Изображение слишком большое (10000×10000)."))
+    result = tasks.classify_mushroom_image.apply(args=[PHOTO])
+    assert stub.calls == 1
+    assert isinstance(result.result, ImageRejected)
+    assert "слишком большое" in str(result.result)
+
+
+def test_corrupt_image_is_rejected_without_retry(classifier):
+    stub = classifier(None)  # Image.open на мусоре - UnidentifiedImageError
+    result = tasks.classify_mushroom_album.apply(args=[[PHOTO]])
+    assert stub.calls == 1
+    assert isinstance(result.result, ImageRejected)
+
+
+def test_transient_error_is_retried(classifier):
+    stub = classifier(OSError("I/O error"))
+    tasks.classify_mushroom_image.apply(args=[PHOTO])
+    assert stub.calls == tasks.classify_mushroom_image.max_retries + 1
@@ -0,0 +1,119 @@
+# Данные для обучения - те же шаги, что и в ViT.ipynb: фильтрация классов,
+# стратифицированное разбиение 72/8/20, аугментации и WeightedRandomSampler
+
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import torch
+from datasets import Dataset, Image, ClassLabel
+from PIL import ImageFile
+from torch.utils.data import DataLoader, WeightedRandomSampler
+from torchvision.transforms import (
+    Compose, RandomResizedCrop, RandomHorizontalFlip, ColorJitter,
+    GaussianBlur, ToTensor, Normalize, Resize
+)
+
+ImageFile.LOAD_TRUNCATED_IMAGES = True
+
+DEFAULT_DATA_DIR = "/kaggle/input/mushroom-species/dataset/"
+
+# Исключаемые классы
+TO_REMOVE = {
+    'Apioperdon pyriforme', 'Artomyces pyxidatus', 'Calycina citrina',
+    'Evernia mesomorpha', 'Graphis scripta', 'Mutinus ravenelii',
+    'Phaeophyscia orbicularis', 'Rhytisma acerinum', 'Sarcomyxa serotina',
+    'Sarcosoma globosum', 'Urnula craterium', 'Verpa bohemica'
+}
+
+
+def load_dataframe(data_dir=DEFAULT_DATA_DIR):
+    """Пути к изображениям и метки (имя подпапки)"""
+    file_names, labels = [], []
+    for file in Path(data_dir).glob('*/*.*'):
+        label = file.parent.name
+        if label not in TO_REMOVE:
+            file_names.append(str(file))
+            labels.append(label)
+    return pd.DataFrame({"image": file_names, "label": labels})
+
+
+def split_dataframe(df, labels_list=None):
+    """Стратифицированное разбиение train/val/test так же, как в ноутбуке (seed=42)"""
+    labels_list = labels_list or df['label'].unique().tolist()
+    class_labels = ClassLabel(names=labels_list)
+
+    dataset = Dataset.from_pandas(df).cast_column("image", Image())
+    dataset = dataset.map(lambda ex: {"label": class_labels.str2int(ex["label"])}, batched=False)
+    dataset = dataset.cast_column("label", class_labels)
+
+    dataset = dataset.train_test_split(test_size=0.2, stratify_by_column="label", seed=42)
+    train_val = dataset["train"].train_test_split(test_size=0.1, stratify_by_column="label", seed=42)
+    return train_val["train"], train_val["test"], dataset["test"], labels_list
+
+
+def make_transforms(processor):
+    """Аугментации для train и детерминированное преобразование для val/test"""
+    size = processor.size['height']
+    normalize = Normalize(mean=processor.image_mean, std=processor.image_std)
+
+    train_tfms = Compose([
+        RandomResizedCrop(size, scale=(0.8, 1.0), ratio=(0.75, 1.33)),
+        RandomHorizontalFlip(p=0.5),
+        ColorJitter(brightness=0.3, contrast=0.3, saturation=0.2, hue=0.02),
+        GaussianBlur(kernel_size=3, sigma=(0.1, 2.0)),
+        ToTensor(),
+        normalize,
+    ])
+
+    val_tfms = Compose([
+        Resize((size, size)),
+        ToTensor(),
+        normalize
+    ])
+    return train_tfms, val_tfms
+
+
+def apply_transforms(train_data, val_data, test_data, processor):
+    train_tfms, val_tfms = make_transforms(processor)
+
+    def train_transform(example):
+        example["pixel_values"] = [train_tfms(img.convert("RGB")) for img in example["image"]]
+        return example
+
+    def val_transform(example):
+        example["pixel_values"] = [val_tfms(img.convert("RGB")) for img in example["image"]]
+        return example
+
+    train_data.set_transform(train_transform)
+    val_data.set_transform(val_transform)
+    test_data.set_transform(val_transform)
+
+
+def make_sampler(train_labels):
+    """Балансировка train выборки"""
+    train_labels = np.asarray(train_labels)
+    class_weights = 1. / np.bincount(train_labels)
+    weights = class_weights[train_labels]
+    return WeightedRandomSampler(weights, num_samples=len(weights), replacement=True)
+
+
+def collate_fn(examples):
+    pixel_values = torch.stack([ex["pixel_values"] for ex in examples])
+    labels = torch.tensor([ex["label"] for ex in examples])
+    return {"pixel_values": pixel_values, "labels": labels}
+
+
+def make_dataloader(dataset, batch_size, sampler=None, shuffle=False, num_workers=4, drop_last=False):
+    """DataLoader для датасета HF или шардов: общий collate_fn, pin_memory на GPU"""
+    return DataLoader(
+        dataset,
+        batch_size=batch_size,
+        sampler=sampler,
+        shuffle=shuffle if sampler is None else False,
+        collate_fn=collate_fn,
+        num_workers=num_workers,
+        pin_memory=torch.cuda.is_available(),
+        persistent_workers=num_workers > 0,
+        drop_last=drop_last
+    )
@@ -0,0 +1,164 @@
+# Дистилляция знаний: компактный студент обучается на мягких метках ViT-base
+#
+# запустить: python -m training.distill --teacher ./mushrooms_model_VIT --output ./mushrooms_model_student
+# результат загружается на Google Диск, ID файлов - в GDRIVE_STUDENT_*_FILE_ID,
+# затем MODEL_BACKEND=student или MODEL_BACKEND=cascade
+
+import argparse
+import json
+
+import torch
+import torch.nn.functional as F
+from transformers import (
+    ViTImageProcessor, ViTForImageClassification, AutoModelForImageClassification,
+    TrainingArguments, Trainer, EarlyStoppingCallback
+)
+
+from training.data import (
+    DEFAULT_DATA_DIR, load_dataframe, split_dataframe, apply_transforms, make_sampler, make_dataloader, collate_fn
+)
+from training.shards import ShardDataset, make_shard_transforms
+
+DEFAULT_STUDENT = "facebook/deit-tiny-patch16-224"  # ~5.7M параметров против 86M у ViT-base
+
+
+class DistillationTrainer(Trainer):
+    """Trainer с семплером из ноутбука и функцией потерь дистилляции"""
+
+    def __init__(self, *args, teacher=None, sampler=None, temperature=2.0, alpha=0.5, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.teacher = teacher.eval()
+        self.sampler = sampler
+        self.temperature = temperature
+        self.alpha = alpha
+
+    def get_train_dataloader(self):
+        return make_dataloader(
+            self.train_dataset,
+            batch_size=self.args.per_device_train_batch_size,
+            sampler=self.sampler,
+            num_workers=self.args.dataloader_num_workers,
+            drop_last=True
+        )
+
+    def compute_loss(self, model, inputs, return_outputs=False, **kwargs):
+        labels = inputs["labels"]
+        outputs = model(pixel_values=inputs["pixel_values"])
+
+        with torch.no_grad():
+            if self.teacher.device != outputs.logits.device:
+                self.teacher.to(outputs.logits.device)
+            teacher_logits = self.teacher(pixel_values=inputs["pixel_values"]).logits
+
+        # KL между смягчёнными распределениями учителя и студента + обычная кросс-энтропия
+        t = self.temperature
+        soft_loss = F.kl_div(
+            F.log_softmax(outputs.logits / t, dim=-1),
+            F.softmax(teacher_logits / t, dim=-1),
+            reduction="batchmean"
+        ) * t * t
+        hard_loss = F.cross_entropy(outputs.logits, labels)
+        loss = self.alpha * hard_loss + (1 - self.alpha) * soft_loss
+
+        return (loss, outputs) if return_outputs else loss
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Дистилляция ViT-base в компактную модель")
+    parser.add_argument("--data-dir", default=DEFAULT_DATA_DIR)
+    parser.add_argument("--teacher", default="./mushrooms_model_VIT", help="директория обученной ViT-base")
+    parser.add_argument("--student", default=DEFAULT_STUDENT, help="предобученная компактная модель HF Hub")
+    parser.add_argument("--output", default="./mushrooms_model_student")
+    parser.add_argument("--shards", default=None, help="директория memmap-шардов (python -m training.shards)")
+    parser.add_argument("--workers", type=int, default=4, help="воркеры DataLoader")
+    parser.add_argument("--epochs", type=int, default=20)
+    parser.add_argument("--temperature", type=float, default=2.0)
+    parser.add_argument("--alpha", type=float, default=0.5, help="вес кросс-энтропии с истинными метками")
+    args = parser.parse_args()
+
+    teacher = ViTForImageClassification.from_pretrained(args.teacher)
+    # Студент получает те же входы, что и учитель (нормализация ViT-base), поэтому
+    # сохраняется с процессором учителя - инференс совпадает с обучением
+    processor = ViTImageProcessor.from_pretrained(args.teacher)
+    id2label = {int(i): label for i, label in teacher.config.id2label.items()}
+    label2id = {label: i for i, label in id2label.items()}
+    labels_list = [id2label[i] for i in range(len(id2label))]
+
+    if args.shards:
+        # Готовые uint8-тензоры из memmap: на лету только случайные аугментации
+        train_data = ShardDataset(args.shards, "train", make_shard_transforms(processor, train=True))
+        val_data = ShardDataset(args.shards, "val", make_shard_transforms(processor, train=False))
+        if train_data.meta["class_names"] != labels_list:
+            raise ValueError("Порядок классов в шардах не совпадает с моделью-учителем (см. --model-dir)")
+        sampler = make_sampler(train_data.labels)
+    else:
+        df = load_dataframe(args.data_dir)
+        train_data, val_data, test_data, _ = split_dataframe(df, labels_list)
+        sampler = make_sampler(train_data["label"])
+        apply_transforms(train_data, val_data, test_data, processor)
+
+    student = AutoModelForImageClassification.from_pretrained(
+        args.student,
+        num_labels=len(labels_list),
+        id2label=id2label,
+        label2id=label2id,
+        ignore_mismatched_sizes=True
+    )
+
+    training_args = TrainingArguments(
+        output_dir=f"{args.output}_checkpoints",
+        per_device_train_batch_size=64,
+        per_device_eval_batch_size=32,
+        eval_strategy="epoch",
+        save_strategy="epoch",
+        num_train_epochs=args.epochs,
+        learning_rate=3e-4,
+        weight_decay=0.05,
+        warmup_steps=200,
+        load_best_model_at_end=True,
+        metric_for_best_model="eval_loss",
+        greater_is_better=False,
+        report_to="none",
+        remove_unused_columns=False,
+        dataloader_drop_last=True,
+        dataloader_pin_memory=True,
+        dataloader_num_workers=args.workers
+    )
+
+    trainer = DistillationTrainer(
+        model=student,
+        args=training_args,
+        train_dataset=train_data,
+        eval_dataset=val_data,
+        data_collator=collate_fn,
+        teacher=teacher,
+        sampler=sampler,
+        temperature=args.temperature,
+        alpha=args.alpha,
+        callbacks=[EarlyStoppingCallback(
+            early_stopping_patience=3,
+            early_stopping_threshold=0.001
+        )]
+    )
+    trainer.train()
+
+    student.save_pretrained(args.output)
+    processor.save_pretrained(args.output)
+    metadata = {
+        "id2label": id2label,
+        "label2id": label2id,
+        "class_names": labels_list,
+        "image_size": processor.size['height'],
+        "teacher": args.teacher,
+        "student_base": args.student,
+        "temperature": args.temperature,
+        "alpha": args.alpha,
+    }
+    with open(f"{args.output}/metadata.json", "w") as f:
+        json.dump(metadata, f, indent=4)
+
+    print(f"Модель-студент сохранена в {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+# Обучение и калибровка голов раннего выхода для ViT-base
+#
+# Базовая модель заморожена: CLS-признаки промежуточных слоёв считаются один раз,
+# головы (LayerNorm + Linear) обучаются на них за секунды. Пороги уверенности
+# подбираются на val-разбиении ноутбука так, чтобы точность на вышедших фото была
+# не ниже точности полной модели на тех же фото (с допуском --max-drop).
+#
+# запустить: python -m training.early_exit --model-dir ./mushrooms_model_VIT [--shards ./mushroom_shards]
+# результат: early_exit.json и early_exit.safetensors в директории модели, затем EARLY_EXIT=true
+
+import argparse
+import json
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from transformers import ViTImageProcessor, ViTForImageClassification
+
+from app.early_exit import EarlyExitViT
+from training.data import DEFAULT_DATA_DIR, load_dataframe, split_dataframe, make_transforms, make_dataloader
+from training.shards import ShardDataset, make_shard_transforms
+
+
+def load_splits(args, processor, labels_list):
+    """train и val без аугментаций: признаки для голов считаются один раз"""
+    if args.shards:
+        transform = make_shard_transforms(processor, train=False)
+        train_data = ShardDataset(args.shards, "train", transform)
+        val_data = ShardDataset(args.shards, "val", transform)
+        if train_data.meta["class_names"] != labels_list:
+            raise ValueError("Порядок классов в шардах не совпадает с моделью")
+        return train_data, val_data
+
+    df = load_dataframe(args.data_dir)
+    train_data, val_data, _, _ = split_dataframe(df, labels_list)
+    _, val_tfms = make_transforms(processor)
+
+    def transform(example):
+        example["pixel_values"] = [val_tfms(img.convert("RGB")) for img in example["image"]]
+        return example
+
+    train_data.set_transform(transform)
+    val_data.set_transform(transform)
+    return train_data, val_data
+
+
+@torch.no_grad()
+def extract_features(wrapper, dataset, batch_size, workers, device, limit=None):
+    """CLS-признаки слоёв с головами, логиты полной модели и метки"""
+    if limit and limit < len(dataset):
+        indices = np.random.default_rng(42).choice(len(dataset), limit, replace=False)
+        dataset = torch.utils.data.Subset(dataset, sorted(indices.tolist()))
+    loader = make_dataloader(dataset, batch_size, num_workers=workers)
+
+    features = {key: [] for key in wrapper.exit_heads}
+    logits, labels = [], []
+    for batch in loader:
+        batch_features, batch_logits = wrapper.cls_features(batch["pixel_values"].to(device))
+        for key, value in batch_features.items():
+            features[key].append(value.cpu())
+        logits.append(batch_logits.cpu())
+        labels.append(batch["labels"])
+    return {key: torch.cat(value) for key, value in features.items()}, torch.cat(logits), torch.cat(labels)
+
+
+def train_heads(wrapper, features, labels, epochs, lr, batch_size, device):
+    """Обучение голов на закэшированных признаках кросс-энтропией"""
+    for key, head in wrapper.exit_heads.items():
+        head.train()
+        optimizer = torch.optim.AdamW(head.parameters(), lr=lr, weight_decay=0.01)
+        x, y = features[key].to(device), labels.to(device)
+        for epoch in range(epochs):
+            permutation = torch.randperm(len(x), device=device)
+            total = 0.0
+            for start in range(0, len(x), batch_size):
+                idx = permutation[start:start + batch_size]
+                loss = F.cross_entropy(head(x[idx]), y[idx])
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+                total += loss.item() * len(idx)
+        head.eval()
+        print(f"Голова после слоя {key}: loss {total / len(x):.4f}")
+
+
+@torch.no_grad()
+def exit_probs(wrapper, features, device):
+    return {key: torch.softmax(head(features[key].to(device)), dim=-1).cpu() for key, head in wrapper.exit_heads.items()}
+
+
+def simulate(probs_by_layer, final_probs, labels, thresholds, num_layers):
+    """Последовательный ранний выход на val: точность, средняя глубина, доли выходов"""
+    n = len(labels)
+    predictions = final_probs.argmax(dim=-1).clone()
+    depth = torch.full((n,), num_layers)
+    remaining = torch.ones(n, dtype=torch.bool)
+    for key in sorted(probs_by_layer, key=int):
+        confidence, predicted = probs_by_layer[key].max(dim=-1)
+        exits = remaining & (confidence >= thresholds[key])
+        predictions[exits] = predicted[exits]
+        depth[exits] = int(key)
+        remaining &= ~exits
+
+    exits = {key: round(float((depth == int(key)).float().mean()), 4) for key in sorted(probs_by_layer, key=int)}
+    exits[str(num_layers)] = round(float((depth == num_layers).float().mean()), 4)
+    return float((predictions == labels).float().mean()), float(depth.float().mean()), exits
+
+
+def calibrate(probs_by_layer, final_probs, labels, max_drop):
+    """Жадно по слоям: наименьший порог, при котором вышедшие фото не хуже полной модели"""
+    final_correct = final_probs.argmax(dim=-1) == labels
+    candidates = np.round(np.linspace(0.5, 0.999, 200), 4)
+    remaining = torch.ones(len(labels), dtype=torch.bool)
+    thresholds = {}
+    for key in sorted(probs_by_layer, key=int):
+        confidence, predicted = probs_by_layer[key].max(dim=-1)
+        correct = predicted == labels
+        thresholds[key] = 1.01  # Порог выше 1 - выход с этого слоя отключён
+        for threshold in candidates:
+            exits = remaining & (confidence >= threshold)
+            if not exits.any():
+                break
+            if correct[exits].float().mean() >= final_correct[exits].float().mean() - max_drop:
+                thresholds[key] = float(threshold)
+                remaining &= ~exits
+                break
+    return thresholds
+
+
+@torch.no_grad()
+def measure_speedup(wrapper, dataset, batch_size, device, limit=512):
+    """Реальное ускорение на val: время прохода с ранним выходом и без него"""
+    subset = torch.utils.data.Subset(dataset, range(min(limit, len(dataset))))
+    batches = [b["pixel_values"].to(device) for b in make_dataloader(subset, batch_size, num_workers=0)]
+    timings = {}
+    for use_exits in (False, True):
+        wrapper(pixel_values=batches[0], use_exits=use_exits)  # Прогрев
+        started = time.perf_counter()
+        for pixel_values in batches:
+            wrapper(pixel_values=pixel_values, use_exits=use_exits)
+        timings[use_exits] = time.perf_counter() - started
+    return timings[False] / timings[True]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Головы раннего выхода для ViT-base")
+    parser.add_argument("--model-dir", default="./mushrooms_model_VIT")
+    parser.add_argument("--data-dir", default=DEFAULT_DATA_DIR)
+    parser.add_argument("--shards", default=None, help="директория memmap-шардов (python -m training.shards)")
+    parser.add_argument("--exit-layers", type=int, nargs="+", default=None, help="по умолчанию 1/3, 1/2 и 2/3 глубины")
+    parser.add_argument("--max-drop", type=float, default=0.005, help="допустимая потеря точности на вышедших фото")
+    parser.add_argument("--epochs", type=int, default=10)
+    parser.add_argument("--lr", type=float, default=1e-3)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--max-train-samples", type=int, default=None)
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model = ViTForImageClassification.from_pretrained(args.model_dir).to(device).eval()
+    processor = ViTImageProcessor.from_pretrained(args.model_dir)
+    num_layers = model.config.num_hidden_layers
+    exit_layers = args.exit_layers or sorted({num_layers // 3, num_layers // 2, 2 * num_layers // 3} - {0})
+    labels_list = [model.config.id2label[i] for i in range(len(model.config.id2label))]
+
+    wrapper = EarlyExitViT(model, exit_layers).to(device).eval()
+    train_data, val_data = load_splits(args, processor, labels_list)
+
+    print("Признаки train...")
+    train_features, _, train_labels = extract_features(
+        wrapper, train_data, args.batch_size, args.workers, device, args.max_train_samples
+    )
+    train_heads(wrapper, train_features, train_labels, args.epochs, args.lr, args.batch_size, device)
+
+    print("Калибровка на val...")
+    val_features, val_logits, val_labels = extract_features(wrapper, val_data, args.batch_size, args.workers, device)
+    probs_by_layer = exit_probs(wrapper, val_features, device)
+    final_probs = torch.softmax(val_logits, dim=-1)
+    wrapper.thresholds = calibrate(probs_by_layer, final_probs, val_labels, args.max_drop)
+
+    full_accuracy = float((final_probs.argmax(dim=-1) == val_labels).float().mean())
+    accuracy, average_layers, exits = simulate(probs_by_layer, final_probs, val_labels, wrapper.thresholds, num_layers)
+    report = {
+        "val_samples": len(val_labels),
+        "full_accuracy": round(full_accuracy, 4),
+        "early_exit_accuracy": round(accuracy, 4),
+        "accuracy_drop": round(full_accuracy - accuracy, 4),
+        "average_layers": round(average_layers, 2),
+        "num_layers": num_layers,
+        "layer_speedup": round(num_layers / average_layers, 2),  # Доля FLOPs энкодера, головы пренебрежимо малы
+        "measured_speedup": round(measure_speedup(wrapper, val_data, args.batch_size, device), 2),
+        "exit_distribution": exits,
+    }
+    wrapper.save_heads(args.model_dir, report)
+    print(json.dumps({"thresholds": wrapper.thresholds, **report}, ensure_ascii=False, indent=2))
+    print(f"Головы раннего выхода сохранены в {args.model_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+# Предварительно декодированные шарды датасета (uint8, NumPy memmap)
+#
+# JPEG декодируются и уменьшаются один раз, дальше каждая эпоха читает готовые тензоры
+# из memmap без копирования; на лету выполняются только случайные аугментации.
+#
+# собрать: python -m training.shards --data-dir /kaggle/input/mushroom-species/dataset/ \
+#              --model-dir ./mushrooms_model_VIT --output ./mushroom_shards
+
+import argparse
+import json
+import os
+from bisect import bisect_right
+from multiprocessing import Pool
+
+import numpy as np
+import torch
+from datasets import Image as ImageFeature
+from PIL import Image
+from torch.utils.data import Dataset
+from torchvision.transforms import v2
+
+from training.data import DEFAULT_DATA_DIR, load_dataframe, split_dataframe
+
+SPLITS = ("train", "val", "test")
+
+
+def _decode(args):
+    """Декодирование и приведение к квадрату store_size (выполняется в пуле процессов)"""
+    path, store_size = args
+    with Image.open(path) as image:
+        image.draft("RGB", (store_size, store_size))  # Для JPEG декодируем сразу в уменьшенном виде
+        image = image.convert("RGB").resize((store_size, store_size), Image.BILINEAR)
+        return np.asarray(image, dtype=np.uint8)
+
+
+def write_split(paths, labels, out_dir, split, store_size, shard_size, workers):
+    """Пишет один split в шарды {split}-NNNNN.npy и возвращает их размеры"""
+    shard_lengths = []
+    with Pool(workers) as pool:
+        for shard_idx, start in enumerate(range(0, len(paths), shard_size)):
+            chunk = paths[start:start + shard_size]
+            shard = np.lib.format.open_memmap(
+                os.path.join(out_dir, f"{split}-{shard_idx:05d}.npy"),
+                mode="w+", dtype=np.uint8, shape=(len(chunk), store_size, store_size, 3)
+            )
+            for i, array in enumerate(pool.imap(_decode, [(p, store_size) for p in chunk], chunksize=16)):
+                shard[i] = array
+            shard.flush()
+            del shard
+            shard_lengths.append(len(chunk))
+            print(f"{split}: шард {shard_idx} ({start + len(chunk)}/{len(paths)})")
+
+    np.save(os.path.join(out_dir, f"{split}-labels.npy"), np.asarray(labels, dtype=np.int64))
+    return shard_lengths
+
+
+def build_shards(data_dir, out_dir, labels_list=None, store_size=256, shard_size=4096, workers=None):
+    """Собирает шарды train/val/test с тем же разбиением, что и в ноутбуке"""
+    os.makedirs(out_dir, exist_ok=True)
+    df = load_dataframe(data_dir)
+    train_data, val_data, test_data, labels_list = split_dataframe(df, labels_list)
+
+    meta = {"class_names": labels_list, "store_size": store_size, "splits": {}}
+    for split, data in zip(SPLITS, (train_data, val_data, test_data)):
+        # Только пути к файлам: декодирование выполняет пул процессов
+        data = data.cast_column("image", ImageFeature(decode=False))
+        paths = [item["path"] for item in data["image"]]
+        meta["splits"][split] = write_split(
+            paths, data["label"], out_dir, split, store_size, shard_size, workers or os.cpu_count()
+        )
+
+    with open(os.path.join(out_dir, "meta.json"), "w") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=4)
+    return meta
+
+
+def make_shard_transforms(processor, train: bool):
+    """Аугментации ноутбука для uint8-тензоров (C, H, W)"""
+    size = processor.size['height']
+    finish = [
+        v2.ToDtype(torch.float32, scale=True),
+        v2.Normalize(mean=processor.image_mean, std=processor.image_std),
+    ]
+    if train:
+        return v2.Compose([
+            v2.RandomResizedCrop(size, scale=(0.8, 1.0), ratio=(0.75, 1.33), antialias=True),
+            v2.RandomHorizontalFlip(p=0.5),
+            v2.ColorJitter(brightness=0.3, contrast=0.3, saturation=0.2, hue=0.02),
+            v2.GaussianBlur(kernel_size=3, sigma=(0.1, 2.0)),
+            *finish,
+        ])
+    return v2.Compose([v2.Resize((size, size), antialias=True), *finish])
+
+
+class ShardDataset(Dataset):
+    """Датасет поверх memmap-шардов; возвращает те же поля, что ожидает collate_fn"""
+
+    def __init__(self, root, split, transform=None):
+        with open(os.path.join(root, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.root = root
+        self.split = split
+        self.transform = transform
+        self.labels = np.load(os.path.join(root, f"{split}-labels.npy"))
+        self.offsets = np.cumsum([0] + self.meta["splits"][split]).tolist()
+        self._shards = None  # Открываются лениво - отдельно в каждом воркере DataLoader
+
+    def __len__(self):
+        return self.offsets[-1]
+
+    def _open(self):
+        # mmap_mode="c": страницы читаются с диска по требованию и не копируются,
+        # а torch.from_numpy получает записываемый массив без предупреждений
+        self._shards = [
+            np.load(os.path.join(self.root, f"{self.split}-{i:05d}.npy"), mmap_mode="c")
+            for i in range(len(self.offsets) - 1)
+        ]
+
+    def __getitem__(self, idx):
+        if self._shards is None:
+            self._open()
+        shard_idx = bisect_right(self.offsets, idx) - 1
+        array = self._shards[shard_idx][idx - self.offsets[shard_idx]]
+        pixel_values = torch.from_numpy(array).permute(2, 0, 1)
+        if self.transform is not None:
+            pixel_values = self.transform(pixel_values)
+        return {"pixel_values": pixel_values, "label": int(self.labels[idx])}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сборка memmap-шардов датасета грибов")
+    parser.add_argument("--data-dir", default=DEFAULT_DATA_DIR)
+    parser.add_argument("--output", default="./mushroom_shards")
+    parser.add_argument("--model-dir", default=None, help="взять порядок классов из config.json модели")
+    parser.add_argument("--store-size", type=int, default=256, help="сторона хранимого изображения (>= 224)")
+    parser.add_argument("--shard-size", type=int, default=4096)
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    labels_list = None
+    if args.model_dir:
+        with open(os.path.join(args.model_dir, "config.json")) as f:
+            id2label = json.load(f)["id2label"]
+        labels_list = [id2label[str(i)] for i in range(len(id2label))]
+
+    meta = build_shards(args.data_dir, args.output, labels_list, args.store_size, args.shard_size, args.workers)
+    print(f"Шарды сохранены в {args.output}: " +
+          ", ".join(f"{split}={sum(lengths)}" for split, lengths in meta["splits"].items()))
+
+
+if __name__ == "__main__":
+    main()